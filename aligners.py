@@ -1,218 +1,200 @@
 import subprocess
 import time
-import tracemalloc
 from util import save_results
 from pyfamsa import Aligner, Sequence
-from util import parse_fasta
-
-def famsa_python(input_file, output_file, threads, dataset_size, result_dict):
-
-    sequences = []
-    for name, seq in zip(*parse_fasta(input_file, return_names=True, clean=None, full_name=False)):
-        sequences.append(Sequence(name.encode(), seq.encode()))
-    
-    # start computing time and memory
-    tracemalloc.start()
-    start = time.time()
-
-    aligner = Aligner(guide_tree="sl")
-    msa = aligner.align(sequences)
-
-    with open(output_file, "w") as f:
-        for seq in msa:
-            print(f">{seq.id.decode()}\n{seq.sequence.decode()}", file=f)
-
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "famsa-python", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
-
-def famsa_medoid_python(input_file, output_file, threads, dataset_size, result_dict):
-
-    sequences = []
-    for name, seq in zip(*parse_fasta(input_file, return_names=True, clean=None, full_name=False)):
-        sequences.append(Sequence(name.encode(), seq.encode()))
-    
-    # start computing time and memory
-    tracemalloc.start()
-    start = time.time()
-
-    aligner = Aligner(guide_tree="sl", tree_heuristic="medoid")
-    msa = aligner.align(sequences)
-
-    with open(output_file, "w") as f:
-        for seq in msa:
-            print(f">{seq.id.decode()}\n{seq.sequence.decode()}", file=f)
-
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "famsa-medoid-python", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
-
-
-def famsa(input_file, output_file, threads, dataset_size, result_dict):
-    tracemalloc.start()
-    start = time.time()
-
+from util import iter_fasta
+from resources import run_measured, measure_self, LimitExceeded
+from sampler import ProcSampler
+from spans import span
+
+def _make_sampler(sample_interval, timeseries_dir):
+    if timeseries_dir is None:
+        return None
+    return ProcSampler(interval=sample_interval or 0.1)
+
+def _save_timeseries(sampler, usage, timeseries_dir, aligner, dataset_size, threads, tag=None):
+    if sampler is None:
+        return
+    usage.update(sampler.summary())
+    # one file per trial (and warm-up), so repeats do not overwrite each other
+    suffix = f"_{tag}" if tag else ""
+    usage["timeseries"] = sampler.save(f"{timeseries_dir}/{aligner}_{dataset_size}_{threads}{suffix}.npz")
+
+def _run_aligner(aligner, cmd, threads, dataset_size, result_dict, shell=False, sample_interval=None, timeseries_dir=None, affinity=None,
+                 timeout=None, memory_limit_mb=None, cgroup_parent=None, timeseries_name=None, timeseries_tag=None):
+    """
+        Run an aligner command, optionally sampling its process tree every sample_interval
+        seconds into {timeseries_dir}/{aligner}_{dataset_size}_{threads}_{timeseries_tag}.npz
+        (timeseries_name instead of aligner when given, for wrappers storing their rows under
+        another name; the tag tells trials and warm-ups apart) and pinning it to the CPUs in affinity.
+
+        A run stopped by timeout (seconds) or memory_limit_mb is stored as a DNF row with
+        status "timeout" or "oom" and the usage measured up to the kill.
+    """
+    sampler = _make_sampler(sample_interval, timeseries_dir)
     try:
-        proc = subprocess.run(["famsa", 
-                                "-gz",
-                                "-t", threads, 
-                                input_file,
-                                output_file],
-                                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                                )
+        with span(aligner):
+            usage = run_measured(cmd, shell=shell, sampler=sampler, affinity=affinity,
+                                 timeout=timeout, memory_limit_mb=memory_limit_mb, cgroup_parent=cgroup_parent)
+        usage["status"] = "ok"
+    except LimitExceeded as e:
+        print(f"DNF {aligner} on {dataset_size} ({threads} threads): {e.status}")
+        usage = e.usage
+        usage["status"] = e.status
     except subprocess.CalledProcessError as e:
         print(e.stderr.decode('utf-8'))
         print(e.stdout.decode('utf-8'))
         raise e
 
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "famsa", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
-
-def famsa_medoid(input_file, output_file, threads, dataset_size, result_dict):
-    tracemalloc.start()
-    start = time.time()
-
-    try:
-        proc = subprocess.run(["famsa", 
-                                "-medoidtree",
-                                "-gz",
-                                "-t", threads, 
-                                input_file,
-                                output_file],
-                                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                                )
-    except subprocess.CalledProcessError as e:
-        print(e.stderr.decode('utf-8'))
-        print(e.stdout.decode('utf-8'))
-        raise e
-
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "famsa-medoid", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
-
-def clustalo(input_file, output_file, threads, dataset_size, result_dict):
-    tracemalloc.start()
-    start = time.time()
-
-    try:
-        proc = subprocess.run(["clustalo", 
-                                "--threads", threads, 
-                                "-i", input_file,
-                                "-o", output_file,
-                                "--force"],
-                                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                                )
-    except subprocess.CalledProcessError as e:
-        print(e.stderr.decode('utf-8'))
-        print(e.stdout.decode('utf-8'))
-        raise e
-
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "clustalo", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
-
-def mafft_parttree(input_file, output_file, threads, dataset_size, result_dict):
-    tracemalloc.start()
-    start = time.time()
-    try:
-        proc = subprocess.run(f"mafft --anysymbol --quiet --parttree --thread {threads} {input_file} > {output_file}",
-                                shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        print(e.stderr.decode('utf-8'))
-        print(e.stdout.decode('utf-8'))
-        raise e
-
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "mafft-parttree", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
-
-def kalign3(input_file, output_file, threads, dataset_size, result_dict):
-    tracemalloc.start()
-    start = time.time()
-
-    try:
-        proc = subprocess.run(["kalign", 
-                                "--nthreads", threads, 
-                                "-i", input_file,
-                                "-o", output_file],
-                                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                                )
-    except subprocess.CalledProcessError as e:
-        print(e.stderr.decode('utf-8'))
-        print(e.stdout.decode('utf-8'))
-        raise e
-
-    end = time.time()
-    current, peak = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-
-    # Metrics
-    time_taken = (end - start) / 60
-    current_mb = current / 10**3
-    peak_mb = peak / 10**3
-    usage_mb = peak_mb - current_mb
-    # print(f"Current memory usage is {current / 10**3}KB; Peak was {peak / 10**3}KB; Diff = {(peak - current) / 10**3}KB")
-    # print(f"Total time taken: {total_time}")
-
-    save_results(result_dict, "kalign3", current_mb, peak_mb, usage_mb, time_taken, dataset_size, threads)
\ No newline at end of file
+    _save_timeseries(sampler, usage, timeseries_dir, timeseries_name or aligner, dataset_size, threads, timeseries_tag)
+    return save_results(result_dict, aligner, usage, dataset_size, threads)
+
+# bytes buffered by the pyfamsa output writer
+WRITE_BUFFER = 1 << 22
+
+def _run_pyfamsa(aligner_name, aligner_options, input_file, output_file, threads, dataset_size, result_dict, measure_tree=False, **run_options):
+    """
+        Align in-process with pyfamsa, timing each phase separately (seconds):
+            parse_time: reading the input into (name, sequence) bytes
+            sequence_time: building pyfamsa.Sequence objects
+            align_time: Aligner.align
+            write_time: serializing the alignment through a buffered bulk writer
+            tree_time: Aligner.build_tree alone, only with measure_tree and where pyfamsa provides it;
+                       run after the measured region since align() builds its own tree, so it does not
+                       count towards time but makes every trial take longer
+    """
+    # start computing time and memory
+    sampler = _make_sampler(run_options.get("sample_interval"), run_options.get("timeseries_dir"))
+    phases = {}
+    with measure_self(sampler) as usage:
+        start = time.perf_counter()
+        with span(f"{aligner_name} parse") as parse_span:
+            records = list(iter_fasta(input_file, clean=None, full_name=False))
+            parse_span.add_bytes(sum(len(name) + len(seq) for name, seq in records))
+        phases["parse_time"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with span(f"{aligner_name} sequence objects"):
+            sequences = [Sequence(name, seq) for name, seq in records]
+            del records
+        phases["sequence_time"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with span(f"{aligner_name} align"):
+            aligner = Aligner(threads=int(threads), **aligner_options)
+            msa = aligner.align(sequences)
+        phases["align_time"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with span(f"{aligner_name} write") as write_span, open(output_file, "wb", buffering=WRITE_BUFFER) as f:
+            f.writelines(b">%s\n%s\n" % (seq.id, seq.sequence) for seq in msa)
+            write_span.add_bytes(f.tell())
+        phases["write_time"] = time.perf_counter() - start
+
+    if measure_tree and hasattr(aligner, "build_tree"):
+        start = time.perf_counter()
+        with span(f"{aligner_name} guide tree"):
+            aligner.build_tree(sequences)
+        phases["tree_time"] = time.perf_counter() - start
+
+    usage.update(phases)
+    usage.pop("start_rss_mb", None)
+    usage["status"] = "ok"
+    _save_timeseries(sampler, usage, run_options.get("timeseries_dir"), run_options.get("timeseries_name") or aligner_name,
+                     dataset_size, threads, run_options.get("timeseries_tag"))
+    return save_results(result_dict, aligner_name, usage, dataset_size, threads)
+
+def famsa_python(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    return _run_pyfamsa("famsa-python", dict(guide_tree="sl"),
+                        input_file, output_file, threads, dataset_size, result_dict, **run_options)
+
+def famsa_medoid_python(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    return _run_pyfamsa("famsa-medoid-python", dict(guide_tree="sl", tree_heuristic="medoid"),
+                        input_file, output_file, threads, dataset_size, result_dict, **run_options)
+
+
+def famsa(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    return _run_aligner("famsa",
+                        ["famsa", 
+                        "-gz",
+                        "-t", threads, 
+                        input_file,
+                        output_file],
+                        threads, dataset_size, result_dict, **run_options)
+
+def famsa_medoid(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    return _run_aligner("famsa-medoid",
+                        ["famsa", 
+                        "-medoidtree",
+                        "-gz",
+                        "-t", threads, 
+                        input_file,
+                        output_file],
+                        threads, dataset_size, result_dict, **run_options)
+
+def clustalo(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    return _run_aligner("clustalo",
+                        ["clustalo", 
+                        "--threads", threads, 
+                        "-i", input_file,
+                        "-o", output_file,
+                        "--force"],
+                        threads, dataset_size, result_dict, **run_options)
+
+def mafft_parttree(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    # rusage of the shell covers every mafft stage it spawns
+    return _run_aligner("mafft-parttree",
+                        f"mafft --anysymbol --quiet --parttree --thread {threads} {input_file} > {output_file}",
+                        threads, dataset_size, result_dict, shell=True, **run_options)
+
+def kalign3(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+    return _run_aligner("kalign3",
+                        ["kalign", 
+                        "--nthreads", threads, 
+                        "-i", input_file,
+                        "-o", output_file],
+                        threads, dataset_size, result_dict, **run_options)
+
+def famsa_add(input_file, output_file, threads, dataset_size, result_dict, base_alignment=None, **run_options):
+    # the new sequences are aligned into a profile first, then merged with the base alignment by
+    # profile-profile alignment; rusage of the shell covers both famsa runs
+    batch_alignment = f"{output_file}.batch.fasta"
+    return _run_aligner("famsa-add",
+                        f"famsa -t {threads} {input_file} {batch_alignment} && "
+                        f"famsa -t {threads} {base_alignment} {batch_alignment} {output_file}; "
+                        f"status=$?; rm -f {batch_alignment}; exit $status",
+                        threads, dataset_size, result_dict, shell=True, **run_options)
+
+def famsa_profile(input_file, output_file, threads, dataset_size, result_dict, second_profile=None, **run_options):
+    # profile-profile alignment of two existing alignments
+    return _run_aligner("famsa-profile",
+                        ["famsa",
+                        "-t", threads,
+                        input_file,
+                        second_profile,
+                        output_file],
+                        threads, dataset_size, result_dict, **run_options)
+
+def mafft_add(input_file, output_file, threads, dataset_size, result_dict, base_alignment=None, **run_options):
+    return _run_aligner("mafft-add",
+                        f"mafft --anysymbol --quiet --thread {threads} --add {input_file} {base_alignment} > {output_file}",
+                        threads, dataset_size, result_dict, shell=True, **run_options)
+
+def mafft_addfragments(input_file, output_file, threads, dataset_size, result_dict, base_alignment=None, **run_options):
+    return _run_aligner("mafft-addfragments",
+                        f"mafft --anysymbol --quiet --thread {threads} --addfragments {input_file} {base_alignment} > {output_file}",
+                        threads, dataset_size, result_dict, shell=True, **run_options)
+
+# wrapper of every aligner by the name its results are stored under
+ALIGNERS = {
+    "famsa": famsa,
+    "famsa-medoid": famsa_medoid,
+    "famsa-python": famsa_python,
+    "famsa-medoid-python": famsa_medoid_python,
+    "clustalo": clustalo,
+    "mafft-parttree": mafft_parttree,
+    "kalign3": kalign3,
+    "famsa-add": famsa_add,
+    "mafft-add": mafft_add,
+    "mafft-addfragments": mafft_addfragments,
+}
@@ -0,0 +1,271 @@
+import itertools
+import math
+import numpy as np
+import pandas as pd
+
+
+def scaling_report(df, time_column="Time"):
+    """
+        Thread-scaling metrics per aligner and dataset size.
+
+        The baseline is the smallest thread count measured for each (aligner, dataset size), normally 1.
+        With a baseline of p0 threads the processor ratio n = p / p0 is used in place of p, so the
+        numbers stay comparable when the single-thread run is skipped.
+
+        input:
+            df: results dataframe from util.dict_to_dataframe (needs Aligner, Dataset Size, Threads and time_column)
+
+        output: dataframe with
+            Speedup: T(p0) / T(p)
+            Efficiency: Speedup / n
+            Serial Fraction: Karp-Flatt metric (1/Speedup - 1/n) / (1 - 1/n), undefined for n = 1
+    """
+    if "Status" in df.columns:
+        # DNF runs were cut short, their times say nothing about scaling
+        df = df[df["Status"] == "ok"]
+
+    rows = []
+    for (aligner, dataset_size), group in df.groupby(["Aligner", "Dataset Size"], sort=False):
+        group = group.sort_values("Threads")
+        base_threads = group["Threads"].iloc[0]
+        base_time = group[time_column].iloc[0]
+
+        for threads, elapsed in zip(group["Threads"], group[time_column]):
+            n = threads / base_threads
+            speedup = base_time / elapsed if elapsed > 0 else np.nan
+            if n > 1 and speedup > 0:
+                serial_fraction = (1 / speedup - 1 / n) / (1 - 1 / n)
+            else:
+                serial_fraction = np.nan
+
+            rows.append({
+                "Aligner": aligner,
+                "Dataset Size": dataset_size,
+                "Threads": threads,
+                "Baseline Threads": base_threads,
+                time_column: elapsed,
+                "Speedup": speedup,
+                "Efficiency": speedup / n,
+                "Serial Fraction": serial_fraction,
+            })
+
+    return pd.DataFrame(rows)
+
+
+def robust_summary(values, confidence=0.95, n_boot=2000, seed=0):
+    """
+        Robust statistics of repeated measurements of one benchmark cell.
+
+        input:
+            values: raw samples
+            confidence: level of the percentile bootstrap interval of the median
+            n_boot: bootstrap resamples
+            seed: RNG seed, fixed so the interval is reproducible
+
+        output: dict with median, iqr, min, ci_low, ci_high and cv (std / mean, NaN below two samples)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+
+    if len(values) > 1:
+        rng = np.random.default_rng(seed)
+        boot = np.median(rng.choice(values, size=(n_boot, len(values)), replace=True), axis=1)
+        alpha = (1 - confidence) / 2
+        ci_low, ci_high = np.percentile(boot, [100 * alpha, 100 * (1 - alpha)])
+        mean = values.mean()
+        cv = values.std(ddof=1) / mean if mean > 0 else np.nan
+    else:
+        ci_low = ci_high = median
+        cv = np.nan
+
+    return {
+        "median": float(median),
+        "iqr": float(q3 - q1),
+        "min": float(values.min()),
+        "ci_low": float(ci_low),
+        "ci_high": float(ci_high),
+        "cv": float(cv),
+    }
+
+
+def permutation_test(baseline, candidate, n_perm=10000, seed=0):
+    """
+        One-sided permutation test that candidate samples are larger than baseline samples.
+
+        The statistic is the difference of means. All splits are enumerated when there are at most
+        n_perm of them (exact test), otherwise n_perm random splits are drawn. With 3 trials on each
+        side the smallest possible p-value is 1/20 = 0.05, so regressions need --repeats 3 or more.
+
+        output: p-value, NaN when either side has fewer than two samples
+    """
+    baseline = np.asarray(baseline, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    if len(baseline) < 2 or len(candidate) < 2:
+        return np.nan
+
+    pooled = np.concatenate([baseline, candidate])
+    observed = candidate.mean() - baseline.mean()
+    k = len(candidate)
+    exact = math.comb(len(pooled), k) <= n_perm
+    if exact:
+        splits = np.array(list(itertools.combinations(range(len(pooled)), k)))
+    else:
+        rng = np.random.default_rng(seed)
+        splits = np.argsort(rng.random((n_perm, len(pooled))), axis=1)[:, :k]
+
+    candidate_sums = pooled[splits].sum(axis=1)
+    differences = candidate_sums / k - (pooled.sum() - candidate_sums) / (len(pooled) - k)
+    # tolerance so the observed split always counts despite rounding
+    extreme = int(np.sum(differences >= observed - 1e-12 * max(abs(observed), 1)))
+    if exact:
+        return extreme / len(splits)
+    # the observed split counts once more, so a sampled p-value is never 0
+    return (extreme + 1) / (n_perm + 1)
+
+
+# two-sided 95% Student t quantiles by degrees of freedom, for the few points a size sweep has
+T_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+        12: 2.179, 15: 2.131, 20: 2.086, 30: 2.042}
+
+# complexity models, linear in log space: log y = log a + b log N (power law) or log a + log(N log N)
+COMPLEXITY_MODELS = ("power law", "N log N")
+
+# a tier is off the fitted curve when it falls outside the 95% prediction interval of the fit
+# without it, i.e. when its externally studentized residual exceeds the t quantile with df - 1
+
+
+def _t_95(df):
+    return T_95[max(k for k in T_95 if k <= df)] if df >= 1 else np.nan
+
+
+def _design(n, model):
+    n = np.asarray(n, dtype=np.float64)
+    if model == "power law":
+        return np.column_stack([np.ones_like(n), np.log(n)]), np.zeros_like(n)
+    # the N log N shape is fixed, only the constant is fitted
+    return np.ones((len(n), 1)), np.log(n * np.log(n))
+
+
+def fit_complexity(n, values, model="power law"):
+    """
+        Least-squares fit of values(N) in log space.
+
+        input:
+            n: problem sizes (number of sequences)
+            values: measurement at each size (time, peak RSS, ...), all positive
+            model: "power law" (a N^b) or "N log N" (a N log N)
+
+        output: dict with
+            a, b: the fitted curve (b is 1 for N log N), b_se the standard error of the exponent
+            sigma: residual standard deviation in log space, aic: Akaike information criterion
+            coef, cov, df: log-space coefficients, their covariance and the residual degrees of freedom
+            residuals: externally studentized (leave-one-out) residuals of the points, NaN when
+                       the fit without a point has no degrees of freedom left
+            off_fit: points outside the 95% prediction interval of the fit without them
+    """
+    X, offset = _design(n, model)
+    y = np.log(np.asarray(values, dtype=np.float64)) - offset
+    coef, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    residual = y - X @ coef
+    df = len(y) - X.shape[1]
+    sigma2 = float(residual @ residual / df) if df > 0 else np.nan
+    xtx_inv = np.linalg.pinv(X.T @ X)
+    cov = sigma2 * xtx_inv
+    leverage = np.einsum("ij,jk,ik->i", X, xtx_inv, X)
+    rss = max(float(residual @ residual), 1e-300)
+    # an internally studentized residual is bounded by sqrt(df); leaving the point out is not
+    with np.errstate(divide="ignore", invalid="ignore"):
+        loo_sigma2 = (rss - residual ** 2 / (1 - leverage)) / (df - 1) if df > 1 else np.full_like(residual, np.nan)
+        studentized = residual / np.sqrt(np.maximum(loo_sigma2, 1e-300) * (1 - leverage))
+    # an exact fit has nothing to studentize
+    studentized[np.abs(residual) < 1e-12] = 0.0
+    off_fit = np.abs(studentized) > _t_95(df - 1) if df > 1 else np.zeros(len(y), dtype=bool)
+
+    return {
+        "model": model,
+        "a": float(np.exp(coef[0])),
+        "b": float(coef[1]) if model == "power law" else 1.0,
+        "b_se": float(np.sqrt(cov[1, 1])) if model == "power law" else 0.0,
+        "sigma": float(np.sqrt(sigma2)),
+        "aic": len(y) * np.log(rss / len(y)) + 2 * (X.shape[1] + 1),
+        "coef": coef,
+        "cov": cov,
+        "df": df,
+        "residuals": studentized,
+        "off_fit": off_fit,
+    }
+
+
+def predict_complexity(fit, n):
+    """
+        Extrapolate a fit_complexity fit to sizes n.
+
+        output: (estimate, low, high) arrays, low/high being the 95% prediction interval
+    """
+    X, offset = _design(np.atleast_1d(n), fit["model"])
+    mean = X @ fit["coef"] + offset
+    se = np.sqrt(fit["sigma"] ** 2 + np.einsum("ij,jk,ik->i", X, fit["cov"], X))
+    margin = _t_95(fit["df"]) * se
+    return np.exp(mean), np.exp(mean - margin), np.exp(mean + margin)
+
+
+def complexity_report(df, sequences, targets=(), metrics=("Time", "Peak RSS (MB)")):
+    """
+        Empirical complexity of every aligner over the dataset size tiers.
+
+        Each metric is fitted against the number of sequences with both COMPLEXITY_MODELS, per
+        aligner and thread count, on the ok runs of at least three distinct sizes; the model with the
+        lower AIC is marked best. A tier outside the 95% prediction interval of the best model fitted
+        without it (externally studentized residual), or that did not finish, has left the fitted regime.
+
+        input:
+            df: results dataframe from util.dict_to_dataframe
+            sequences: dict dataset size (tier name) -> number of sequences
+            targets: sizes to extrapolate to
+
+        output: (fits, points) dataframes
+            fits: one row per aligner x threads x metric x model with the curve, the exponent and its
+                  standard error, AIC, Best, and Predicted/Low/High columns for every target size
+            points: one row per measured tier with its Value, externally studentized residual and Off Fit flag
+    """
+    if "Dataset Size" not in df.columns:
+        return pd.DataFrame(), pd.DataFrame()
+    df = df[df["Dataset Size"].isin(list(sequences))].copy()
+    df["Sequences"] = df["Dataset Size"].map(sequences)
+    status = df["Status"] if "Status" in df.columns else pd.Series("ok", index=df.index)
+
+    fits, points = [], []
+    for (aligner, threads), group in df.groupby(["Aligner", "Threads"], sort=False):
+        ok = group[status[group.index] == "ok"].sort_values("Sequences")
+        for metric in metrics:
+            if metric not in ok.columns:
+                continue
+            measured = ok[ok[metric] > 0]
+            if measured["Sequences"].nunique() < 3:
+                continue
+            results = {model: fit_complexity(measured["Sequences"], measured[metric], model) for model in COMPLEXITY_MODELS}
+            best = min(results, key=lambda model: results[model]["aic"])
+
+            for model, fit in results.items():
+                row = {"Aligner": aligner, "Threads": threads, "Metric": metric, "Model": model,
+                       "Coefficient": fit["a"], "Exponent": fit["b"], "Exponent SE": fit["b_se"],
+                       "Log Residual SD": fit["sigma"], "AIC": fit["aic"], "Best": model == best}
+                if len(targets):
+                    estimate, low, high = predict_complexity(fit, targets)
+                    for target, e, lo, hi in zip(targets, estimate, low, high):
+                        row[f"Predicted N={target}"] = e
+                        row[f"Low N={target}"] = lo
+                        row[f"High N={target}"] = hi
+                fits.append(row)
+
+            fit = results[best]
+            for (size, n, value), residual, off_fit in zip(measured[["Dataset Size", "Sequences", metric]].values, fit["residuals"], fit["off_fit"]):
+                points.append({"Aligner": aligner, "Threads": threads, "Metric": metric, "Dataset Size": size,
+                               "Sequences": n, "Value": value, "Model": best, "Residual": residual,
+                               "Off Fit": bool(off_fit)})
+            # tiers that did not finish are past whatever regime was fitted
+            for size, n in group[status[group.index] != "ok"][["Dataset Size", "Sequences"]].values:
+                points.append({"Aligner": aligner, "Threads": threads, "Metric": metric, "Dataset Size": size,
+                               "Sequences": n, "Value": np.nan, "Model": best, "Residual": np.nan, "Off Fit": True})
+
+    return pd.DataFrame(fits), pd.DataFrame(points)
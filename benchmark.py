@@ -1,101 +1,426 @@
 import argparse
-from aligners import famsa, famsa_medoid, clustalo, mafft_parttree, kalign3, famsa_python, famsa_medoid_python
-from util import prepare_extHomFam_v2, parse_fasta, create_synthetic_dataset, dict_to_dataframe
+from aligners import famsa, famsa_medoid, clustalo, mafft_parttree, kalign3, famsa_python, famsa_medoid_python, famsa_add, mafft_add, mafft_addfragments
+from util import prepare_extHomFam_v2, parse_fasta, create_synthetic_dataset, create_stratified_datasets, compress_fasta, count_sequences, dict_to_dataframe, samples_to_dataframe, parse_thread_list, save_results
+from analysis import scaling_report, complexity_report
+from trials import run_cell
+from scheduler import CoreScheduler, available_cores, format_cores, load_memory_estimates
+from journal import Journal
+from scoring import load_references
+from validate import AlignmentValidator
+from sinks import OutputSink, SINK_MODES, TMPFS_DIR
+from results_store import ResultsStore, collect_metadata, compare_runs
+from job_queue import JobQueue, run_fingerprint
+from dedup import deduplicated
+from divide import divided, CLUSTER_SIZE
+from incremental import prepare_incremental, incremental_report
+from spans import span, configure as configure_spans, report as spans_report, format_report
+import contextlib
 import os
+import subprocess
+import sys
+import time
 import pandas as pd
 import tqdm
 import tempfile as tmp
 
 # Define arguments
 parser = argparse.ArgumentParser()
-parser.add_argument('--threads', type=int, help='Number of threads', required=True)
+parser.add_argument('--threads', type=str, help='Number of threads, or a sweep as a list and/or ranges, e.g. 1,2,4,8,16,32,64,128 or 1-8 or 8-128:8', required=True)
 parser.add_argument('--whole-extHomFam-v2', action='store_true', help='Use the whole extHomFam-v2 dataset')
 parser.add_argument('--no-python', action='store_true', help='Do not use the Python implementation of FAMSA and FAMSA-Medoid')
+parser.add_argument('--measure-tree', action='store_true', help='Also time pyfamsa Aligner.build_tree on its own after every pyfamsa run (Guide Tree (s)); not part of Time, but lengthens each trial')
+parser.add_argument('--sample-interval', type=int, default=None, help='Record a /proc memory and CPU time series of every aligner run, polled every SAMPLE_INTERVAL ms (e.g. 50-200)')
+parser.add_argument('--repeats', type=int, default=1, help='Measured trials per aligner x dataset x threads cell')
+parser.add_argument('--warmup', type=int, default=0, help='Unrecorded warm-up runs before the measured trials of each cell')
+parser.add_argument('--cv-threshold', type=float, default=0.05, help='Re-run a cell while the coefficient of variation of its time is above this')
+parser.add_argument('--max-repeats', type=int, default=None, help='Cap on trials per cell when re-running noisy cells (default: 3 x --repeats)')
+parser.add_argument('--synthetic-sizes', type=str, default=None, help='Synthetic tiers cut from extHomFam-v2 medium as name=count pairs (default: xsmall=50000,small=100000,medium=250000,large=500000)')
+parser.add_argument('--stratified', type=int, default=None, metavar='COUNT', help='Run on length-, family- and order-stratified datasets of COUNT sequences instead of the size tiers')
+parser.add_argument('--stratified-source', type=str, default='medium', choices=['medium', 'xlarge'], help='extHomFam-v2 tier the stratified datasets are drawn from')
+parser.add_argument('--stratified-families', type=str, default=None, help='Numbers of families of the stratified datasets (default: 10,100,1000)')
+parser.add_argument('--incremental', type=int, default=None, metavar='N', help='Benchmark adding sequences to an alignment of N sequences (FAMSA profile-profile, MAFFT --add/--addfragments) against re-aligning everything, instead of the size tiers')
+parser.add_argument('--add-sizes', type=str, default=None, help='Numbers of sequences added with --incremental (default: 100,1000,10000,50000)')
+parser.add_argument('--seed', type=int, default=0, help='Seed for sampling the synthetic tiers')
+parser.add_argument('--core-budget', type=int, default=None, help='Run jobs concurrently on disjoint CPU sets within this many cores (default: one job at a time)')
+parser.add_argument('--memory-budget', type=float, default=None, help='Memory budget in GB for concurrent jobs, with --core-budget')
+parser.add_argument('--memory-estimates', type=str, nargs='+', default=None, help='Earlier MSA-results CSVs used to estimate the peak RSS of each job, with --memory-budget')
+parser.add_argument('--resume', action='store_true', help='Resume an interrupted run from its journal: keep finished trials and cells, re-run failed and missing ones')
+parser.add_argument('--output-dir', type=str, default=None, help='Keep the alignments in this directory instead of a temporary one')
+parser.add_argument('--timeout', type=float, default=None, help='Wall-clock limit per aligner run in minutes; runs hitting it are recorded as DNF (timeout)')
+parser.add_argument('--memory-limit', type=float, default=None, help='Memory limit per aligner run in GB; runs hitting it are recorded as DNF (oom)')
+parser.add_argument('--cgroup', type=str, default=None, help='Delegated cgroup v2 directory to enforce --memory-limit as memory.max (default: RLIMIT_AS)')
+parser.add_argument('--references', type=str, default=None, help='Directory of reference alignments (one family per file) to compute SP and TC scores of every output against')
+parser.add_argument('--reference-pattern', type=str, default='*', help='Glob of the reference alignment files inside --references')
+parser.add_argument('--no-validate', action='store_true', help='Do not check that every output is a valid alignment of its input')
+parser.add_argument('--no-column-stats', action='store_true', help='Do not compute the column statistics (gap fraction, entropy, trimmed columns) of every output')
+parser.add_argument('--output-sink', type=str, choices=SINK_MODES, default='disk', help='Where the aligners write: disk (the output directory), tmpfs (RAM-backed, no storage latency) or discard (a pipe that only counts and hashes the bytes; no validation or scoring)')
+parser.add_argument('--tmpfs-dir', type=str, default=TMPFS_DIR, help='RAM-backed directory of the tmpfs output sink')
+parser.add_argument('--extrapolate', type=str, default=None, help='Sizes (number of sequences) to extrapolate the fitted time and peak RSS curves to, e.g. 1000000,5000000; the xlarge tier is added when it was built but not run')
+parser.add_argument('--queue', type=str, default=None, help='Put the grid in this SQLite job queue (on storage shared with the workers) for worker.py processes to run, wait for them and collect the results')
+parser.add_argument('--enqueue-only', action='store_true', help='With --queue, only enqueue the grid; re-run the same command later to collect')
+parser.add_argument('--db', type=str, default=None, help='Results database every run is stored in with its environment (default: MSAresults/MSA-results.sqlite)')
+parser.add_argument('--compare-to', type=str, default=None, help='Compare this run against a stored run: run id, baseline name or "latest"; see compare.py')
+parser.add_argument('--set-baseline', type=str, default=None, metavar='NAME', help='Store this run as baseline NAME')
+parser.add_argument('--dedup', action='store_true', help='Also run every aligner on one copy of each distinct sequence, re-expanding its alignment afterwards (<aligner>-dedup rows, end to end)')
+parser.add_argument('--divide', action='store_true', help='Also run FAMSA and Kalign3 by divide and conquer: k-mer sketch clusters aligned separately, merged by profile-profile alignment (<aligner>-divide rows)')
+parser.add_argument('--cluster-size', type=int, default=CLUSTER_SIZE, help='Target number of sequences per cluster with --divide')
+parser.add_argument('--divide-workers', type=int, default=4, help='Clusters aligned at the same time with --divide; each gets threads / DIVIDE_WORKERS threads')
+parser.add_argument('--cluster-memory-limit', type=float, default=None, help='Memory limit per cluster alignment in GB with --divide (default: --memory-limit)')
+parser.add_argument('--profile-spans', type=str, default=None, help='Capture these instrumentation spans with cProfile, e.g. create_synthetic_dataset,parse_fasta; see MSA-spans_<run>.csv for the span names')
+parser.add_argument('--compressed-input', action='store_true', help='Also run FAMSA and pyfamsa on a gzip copy of every dataset, to compare reading compressed and plain input')
 args = parser.parse_args()
 
 result_dict = {}
-args.threads = str(args.threads)
+trial_samples = []
+trial_options = {
+        "trial_samples": trial_samples,
+        "repeats": args.repeats,
+        "warmup": args.warmup,
+        "cv_threshold": args.cv_threshold,
+        "max_repeats": args.max_repeats,
+}
+thread_list = parse_thread_list(args.threads)
+threads_label = f"{thread_list[0]}" if len(thread_list) == 1 else f"{thread_list[0]}-{thread_list[-1]}"
+
+folder_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "MSAresults")
+run_name = f"{threads_label}_whole" if args.whole_extHomFam_v2 else f"{threads_label}_synthetic"
+if args.stratified:
+        run_name = f"{threads_label}_stratified"
+if args.incremental:
+        run_name = f"{threads_label}_incremental"
+
+# Python-side phases (dataset preparation, parsing, validation, ...) are timed as nested spans
+configure_spans(profile=args.profile_spans.split(",") if args.profile_spans else (), profile_dir=f"{folder_path}/profiles_{run_name}")
+
+run_options = {}
+if args.sample_interval:
+        run_options["sample_interval"] = args.sample_interval / 1000
+        run_options["timeseries_dir"] = f"{folder_path}/timeseries_{run_name}"
+
+# Limits for the external aligners; ClustalO and MAFFT-PartTree only run under a limit
+if args.timeout:
+        run_options["timeout"] = args.timeout * 60
+if args.memory_limit:
+        run_options["memory_limit_mb"] = args.memory_limit * 1024
+        run_options["cgroup_parent"] = args.cgroup
+with_limits = bool(args.timeout or args.memory_limit)
+if not with_limits:
+        print("Skipping ClustalO and MAFFT-PartTree: set --timeout and/or --memory-limit to include them")
+
+# Reference alignments for the SP/TC accuracy scores
+references = None
+if args.references:
+        references = load_references(args.references, args.reference_pattern)
+        print(f"Loaded {len(references)} reference alignments from {args.references}")
+
+# Where the alignments go; the discard sink keeps nothing to validate or score
+sink = OutputSink(args.output_sink, args.tmpfs_dir)
+if not sink.keeps_output and (references is not None or not args.no_validate):
+        print("Output sink discard keeps no alignments: skipping validation and SP/TC scoring")
+validator = None if args.no_validate or not sink.keeps_output else AlignmentValidator()
+
+# Every finished trial and cell is journaled immediately, so a crashed run can be resumed
+journal = Journal(f"{folder_path}/MSA-journal_{run_name}.jsonl", resume=args.resume)
+if args.resume:
+        print(f"Resuming: {len(journal.cells)} cells finished, {len(journal.failed)} failed")
 
 # Prepare extHomFam-v2 dataset
 extHomFam_v2 = prepare_extHomFam_v2(all=args.whole_extHomFam_v2)
 
-# Take the xlarge dataset and randomly take without replacing 100,000 (small), 250,000 (medium), 500,000 (large) sequences
-mini_extHomFam_v2 = create_synthetic_dataset(extHomFam_v2)
+# Take the medium dataset and randomly take without replacing 50,000 (xsmall), 100,000 (small), 250,000 (medium), 500,000 (large) sequences
+synthetic_sizes = None
+if args.synthetic_sizes:
+        synthetic_sizes = {name: int(count) for name, count in (pair.split("=") for pair in args.synthetic_sizes.split(","))}
+mini_extHomFam_v2 = create_synthetic_dataset(extHomFam_v2, sizes=synthetic_sizes, seed=args.seed)
 
 dataset_for_use = extHomFam_v2 if args.whole_extHomFam_v2 else mini_extHomFam_v2
 
+# Same number of sequences, different length distributions, family counts and input orders
+if args.stratified:
+        source = extHomFam_v2.get(args.stratified_source) or prepare_extHomFam_v2(tiers=[args.stratified_source])[args.stratified_source]
+        family_counts = [int(count) for count in args.stratified_families.split(",")] if args.stratified_families else None
+        dataset_for_use = create_stratified_datasets(source, count=args.stratified, seed=args.seed, family_counts=family_counts)
+
+# Base alignment plus batches of new sequences; each batch is also aligned from scratch with the base
+if args.incremental:
+        add_sizes = [int(size) for size in args.add_sizes.split(",")] if args.add_sizes else None
+        incremental = prepare_incremental(extHomFam_v2["medium"], args.incremental, add_sizes, seed=args.seed, threads=max(thread_list))
+        dataset_for_use = {label: batch["full"] for label, batch in incremental["batches"].items()}
+
+# Only FAMSA and pyfamsa read gzip input; the other aligners need plain fasta
+compressed_aligners = {"famsa", "famsa-medoid", "famsa-python", "famsa-medoid-python"}
+if args.compressed_input:
+        dataset_for_use = dict(dataset_for_use)
+        for sizes in list(dataset_for_use.keys()):
+                dataset_for_use[f"{sizes}.gz"] = compress_fasta(dataset_for_use[sizes], "gzip")
+
+# Number of sequences of every tier, for the complexity fits
+sequences = {sizes: count_sequences(file_name) for sizes, file_name in dataset_for_use.items() if not sizes.endswith(".gz")}
+
+# Host, CPU, kernel, tool versions and dataset hashes, stored with the results
+with span("collect_metadata"):
+        metadata = collect_metadata(dataset_for_use, vars(args))
+
 #Prepare save path
 print(f"Skipping Python implementation of FAMSA and FAMSA-Medoid: {args.no_python}") if args.no_python else print("Using Python implementation of FAMSA and FAMSA-Medoid")
-with tmp.TemporaryDirectory() as tmpdirname:
-        print(f"Created temporary directory: {tmpdirname}")
+output_dir = contextlib.nullcontext(args.output_dir) if args.output_dir else tmp.TemporaryDirectory()
+with output_dir as tmpdirname, span("benchmark grid"):
+        if args.output_dir:
+                os.makedirs(tmpdirname, exist_ok=True)
+                print(f"Writing alignments to: {tmpdirname}")
+        else:
+                print(f"Created temporary directory: {tmpdirname}")
         save_path = tmpdirname
-        # Benchmarking
-        pbar = tqdm.tqdm(total=len(dataset_for_use.keys()))
+
+        # Build the aligner x dataset size x threads grid
+        python_options = {"measure_tree": True} if args.measure_tree else {}
+        jobs = []
         for sizes in list(dataset_for_use.keys()):
                 file_name = dataset_for_use[sizes]
                 clean_file_name = file_name.split("/")[-1].split(".")[0]
-                print(f"File name: {file_name}")
-
-                print(f"=================ALIGNING {sizes.upper()}=================")
-                famsa(input_file=f"{file_name}", 
-                        output_file=f"{save_path}/{clean_file_name}-FAMSA.fasta", 
-                        threads=args.threads,
-                        dataset_size=sizes,
-                        result_dict=result_dict)
-                print(f"Complete FAMSA")
-                
-                famsa_medoid(input_file=f"{file_name}",
-                        output_file=f"{save_path}/{clean_file_name}-FAMSA-medoid.fasta",
-                        threads=args.threads,
-                        dataset_size=sizes,
-                        result_dict=result_dict)
-                print(f"Complete FAMSA-Medoid")
-
-                if not args.no_python:
-                        famsa_python(input_file=f"{file_name}",
-                                output_file=f"{save_path}/{clean_file_name}-FAMSA-python.fasta",
-                                threads=1,
-                                dataset_size=sizes,
-                                result_dict=result_dict)
-                        print(f"Complete FAMSA-Python")
-                
-                        famsa_medoid_python(input_file=f"{file_name}",
-                                output_file=f"{save_path}/{clean_file_name}-FAMSA-medoid-python.fasta",
-                                threads=1,
-                                dataset_size=sizes,
-                                result_dict=result_dict)
-                        print(f"Complete FAMSA-Medoid-Python")
-                
-                # #CLUSTALO # takes long time
-                # clustalo(input_file=f"{file_name}",
-                #         output_file=f"{save_path}/{clean_file_name}-CLUSTALO.fasta",
-                #         threads=args.threads,
-                #         dataset_size=sizes,
-                #         result_dict=result_dict)
-                # print(f"Complete CLUSTALO")
-                
-                # # MAFFT-PartTree # uses too much memory
-                # mafft_parttree(input_file=f"{file_name}",
-                #         output_file=f"{save_path}/{clean_file_name}-MAFFT.fasta",
-                #         threads=args.threads,
-                #         dataset_size=sizes,
-                #         result_dict=result_dict)
-                # print(f"Complete MAFFT-PartTree")
-                
-                kalign3(input_file=f"{file_name}",
-                        output_file=f"{save_path}/{clean_file_name}-KALIGN3.fasta",
-                        threads=args.threads,
-                        dataset_size=sizes,
-                        result_dict=result_dict)
-                print(f"Complete KALIGN3")
-                
+
+                for threads in thread_list:
+                        jobs.append(dict(aligner="famsa", label="FAMSA", fn=famsa, input_file=file_name,
+                                output_file=f"{save_path}/{clean_file_name}-FAMSA-t{threads}.fasta",
+                                threads=str(threads), dataset_size=sizes))
+
+                        jobs.append(dict(aligner="famsa-medoid", label="FAMSA-Medoid", fn=famsa_medoid, input_file=file_name,
+                                output_file=f"{save_path}/{clean_file_name}-FAMSA-medoid-t{threads}.fasta",
+                                threads=str(threads), dataset_size=sizes))
+
+                        # the in-process pyfamsa path runs alone, since it is measured on this process
+                        if not args.no_python:
+                                jobs.append(dict(aligner="famsa-python", label="FAMSA-Python", fn=famsa_python, input_file=file_name,
+                                        output_file=f"{save_path}/{clean_file_name}-FAMSA-python-t{threads}.fasta",
+                                        threads=str(threads), dataset_size=sizes, exclusive=True, fn_options=python_options))
+
+                                jobs.append(dict(aligner="famsa-medoid-python", label="FAMSA-Medoid-Python", fn=famsa_medoid_python, input_file=file_name,
+                                        output_file=f"{save_path}/{clean_file_name}-FAMSA-medoid-python-t{threads}.fasta",
+                                        threads=str(threads), dataset_size=sizes, exclusive=True, fn_options=python_options))
+
+                        # CLUSTALO takes long time, MAFFT-PartTree uses too much memory
+                        if with_limits:
+                                jobs.append(dict(aligner="clustalo", label="CLUSTALO", fn=clustalo, input_file=file_name,
+                                        output_file=f"{save_path}/{clean_file_name}-CLUSTALO-t{threads}.fasta",
+                                        threads=str(threads), dataset_size=sizes))
+
+                                jobs.append(dict(aligner="mafft-parttree", label="MAFFT-PartTree", fn=mafft_parttree, input_file=file_name,
+                                        output_file=f"{save_path}/{clean_file_name}-MAFFT-t{threads}.fasta",
+                                        threads=str(threads), dataset_size=sizes))
+
+                        jobs.append(dict(aligner="kalign3", label="KALIGN3", fn=kalign3, input_file=file_name,
+                                output_file=f"{save_path}/{clean_file_name}-KALIGN3-t{threads}.fasta",
+                                threads=str(threads), dataset_size=sizes))
+
+        if args.incremental:
+                jobs = []
+                add_options = {"base_alignment": incremental["base_alignment"]}
+                for label, batch in incremental["batches"].items():
+                        for threads in thread_list:
+                                jobs.append(dict(aligner="famsa-add", label="FAMSA-Add", fn=famsa_add, input_file=batch["batch"],
+                                        expected_input=batch["full"], fn_options=add_options,
+                                        output_file=f"{save_path}/incremental-{label}-FAMSA-add-t{threads}.fasta",
+                                        threads=str(threads), dataset_size=label))
+                                jobs.append(dict(aligner="famsa", label="FAMSA", fn=famsa, input_file=batch["full"],
+                                        output_file=f"{save_path}/incremental-{label}-FAMSA-t{threads}.fasta",
+                                        threads=str(threads), dataset_size=label))
+                                if with_limits:
+                                        jobs.append(dict(aligner="mafft-add", label="MAFFT-Add", fn=mafft_add, input_file=batch["batch"],
+                                                expected_input=batch["full"], fn_options=add_options,
+                                                output_file=f"{save_path}/incremental-{label}-MAFFT-add-t{threads}.fasta",
+                                                threads=str(threads), dataset_size=label))
+                                        jobs.append(dict(aligner="mafft-addfragments", label="MAFFT-AddFragments", fn=mafft_addfragments, input_file=batch["batch"],
+                                                expected_input=batch["full"], fn_options=add_options,
+                                                output_file=f"{save_path}/incremental-{label}-MAFFT-addfragments-t{threads}.fasta",
+                                                threads=str(threads), dataset_size=label))
+                                        jobs.append(dict(aligner="mafft-parttree", label="MAFFT-PartTree", fn=mafft_parttree, input_file=batch["full"],
+                                                output_file=f"{save_path}/incremental-{label}-MAFFT-t{threads}.fasta",
+                                                threads=str(threads), dataset_size=label))
+
+        if args.compressed_input:
+                jobs = [job for job in jobs if not job["dataset_size"].endswith(".gz") or job["aligner"] in compressed_aligners]
+                for job in jobs:
+                        if job["dataset_size"].endswith(".gz"):
+                                job["output_file"] = job["output_file"].replace(".fasta", "-gz-input.fasta")
+
+        # FAMSA and Kalign3 by divide and conquer, on plain inputs (clusters are cut through the index)
+        if args.divide:
+                divide_options = {"cluster_size": args.cluster_size, "workers": args.divide_workers, "seed": args.seed}
+                if args.cluster_memory_limit:
+                        divide_options["cluster_memory_mb"] = args.cluster_memory_limit * 1024
+                jobs += [dict(job, aligner=f"{job['aligner']}-divide", label=f"{job['label']}-Divide", fn=divided(job["fn"]), fn_options=divide_options,
+                              output_file=job["output_file"].replace(".fasta", "-divide.fasta"), base_aligner=job["aligner"], divide=True)
+                         for job in jobs if job["aligner"] in ("famsa", "kalign3") and "fn_options" not in job and not job["input_file"].endswith(".gz")]
+
+        # the same jobs through the deduplication stage
+        if args.dedup:
+                jobs += [dict(job, aligner=f"{job['aligner']}-dedup", label=f"{job['label']}+dedup", fn=deduplicated(job["fn"]),
+                              output_file=job["output_file"].replace(".fasta", "-dedup.fasta"), base_aligner=job.get("base_aligner", job["aligner"]), dedup=True)
+                         for job in jobs]
+
+        def run_job(job, affinity=None):
+                cell = (job["aligner"], job["dataset_size"], job["threads"])
+                previous = journal.completed_trials(*cell)
+                summary = journal.completed_cell(*cell)
+                if summary is not None:
+                        for trial, row in enumerate(previous):
+                                trial_samples.append((job["aligner"], job["dataset_size"], trial, row))
+                        return save_results(result_dict, job["aligner"], summary, job["dataset_size"], job["threads"])
+
+                options = dict(run_options)
+                if affinity is not None and not job.get("exclusive"):
+                        options["affinity"] = affinity
+                try:
+                        with span("cell"):
+                                return run_cell(job, result_dict, sink=sink, validator=validator, references=references,
+                                        column_stats=not args.no_column_stats, previous=previous,
+                                        on_trial=lambda trial, row: journal.record_trial(*cell, trial, row),
+                                        **trial_options,
+                                        **options)
+                except subprocess.CalledProcessError as e:
+                        journal.record_failure(*cell, e)
+                        return None
+                except (OSError, ValueError, EOFError) as e:
+                        # a missing binary or an unreadable input or output fails the cell, not the grid
+                        journal.record_failure(*cell, f"{type(e).__name__}: {e}")
+                        return None
+
+        def job_done(job, row):
+                if row is None:
+                        print(f"FAILED {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads), see {journal.path}")
+                else:
+                        journal.record_cell(job["aligner"], job["dataset_size"], job["threads"], row)
+                        if row.get("status", "ok") != "ok":
+                                print(f"DNF ({row['status']}) {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads)")
+                                pbar.update(1)
+                                return
+                        print(f"Complete {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads)")
                 pbar.update(1)
-                print(f"Aligned {sizes.upper()}")
+
+        # Benchmarking
+        pbar = tqdm.tqdm(total=len(jobs))
+        if args.queue:
+                queue = JobQueue(args.queue)
+                queue_config = {
+                        "run_options": run_options,
+                        "trial_options": {key: value for key, value in trial_options.items() if key != "trial_samples"},
+                        "output_sink": args.output_sink,
+                        "tmpfs_dir": args.tmpfs_dir,
+                        "output_dir": args.output_dir,
+                        "validate": not args.no_validate,
+                        "column_stats": not args.no_column_stats,
+                        "references": args.references,
+                        "reference_pattern": args.reference_pattern,
+                }
+                queue.set_config(queue_config)
+                # jobs of an earlier run with other options or datasets are dropped, not collected
+                run = run_fingerprint(queue_config, metadata["datasets"])
+                # workers write the alignments to their own output directory
+                added = queue.enqueue([dict({key: value for key, value in job.items() if key != "fn"}, output_file=os.path.basename(job["output_file"]))
+                                       for job in jobs], run=run)
+                print(f"Queued {added} jobs in {args.queue} ({len(jobs) - added} were already queued), run them with: python3 worker.py {args.queue}")
+                if args.enqueue_only:
+                        pbar.close()
+                        sink.close()
+                        sys.exit(0)
+
+                counts = queue.counts()
+                while counts["pending"] + counts["running"]:
+                        pbar.set_postfix(counts)
+                        time.sleep(10)
+                        counts = queue.counts()
+
+                queued_jobs = {JobQueue.key(dict(job, run=run)): job for job in jobs}
+                for queued in queue.jobs():
+                        job = queued_jobs.get(JobQueue.key(queued["spec"]))
+                        if job is None:
+                                continue
+                        if queued["status"] == "done":
+                                for trial, row in queued["result"]["trials"]:
+                                        trial_samples.append((job["aligner"], job["dataset_size"], trial, row))
+                                job_done(job, save_results(result_dict, job["aligner"], queued["result"]["row"], job["dataset_size"], job["threads"]))
+                        else:
+                                journal.record_failure(job["aligner"], job["dataset_size"], job["threads"], queued["error"])
+                                job_done(job, None)
+                queue.close()
+        elif args.core_budget:
+                memory_estimates = load_memory_estimates(args.memory_estimates) if args.memory_estimates else None
+                memory_budget_mb = args.memory_budget * 1024 if args.memory_budget else None
+                scheduler = CoreScheduler(available_cores(args.core_budget), memory_budget_mb, memory_estimates)
+                print(f"Scheduling {len(jobs)} jobs on CPUs {format_cores(scheduler.cores)}")
+                scheduler.run(jobs, run_job, on_done=job_done)
+        else:
+                for job in jobs:
+                        job_done(job, run_job(job))
         pbar.close()
 
+sink.close()
+journal.close()
+if journal.failed:
+        print(f"WARNING: {len(journal.failed)} cells failed, re-run them with --resume:")
+        for (aligner, dataset_size, threads), error in journal.failed.items():
+                print(f"  {aligner} {dataset_size} {threads} threads: {error}")
+
 df = dict_to_dataframe(result_dict)
-folder_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "MSAresults")
 os.makedirs(folder_path, exist_ok=True)
 
-if args.whole_extHomFam_v2: df.to_csv(f"{folder_path}/MSA-results_{args.threads}_whole.csv")
-else: df.to_csv(f"{folder_path}/MSA-results_{args.threads}_synthetic.csv")
+df.to_csv(f"{folder_path}/MSA-results_{run_name}.csv")
+samples_to_dataframe(trial_samples).to_csv(f"{folder_path}/MSA-trials_{run_name}.csv", index=False)
+
+unstable = df[df["Unstable"]] if "Unstable" in df.columns else df.iloc[0:0]
+if len(unstable):
+        print(f"WARNING: {len(unstable)} cells still have a time CV above {args.cv_threshold} after re-runs:")
+        print(unstable[["Aligner", "Dataset Size", "Threads", "Time", "Time CV", "Trials"]].to_string(index=False))
+
+if len(thread_list) > 1:
+        scaling = scaling_report(df)
+        scaling.to_csv(f"{folder_path}/MSA-scaling_{run_name}.csv", index=False)
+        print(scaling.to_string(index=False))
+
+if args.incremental:
+        crossover = incremental_report(df, {label: batch["batch_size"] for label, batch in incremental["batches"].items()})
+        if len(crossover):
+                crossover.to_csv(f"{folder_path}/MSA-incremental_{run_name}.csv", index=False)
+                print(crossover.to_string(index=False))
+
+# Fit time(N) and peak RSS(N) over the tiers and extrapolate them
+targets = [int(target) for target in args.extrapolate.split(",")] if args.extrapolate else []
+xlarge = f"{os.path.dirname(folder_path)}/extHomFam-v2-xlarge.fasta"
+if "xlarge" not in dataset_for_use and os.path.exists(xlarge):
+        targets.append(count_sequences(xlarge))
+fits, points = complexity_report(df, sequences, sorted(set(targets)))
+if len(fits):
+        fits.to_csv(f"{folder_path}/MSA-complexity_{run_name}.csv", index=False)
+        points.to_csv(f"{folder_path}/MSA-complexity-points_{run_name}.csv", index=False)
+        best = fits[fits["Best"]]
+        print(best[["Aligner", "Threads", "Metric", "Model", "Coefficient", "Exponent", "Exponent SE"]
+                   + [column for column in best.columns if column.startswith("Predicted ")]].to_string(index=False))
+        off_fit = points[points["Off Fit"]]
+        if len(off_fit):
+                print(f"WARNING: {len(off_fit)} tiers left the fitted regime:")
+                print(off_fit[["Aligner", "Threads", "Metric", "Dataset Size", "Sequences", "Residual"]].to_string(index=False))
+
+# Store the run and look for regressions against an earlier one
+store = ResultsStore(args.db or f"{folder_path}/MSA-results.sqlite")
+if args.compare_to:
+        baseline = store.resolve(args.compare_to)
+run_id = store.add_run(run_name, result_dict, trial_samples, metadata)
+print(f"Stored run {run_id} in {store.path}")
+if args.set_baseline:
+        store.set_baseline(args.set_baseline, run_id)
+        print(f"Baseline {args.set_baseline} is run {run_id}")
+if args.compare_to:
+        comparison = compare_runs(store, baseline, run_id)
+        comparison.to_csv(f"{folder_path}/MSA-comparison_{run_name}.csv", index=False)
+        regressions = comparison[comparison["Regression"]] if len(comparison) else comparison
+        if len(regressions):
+                print(f"WARNING: {len(regressions)} cells regressed against run {baseline}:")
+                print(regressions[["Aligner", "Dataset Size", "Threads", "Time Change", "Peak RSS (MB) Change", "Status"]].to_string(index=False))
+        else:
+                print(f"No regressions against run {baseline}")
+store.close()
+
+# Where the Python side of the run spent its time
+spans = spans_report()
+spans.to_csv(f"{folder_path}/MSA-spans_{run_name}.csv", index=False)
+print(format_report(spans))
@@ -0,0 +1,149 @@
+import os
+import numpy as np
+from scoring import GAPS
+from util import iter_fasta, open_fasta_write, COPY_BUFFER
+
+# matrix cells processed per chunk of rows; counting takes about 8 bytes per cell
+CHUNK_CELLS = 1 << 22
+# residue letters column frequencies are reported for
+ALPHABET = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWYBJOUXZ", dtype=np.uint8)
+# minimum fraction of rows with a residue for a column to be kept by trimming
+MIN_OCCUPANCY = 0.5
+
+
+def alignment_to_memmap(alignment_file, matrix_file=None, rebuild=False):
+    """
+        Convert an aligned fasta file (plain or gzip) into a memory-mapped N x L uint8 matrix.
+
+        Rows are streamed into {alignment_file}.u8 (or matrix_file), upper-cased, with "." read as a
+        gap; the names go to a sidecar {matrix_file}.idx.npz together with the shape. Both are
+        rebuilt when the alignment's size or mtime changes.
+
+        output: (names, matrix) with names a numpy bytes array and matrix a read-only np.memmap
+    """
+    matrix_file = matrix_file or f"{alignment_file}.u8"
+    index_file = f"{matrix_file}.idx.npz"
+    stat = os.stat(alignment_file)
+    if not rebuild and os.path.exists(matrix_file) and os.path.exists(index_file):
+        with np.load(index_file) as index:
+            if int(index["source_size"]) == stat.st_size and int(index["source_mtime_ns"]) == stat.st_mtime_ns:
+                return index["names"], _open_matrix(matrix_file, tuple(index["shape"]))
+
+    names = []
+    width = None
+    with open(matrix_file, "wb", buffering=COPY_BUFFER) as out:
+        for name, row in iter_fasta(alignment_file):
+            if width is None:
+                width = len(row)
+            elif len(row) != width:
+                raise ValueError(f"{alignment_file}: row {name.decode(errors='replace')} has {len(row)} columns, expected {width}")
+            out.write(row.upper().replace(b".", b"-"))
+            names.append(name)
+
+    shape = (len(names), width or 0)
+    np.savez(index_file, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns,
+             shape=np.array(shape, dtype=np.int64), names=np.array(names, dtype=bytes))
+    return np.array(names, dtype=bytes), _open_matrix(matrix_file, shape)
+
+
+def _open_matrix(matrix_file, shape):
+    # np.memmap refuses empty files
+    if shape[0] * shape[1] == 0:
+        return np.zeros(shape, dtype=np.uint8)
+    return np.memmap(matrix_file, dtype=np.uint8, mode="r", shape=shape)
+
+
+def _row_chunks(matrix, chunk_cells=CHUNK_CELLS):
+    rows = max(1, chunk_cells // max(1, matrix.shape[1]))
+    for start in range(0, matrix.shape[0], rows):
+        yield start, np.asarray(matrix[start:start + rows])
+
+
+def column_counts(matrix, chunk_cells=CHUNK_CELLS):
+    """
+        Count of every byte value in every column, accumulated over chunks of rows.
+
+        output: L x 256 int64 array
+    """
+    width = matrix.shape[1]
+    counts = np.zeros(width * 256, dtype=np.int64)
+    offsets = np.arange(width, dtype=np.int64) * 256
+    for _, chunk in _row_chunks(matrix, chunk_cells):
+        counts += np.bincount((chunk + offsets).ravel(), minlength=width * 256)
+    return counts.reshape(width, 256)
+
+
+def column_statistics(matrix, chunk_cells=CHUNK_CELLS, min_occupancy=MIN_OCCUPANCY):
+    """
+        Per-column statistics of an alignment matrix, in one chunked pass over its rows.
+
+        output: dict of numpy arrays over the L columns
+            gap_fraction: rows with a gap
+            occupancy: rows with a residue (1 - gap_fraction)
+            frequencies: L x len(ALPHABET), residue frequencies among the residues of the column
+            entropy: Shannon entropy (bits) of the residue frequencies, 0 for columns without residues
+            keep: columns with occupancy >= min_occupancy, those kept by trim_alignment
+    """
+    counts = column_counts(matrix, chunk_cells)
+    rows = max(1, matrix.shape[0])
+    gap_fraction = counts[:, GAPS].sum(axis=1) / rows
+    residues = counts[:, ALPHABET]
+    totals = residues.sum(axis=1, keepdims=True)
+    frequencies = np.divide(residues, totals, out=np.zeros(residues.shape), where=totals > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = 0.0 - np.sum(np.where(frequencies > 0, frequencies * np.log2(frequencies), 0.0), axis=1)
+    occupancy = 1 - gap_fraction
+    return {
+        "gap_fraction": gap_fraction,
+        "occupancy": occupancy,
+        "frequencies": frequencies,
+        "entropy": entropy,
+        "keep": occupancy >= min_occupancy,
+    }
+
+
+def trim_alignment(names, matrix, output_file, min_occupancy=MIN_OCCUPANCY, chunk_cells=CHUNK_CELLS):
+    """
+        Write the alignment without the columns of occupancy below min_occupancy (gzip by the
+        file extension), chunk by chunk.
+
+        output: number of columns kept
+    """
+    keep = column_statistics(matrix, chunk_cells, min_occupancy)["keep"]
+    with open_fasta_write(output_file) as out:
+        for start, chunk in _row_chunks(matrix, chunk_cells):
+            trimmed = np.ascontiguousarray(chunk[:, keep])
+            out.writelines(b">%s\n%s\n" % (names[start + i], trimmed[i].tobytes()) for i in range(len(trimmed)))
+    return int(keep.sum())
+
+
+def alignment_statistics(alignment_file, min_occupancy=MIN_OCCUPANCY, keep_matrix=False):
+    """
+        Summary of the column statistics of an aligner output, for the results table.
+
+        The matrix is written next to the alignment and removed afterwards unless keep_matrix.
+
+        output: dict with
+            aln_columns: columns of the alignment
+            gap_fraction: gap cells / all cells
+            mean_entropy: mean Shannon entropy (bits) of the columns with residues
+            trimmed_columns: columns kept at min_occupancy
+    """
+    matrix_file = f"{alignment_file}.u8"
+    try:
+        _, matrix = alignment_to_memmap(alignment_file, matrix_file)
+        stats = column_statistics(matrix, min_occupancy=min_occupancy)
+        del matrix
+    finally:
+        if not keep_matrix:
+            for path in (matrix_file, f"{matrix_file}.idx.npz"):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    occupied = stats["occupancy"] > 0
+    return {
+        "aln_columns": len(stats["gap_fraction"]),
+        "gap_fraction": float(stats["gap_fraction"].mean()) if len(stats["gap_fraction"]) else np.nan,
+        "mean_entropy": float(stats["entropy"][occupied].mean()) if occupied.any() else np.nan,
+        "trimmed_columns": int(stats["keep"].sum()),
+    }
@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+from results_store import ResultsStore, compare_runs
+
+folder_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "MSAresults")
+
+# Define arguments
+parser = argparse.ArgumentParser(description='Compare two stored benchmark runs and flag slowdowns and memory growth')
+parser.add_argument('baseline', type=str, nargs='?', default='previous', help='Run id, baseline name, "latest" or "previous" (default: previous)')
+parser.add_argument('candidate', type=str, nargs='?', default='latest', help='Run id, baseline name, "latest" or "previous" (default: latest)')
+parser.add_argument('--db', type=str, default=f"{folder_path}/MSA-results.sqlite", help='Results database written by benchmark.py')
+parser.add_argument('--alpha', type=float, default=0.05, help='Significance level of the one-sided permutation test')
+parser.add_argument('--min-change', type=float, default=0.05, help='Smallest relative growth of the median flagged as a regression')
+parser.add_argument('--output', type=str, default=None, help='Also write the comparison to this CSV')
+parser.add_argument('--list', action='store_true', help='List the stored runs and exit')
+parser.add_argument('--set-baseline', type=str, default=None, metavar='NAME', help='Store the candidate run as baseline NAME and exit')
+args = parser.parse_args()
+
+store = ResultsStore(args.db)
+if args.list:
+        print(store.runs().to_string(index=False))
+        sys.exit(0)
+if args.set_baseline:
+        run_id = store.set_baseline(args.set_baseline, args.candidate)
+        print(f"Baseline {args.set_baseline} is run {run_id}")
+        sys.exit(0)
+
+baseline, candidate = store.resolve(args.baseline), store.resolve(args.candidate)
+print(f"Comparing run {candidate} against run {baseline}")
+before, after = store.metadata(baseline), store.metadata(candidate)
+for key in ["host", "cpu_model", "kernel", "tools", "datasets"]:
+        if before.get(key) != after.get(key):
+                print(f"  {key} changed: {before.get(key)} -> {after.get(key)}")
+
+comparison = compare_runs(store, baseline, candidate, alpha=args.alpha, min_change=args.min_change)
+if args.output:
+        comparison.to_csv(args.output, index=False)
+if comparison.empty:
+        print("No cells in common")
+        sys.exit(0)
+
+print(comparison.to_string(index=False))
+regressions = comparison[comparison["Regression"]]
+if len(regressions):
+        print(f"REGRESSION in {len(regressions)} cells:")
+        print(regressions[["Aligner", "Dataset Size", "Threads", "Slowdown", "Memory Growth", "Status"]].to_string(index=False))
+        sys.exit(1)
+print("No regressions")
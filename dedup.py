@@ -0,0 +1,112 @@
+import hashlib
+import os
+import time
+from resources import measure_self
+from util import iter_fasta, open_fasta_write, save_results
+
+
+def _token(name):
+    # aligners may cut names at the first whitespace
+    return name.split(None, 1)[0] if name.strip() else name
+
+
+def deduplicate_fasta(input_file, output_file, map_file):
+    """
+        Keep the first copy of every distinct sequence, in one streaming pass.
+
+        Sequences are compared through a 16-byte blake2b digest of their exact bytes, so memory grows
+        with the number of distinct sequences only. map_file lists "representative<TAB>duplicate"
+        names, one line per dropped record.
+
+        output: dict with sequences (records read) and unique_sequences (records written)
+    """
+    # digest -> name of the first record with that sequence
+    representatives = {}
+    records = unique = 0
+    with open_fasta_write(output_file) as out, open(map_file, "wb") as duplicates:
+        for name, seq in iter_fasta(input_file, full_name=True):
+            records += 1
+            digest = hashlib.blake2b(seq, digest_size=16).digest()
+            if digest in representatives:
+                duplicates.write(b"%s\t%s\n" % (representatives[digest], name))
+                continue
+            representatives[digest] = _token(name)
+            unique += 1
+            out.write(b">%s\n%s\n" % (name, seq))
+    return {"sequences": records, "unique_sequences": unique}
+
+
+def expand_alignment(aligned_file, map_file, output_file):
+    """
+        Re-insert the dropped duplicates into an alignment of the representatives, each as a copy of
+        its representative's aligned row, right after it.
+
+        output: number of records written
+    """
+    duplicates = {}
+    with open(map_file, "rb") as f:
+        for line in f:
+            representative, duplicate = line.rstrip(b"\n").split(b"\t", 1)
+            duplicates.setdefault(representative, []).append(duplicate)
+
+    written = 0
+    with open_fasta_write(output_file) as out:
+        for name, row in iter_fasta(aligned_file, full_name=True):
+            out.write(b">%s\n%s\n" % (name, row))
+            written += 1
+            for duplicate in duplicates.get(_token(name), ()):
+                out.write(b">%s\n%s\n" % (duplicate, row))
+                written += 1
+    return written
+
+
+def deduplicated(aligner_fn, suffix="-dedup"):
+    """
+        An aligners.py wrapper that aligns only one copy of every distinct sequence.
+
+        Every call deduplicates the input, runs aligner_fn on the representatives and expands its
+        alignment into output_file, so the stored row (under {aligner}{suffix}) is end to end: time
+        includes dedup_time and expand_time (seconds), and the peak RSS is the larger of the aligner's
+        and dedup_rss_mb, what this process grew by during either stage (the harness itself is not
+        counted). It also holds unique_sequences and dedup_ratio (input sequences / unique sequences).
+    """
+    def run(input_file, output_file, threads, dataset_size, result_dict, **run_options):
+        unique_file = f"{output_file}.unique.fasta"
+        aligned_file = f"{output_file}.unique-aligned.fasta"
+        map_file = f"{output_file}.duplicates.tsv"
+        try:
+            with measure_self() as dedup_usage:
+                start = time.perf_counter()
+                counts = deduplicate_fasta(input_file, unique_file, map_file)
+                dedup_time = time.perf_counter() - start
+
+            # the aligner's time series goes under the -dedup name, next to the plain aligner's
+            name = getattr(aligner_fn, "__name__", "aligner").replace("_", "-")
+            scratch = {}
+            row = dict(aligner_fn(unique_file, aligned_file, threads, dataset_size, scratch,
+                                  **dict(run_options, timeseries_name=f"{name}{suffix}")))
+            (aligner, _), = scratch.items()
+
+            stage_rss = dedup_usage["peak_rss_mb"] - dedup_usage["start_rss_mb"]
+            expand_time = 0.0
+            if row.get("status", "ok") == "ok":
+                with measure_self() as expand_usage:
+                    start = time.perf_counter()
+                    expand_alignment(aligned_file, map_file, output_file)
+                    expand_time = time.perf_counter() - start
+                stage_rss = max(stage_rss, expand_usage["peak_rss_mb"] - expand_usage["start_rss_mb"])
+            row["dedup_rss_mb"] = max(stage_rss, 0.0)
+            row["peak_rss_mb"] = max(row["peak_rss_mb"], row["dedup_rss_mb"])
+        finally:
+            for scratch_file in (unique_file, aligned_file, map_file):
+                if os.path.exists(scratch_file):
+                    os.unlink(scratch_file)
+
+        row["time"] += (dedup_time + expand_time) / 60
+        row["dedup_time"] = dedup_time
+        row["expand_time"] = expand_time
+        row["unique_sequences"] = counts["unique_sequences"]
+        row["dedup_ratio"] = counts["sequences"] / counts["unique_sequences"] if counts["unique_sequences"] else float("nan")
+        return save_results(result_dict, f"{aligner}{suffix}", row, dataset_size, threads)
+    run.__name__ = f"{getattr(aligner_fn, '__name__', 'aligner')}_dedup"
+    return run
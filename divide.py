@@ -0,0 +1,257 @@
+import math
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from aligners import famsa_profile
+from resources import measure_self
+from util import iter_fasta, index_fasta, copy_records, save_results, COPY_BUFFER
+
+# residues per k-mer of the sketches, and number of MinHash functions
+KMER = 3
+SKETCH_SIZE = 16
+# sequences sketched per NumPy batch; memory is about 130 bytes x residues of a batch
+SKETCH_BATCH = 2000
+# target number of sequences per cluster
+CLUSTER_SIZE = 20000
+
+# 5-bit code of every byte, letters by position in the alphabet (case-insensitive), anything else 26
+_CODES = np.full(256, 26, dtype=np.uint64)
+for _i, _letter in enumerate(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ"):
+    _CODES[_letter] = _CODES[_letter + 32] = _i
+_EMPTY = np.iinfo(np.uint32).max
+
+
+def _sketch_batch(sequences, k, multipliers, increments):
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    codes = _CODES[np.frombuffer(b"".join(sequences), dtype=np.uint8)]
+    sketches = np.full((len(sequences), len(multipliers)), _EMPTY, dtype=np.uint32)
+    if len(codes) < k:
+        return sketches
+
+    kmers = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+    for i in range(k):
+        kmers = (kmers << np.uint64(5)) | codes[i:len(codes) - k + 1 + i]
+    # keep the k-mers that do not straddle two sequences
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    owner = np.repeat(np.arange(len(sequences)), lengths)[:len(kmers)]
+    valid = np.arange(len(kmers)) - starts[owner] <= lengths[owner] - k
+    kmers, owner = kmers[valid], owner[valid]
+    if len(kmers) == 0:
+        return sketches
+
+    # universal hashing, upper 32 bits of a * x + b
+    hashes = ((kmers[:, np.newaxis] * multipliers + increments) >> np.uint64(32)).astype(np.uint32)
+    present = np.unique(owner)
+    boundaries = np.searchsorted(owner, present)
+    sketches[present] = np.minimum.reduceat(hashes, boundaries, axis=0)
+    return sketches
+
+
+def sketch_sequences(filename, k=KMER, size=SKETCH_SIZE, seed=0, batch=SKETCH_BATCH):
+    """
+        MinHash sketch of the k-mers of every record, in file order.
+
+        Sketches are computed with NumPy over batches of records; the fraction of equal entries of
+        two sketches estimates the Jaccard similarity of their k-mer sets.
+
+        output: (records x size) uint32 array
+    """
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 1 << 62, size=size, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 1 << 62, size=size, dtype=np.uint64)
+    sketches = []
+    sequences = []
+    for _, seq in iter_fasta(filename):
+        sequences.append(seq)
+        if len(sequences) == batch:
+            sketches.append(_sketch_batch(sequences, k, multipliers, increments))
+            sequences = []
+    if sequences:
+        sketches.append(_sketch_batch(sequences, k, multipliers, increments))
+    return np.concatenate(sketches) if sketches else np.zeros((0, size), dtype=np.uint32)
+
+
+def cluster_sketches(sketches, cluster_size=CLUSTER_SIZE, seed=0, batch=SKETCH_BATCH):
+    """
+        Split records into about len / cluster_size clusters of similar k-mer content.
+
+        Records go to the most similar of randomly drawn seed records (most equal sketch entries);
+        clusters larger than twice cluster_size are cut into pieces of cluster_size.
+
+        output: int array, the cluster of every record (0..clusters - 1)
+    """
+    n = len(sketches)
+    count = max(1, math.ceil(n / cluster_size))
+    seeds = sketches[np.random.default_rng(seed).choice(n, size=count, replace=False)]
+    labels = np.empty(n, dtype=np.int64)
+    for start in range(0, n, batch):
+        similarity = (sketches[start:start + batch, np.newaxis, :] == seeds[np.newaxis, :, :]).sum(axis=2)
+        labels[start:start + batch] = similarity.argmax(axis=1)
+
+    # cut oversized clusters, which gather the records similar to no seed
+    order = np.argsort(labels, kind="stable")
+    sizes = np.bincount(labels, minlength=count)
+    final = np.empty(n, dtype=np.int64)
+    next_label = 0
+    position = 0
+    for size in sizes:
+        members = order[position:position + size]
+        position += size
+        if size == 0:
+            continue
+        pieces = math.ceil(size / cluster_size) if size > 2 * cluster_size else 1
+        for piece in np.array_split(members, pieces):
+            final[piece] = next_label
+            next_label += 1
+    return final
+
+
+def cluster_tree(sketches, labels):
+    """
+        UPGMA guide tree over the clusters, from the distance (1 - Jaccard estimate) of the MinHash
+        sketches of their union.
+
+        output: list of merges (left, right, node) in order, leaves being clusters 0..C-1 and
+                internal nodes numbered from C on
+    """
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.searchsorted(labels[order], np.arange(labels.max() + 1))
+    unions = np.minimum.reduceat(sketches[order], boundaries, axis=0)
+    count = len(unions)
+    distance = 1 - (unions[:, np.newaxis, :] == unions[np.newaxis, :, :]).mean(axis=2)
+    np.fill_diagonal(distance, np.inf)
+    sizes = np.bincount(labels).astype(np.float64)
+    nodes = list(range(count))
+    merges = []
+    active = np.ones(count, dtype=bool)
+    for node in range(count, 2 * count - 1):
+        masked = np.where(active[:, np.newaxis] & active[np.newaxis, :], distance, np.inf)
+        i, j = np.unravel_index(np.argmin(masked), masked.shape)
+        merges.append((nodes[i], nodes[j], node))
+        # the merged cluster takes slot i, at the size-weighted mean distance
+        distance[i, :] = distance[:, i] = (sizes[i] * distance[i, :] + sizes[j] * distance[j, :]) / (sizes[i] + sizes[j])
+        distance[i, i] = np.inf
+        sizes[i] += sizes[j]
+        active[j] = False
+        nodes[i] = node
+    return merges
+
+
+def divided(aligner_fn, suffix="-divide"):
+    """
+        An aligners.py wrapper that aligns large inputs by divide and conquer.
+
+        The records are sketched (MinHash of k-mers) and clustered, every cluster is aligned by
+        aligner_fn as its own process (workers at a time, each with cluster_memory_mb as memory limit
+        when given, otherwise the run's memory limit), and the cluster alignments are merged by FAMSA
+        profile-profile alignment along a UPGMA tree over the clusters. The stored row (under
+        {aligner}{suffix}) is end to end: time is the wall time of every stage, CPU times are summed,
+        and the peak RSS covers the processes running together (see below). It also holds clusters,
+        max_cluster_size, sketch_time, cluster_align_time and merge_time (seconds). A cluster or
+        merge stopped by a limit makes the whole run DNF.
+
+        workers is capped at threads, every process getting at least one thread. As up to workers
+        processes run at once, the peak RSS is the largest of: the sum of the workers largest cluster
+        peaks, the sum of the peaks of every round of merges run together, and what sketching added
+        to this process.
+    """
+    def run(input_file, output_file, threads, dataset_size, result_dict, cluster_size=CLUSTER_SIZE, workers=4,
+            cluster_memory_mb=None, seed=0, **run_options):
+        # sub-runs are not sampled, their time series would overwrite each other
+        run_options = {key: value for key, value in run_options.items() if key not in ("sample_interval", "timeseries_dir")}
+        cluster_options = dict(run_options)
+        if cluster_memory_mb is not None:
+            cluster_options["memory_limit_mb"] = cluster_memory_mb
+        workers = max(1, min(int(workers), int(threads)))
+        cluster_threads = str(max(1, int(threads) // workers))
+        workdir = tempfile.mkdtemp(prefix="divide-", dir=os.path.dirname(os.path.abspath(output_file)))
+        rows = []
+        # summed peak RSS of every group of processes that ran at the same time
+        concurrent_peaks = []
+        try:
+            with measure_self() as sketch_usage:
+                # started inside the region, so waiting for another measured region is not counted
+                start = time.perf_counter()
+                sketches = sketch_sequences(input_file, seed=seed)
+                labels = cluster_sketches(sketches, cluster_size, seed=seed)
+                index = index_fasta(input_file)
+                order = np.argsort(labels, kind="stable")
+                sizes = np.bincount(labels)
+                profiles = {}
+                position = 0
+                for cluster, size in enumerate(sizes):
+                    profiles[cluster] = f"{workdir}/cluster-{cluster}.fasta"
+                    with open(profiles[cluster], "wb") as outfile:
+                        # file order inside a cluster
+                        copy_records(input_file, index, np.sort(order[position:position + size]), outfile)
+                    position += size
+                tree = cluster_tree(sketches, labels)
+                del sketches
+            sketch_time = time.perf_counter() - start
+
+            def align_cluster(cluster):
+                if sizes[cluster] < 2:
+                    return None
+                aligned = f"{workdir}/cluster-{cluster}.aln.fasta"
+                row = aligner_fn(profiles[cluster], aligned, cluster_threads, dataset_size, {}, **cluster_options)
+                profiles[cluster] = aligned
+                return row
+
+            phase = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                cluster_rows = [row for row in pool.map(align_cluster, range(len(sizes))) if row is not None]
+            rows += cluster_rows
+            # which clusters overlapped is not tracked, so assume the workers largest did
+            concurrent_peaks.append(sum(sorted((row["peak_rss_mb"] for row in cluster_rows), reverse=True)[:workers]))
+            cluster_align_time = time.perf_counter() - phase
+
+            # merges whose children are both done run together, up to workers at a time
+            phase = time.perf_counter()
+            pending = list(tree)
+            while pending and all(row.get("status", "ok") == "ok" for row in rows):
+                ready = [merge for merge in pending if merge[0] in profiles and merge[1] in profiles][:workers]
+                pending = [merge for merge in pending if merge not in ready]
+                merge_threads = str(max(1, int(threads) // len(ready)))
+
+                def merge_profiles(merge):
+                    left, right, node = merge
+                    merged = f"{workdir}/node-{node}.aln.fasta"
+                    row = famsa_profile(profiles[left], merged, merge_threads, dataset_size, {}, second_profile=profiles[right], **run_options)
+                    return node, merged, row
+
+                with ThreadPoolExecutor(max_workers=len(ready)) as pool:
+                    merge_rows = []
+                    for node, merged, row in pool.map(merge_profiles, ready):
+                        profiles[node] = merged
+                        merge_rows.append(row)
+                rows += merge_rows
+                concurrent_peaks.append(sum(row["peak_rss_mb"] for row in merge_rows))
+            merge_time = time.perf_counter() - phase
+
+            status = next((row["status"] for row in rows if row.get("status", "ok") != "ok"), "ok")
+            if status == "ok":
+                root = tree[-1][2] if tree else 0
+                with open(profiles[root], "rb") as src, open(output_file, "wb") as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        usage = {
+            "status": status,
+            "peak_rss_mb": max(concurrent_peaks + [sketch_usage["peak_rss_mb"] - sketch_usage["start_rss_mb"]]),
+            "time": (time.perf_counter() - start) / 60,
+            "clusters": len(sizes),
+            "max_cluster_size": int(sizes.max()),
+            "sketch_time": sketch_time,
+            "cluster_align_time": cluster_align_time,
+            "merge_time": merge_time,
+        }
+        for key in ("user_time", "system_time", "minor_faults", "major_faults", "voluntary_switches", "involuntary_switches"):
+            usage[key] = sum(row.get(key, 0) for row in rows) + sketch_usage.get(key, 0)
+        name = getattr(aligner_fn, "__name__", "aligner").replace("_", "-")
+        return save_results(result_dict, f"{name}{suffix}", usage, dataset_size, threads)
+    run.__name__ = f"{getattr(aligner_fn, '__name__', 'aligner')}_divide"
+    return run
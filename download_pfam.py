@@ -1,99 +1,206 @@
-import sys, errno, re, json, ssl
+import argparse, json, os, random, ssl, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from urllib import request
 from urllib.error import HTTPError
-from time import sleep
 from tqdm import tqdm
 
-page_size = 200
-BASE_URL = f"https://www.ebi.ac.uk:443/interpro/api/protein/UniProt/entry/pfam/PF00005/?page_size={page_size}&extra_fields=sequence"
-
-save_path = os.path.join(os.path.realpath(__file__), "PF00005.fasta")
-outfile = open(save_path, "w")
+API_URL = "https://www.ebi.ac.uk:443/interpro/api"
+PAGE_SIZE = 200
 HEADER_SEPARATOR = "|"
 LINE_LENGTH = 80
 
-def output_list():
-  #disable SSL verification to avoid config issues
-  context = ssl._create_unverified_context()
+# politeness limit shared by every family: requests in flight, and seconds between request starts
+MAX_CONCURRENT = 2
+MIN_INTERVAL = 1.0
+# retries of a page, with exponential backoff (seconds) and full jitter
+RETRIES = 6
+BACKOFF = 2.0
+MAX_BACKOFF = 120.0
+REQUEST_TIMEOUT = 300
+# HTTP errors worth retrying: timeouts, rate limiting and server errors
+RETRY_CODES = {408, 429, 500, 502, 503, 504}
+WRITE_BUFFER = 1 << 20
+
+def family_url(family, base_url=API_URL, page_size=PAGE_SIZE):
+  return f"{base_url}/protein/UniProt/entry/pfam/{family}/?page_size={page_size}&extra_fields=sequence"
+
+class RateLimiter:
+  """
+    At most max_concurrent requests at a time, started at least min_interval seconds apart, across threads
+
+      with limiter:
+        ... one request ...
+  """
+  def __init__(self, max_concurrent=MAX_CONCURRENT, min_interval=MIN_INTERVAL):
+    self.min_interval = min_interval
+    self._slots = threading.BoundedSemaphore(max_concurrent)
+    self._lock = threading.Lock()
+    self._next_start = 0.0
+
+  def __enter__(self):
+    self._slots.acquire()
+    with self._lock:
+      now = time.monotonic()
+      wait = self._next_start - now
+      self._next_start = max(now, self._next_start) + self.min_interval
+    if wait > 0:
+      time.sleep(wait)
+    return self
 
-  next = BASE_URL
-  last_page = False
+  def __exit__(self, *exc):
+    self._slots.release()
+    return False
 
-  
-  attempts = 0
-  pbar = tqdm()
-  while next:
+def backoff_delay(attempt, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+  # full jitter: uniform over [0, min(max_backoff, backoff * 2^attempt)]
+  return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+def fetch_page(url, limiter, context=None, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+  """
+    GET one page of JSON, retrying timeouts, rate limiting, server and network errors.
+
+    A Retry-After header, when the server sends one, is waited instead of the backoff.
+
+    output: the decoded payload, or None when the server has no content (204)
+  """
+  attempt = 0
+  while True:
+    delay = None
     try:
-      req = request.Request(next, headers={"Accept": "application/json"})
-      res = request.urlopen(req, context=context)
-      # If the API times out due a long running query
-      if res.status == 408:
-        # wait just over a minute
-        sleep(61)
-        # then continue this loop with the same URL
-        continue
-      elif res.status == 204:
-        #no data so leave loop
-        break
-      payload = json.loads(res.read().decode())
-      next = payload["next"]
-      # print(payload)
-      attempts = 0
-      if not next:
-        last_page = True
+      with limiter:
+        req = request.Request(url, headers={"Accept": "application/json"})
+        with request.urlopen(req, context=context, timeout=REQUEST_TIMEOUT) as res:
+          if res.status == 204:
+            return None
+          if res.status != 408:
+            return json.loads(res.read().decode())
+      error = HTTPError(url, 408, "Request Timeout", res.headers, None)
     except HTTPError as e:
-      if e.code == 408:
-        sleep(61)
-        continue
-      else:
-        # If there is a different HTTP error, it wil re-try 3 times before failing
-        if attempts < 3:
-          attempts += 1
-          sleep(61)
-          continue
-        else:
-          sys.stderr.write("LAST URL: " + next)
-          raise e
-
-    total = payload["count"]
-    pbar.total = total
-    pbar.refresh()
-    # pbar = tqdm(total=payload["count"])
-    for i, item in enumerate(payload["results"]):
-      if "entries" not in item:
-          entries = None
-      elif "entries" in item:
-          entries = item["entries"]
-      # entries = None
-      # elif ("entries" in item):
-      #   entries = item["entries"]
-      
-      if entries is not None:
-        entries_header = "-".join(
-          [entry["accession"] + "(" + ";".join(
-            [
-              ",".join(
-                [ str(fragment["start"]) + "..." + str(fragment["end"]) 
-                  for fragment in locations["fragments"]]
-              ) for locations in entry["entry_protein_locations"]
-            ]
-          ) + ")" for entry in entries]
-        )
-        outfile.write(">" + item["metadata"]["accession"] + HEADER_SEPARATOR
-                          + entries_header + HEADER_SEPARATOR
-                          + item["metadata"]["name"] + "\n")
-      else:
-        outfile.write(">" + item["metadata"]["accession"] + HEADER_SEPARATOR + item["metadata"]["name"] + "\n")
-
-      seq = item["extra_fields"]["sequence"]
-      fastaSeqFragments = [seq[0+i:LINE_LENGTH+i] for i in range(0, len(seq), LINE_LENGTH)]
-      for fastaSeqFragment in fastaSeqFragments:
-        outfile.write(fastaSeqFragment + "\n")
-    pbar.update(page_size)
-    
-    # Don't overload the server, give it time before asking for more
-    if next:
-      sleep(1)
+      if e.code not in RETRY_CODES:
+        sys.stderr.write(f"LAST URL: {url}\n")
+        raise
+      error = e
+      retry_after = e.headers.get("Retry-After") if e.headers else None
+      if retry_after and retry_after.isdigit():
+        delay = float(retry_after)
+    except (OSError, ValueError) as e:
+      # network errors, timeouts, truncated or garbled bodies
+      error = e
+    if attempt >= retries:
+      sys.stderr.write(f"LAST URL: {url}\n")
+      raise error
+    time.sleep(backoff_delay(attempt, backoff, max_backoff) if delay is None else delay)
+    attempt += 1
+
+def format_record(item):
+  """
+    One fasta record: accession|Pfam entries with their fragments|name, sequence in lines of LINE_LENGTH
+  """
+  entries = item.get("entries")
+  if entries is not None:
+    entries_header = "-".join(
+      entry["accession"] + "(" + ";".join(
+        ",".join(f"{fragment['start']}...{fragment['end']}" for fragment in locations["fragments"])
+        for locations in entry["entry_protein_locations"]
+      ) + ")" for entry in entries
+    )
+    header = item["metadata"]["accession"] + HEADER_SEPARATOR + entries_header + HEADER_SEPARATOR + item["metadata"]["name"]
+  else:
+    header = item["metadata"]["accession"] + HEADER_SEPARATOR + item["metadata"]["name"]
+
+  seq = item["extra_fields"]["sequence"]
+  lines = [seq[i:i + LINE_LENGTH] + "\n" for i in range(0, len(seq), LINE_LENGTH)]
+  return ">" + header + "\n" + "".join(lines)
+
+def _load_state(state_file):
+  if not os.path.exists(state_file):
+    return None
+  with open(state_file) as f:
+    return json.load(f)
+
+def _save_state(state_file, state):
+  # written aside and renamed, so an interruption leaves the previous cursor intact
+  with open(f"{state_file}.tmp", "w") as f:
+    json.dump(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(f"{state_file}.tmp", state_file)
+
+def download_family(family, output_dir, limiter, base_url=API_URL, page_size=PAGE_SIZE, context=None, position=0, **fetch_options):
+  """
+    Download every UniProt protein of a Pfam family to {output_dir}/{family}.fasta.
+
+    The next page is fetched while the current one is formatted and written. After every page
+    the output is flushed and {family}.fasta.cursor.json records the next cursor and the bytes
+    written, so an interrupted download resumes from the last completed page (the output is cut
+    back to that point first). A finished family is skipped.
+
+    output: path of the fasta file
+  """
+  output_file = os.path.join(output_dir, f"{family}.fasta")
+  state_file = f"{output_file}.cursor.json"
+  state = _load_state(state_file) if os.path.exists(output_file) else None
+  if state is None:
+    state = {"next": family_url(family, base_url, page_size), "bytes": 0, "records": 0, "count": None, "done": False}
+  if state["done"]:
+    return output_file
+
+  pbar = tqdm(desc=family, total=state["count"], initial=state["records"], position=position, leave=True)
+  with open(output_file, "ab") as raw:
+    raw.truncate(state["bytes"])
+  with open(output_file, "ab", buffering=WRITE_BUFFER) as outfile, ThreadPoolExecutor(max_workers=1) as prefetch:
+    page = prefetch.submit(fetch_page, state["next"], limiter, context, **fetch_options)
+    while page is not None:
+      payload = page.result()
+      next_url = payload.get("next") if payload else None
+      # start fetching the next page before writing this one
+      page = prefetch.submit(fetch_page, next_url, limiter, context, **fetch_options) if next_url else None
+
+      if payload:
+        results = payload.get("results", [])
+        outfile.write("".join(format_record(item) for item in results).encode())
+        outfile.flush()
+        state["records"] += len(results)
+        state["count"] = payload.get("count", state["count"])
+        pbar.total = state["count"]
+        pbar.update(len(results))
+      state["bytes"] = outfile.tell()
+      state["next"] = next_url
+      state["done"] = next_url is None
+      os.fsync(outfile.fileno())
+      _save_state(state_file, state)
   pbar.close()
+  return output_file
+
+def download_families(families, output_dir, base_url=API_URL, max_concurrent=MAX_CONCURRENT, min_interval=MIN_INTERVAL,
+                      page_size=PAGE_SIZE, verify_ssl=False, **fetch_options):
+  """
+    Download several Pfam families at once; all of them share one politeness limit
+
+    output: dict family -> path of its fasta file
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  limiter = RateLimiter(max_concurrent, min_interval)
+  # SSL verification is off by default to avoid certificate configuration issues
+  context = None if verify_ssl else ssl._create_unverified_context()
+  with ThreadPoolExecutor(max_workers=max(1, len(families))) as pool:
+    futures = {family: pool.submit(download_family, family, output_dir, limiter, base_url, page_size, context, position, **fetch_options)
+               for position, family in enumerate(families)}
+    return {family: future.result() for family, future in futures.items()}
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Download the UniProt proteins of Pfam families from the InterPro API as fasta")
+  parser.add_argument("families", nargs="*", default=["PF00005"], help="Pfam accessions (default: PF00005)")
+  parser.add_argument("--output-dir", default=os.path.dirname(os.path.realpath(__file__)), help="Directory of the <family>.fasta files (default: next to this script)")
+  parser.add_argument("--base-url", default=API_URL, help="InterPro API root, e.g. a local stand-in server for testing")
+  parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Proteins per page")
+  parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT, help="Requests in flight at a time, over all families")
+  parser.add_argument("--min-interval", type=float, default=MIN_INTERVAL, help="Seconds between the starts of two requests")
+  parser.add_argument("--retries", type=int, default=RETRIES, help="Retries of a page before giving up")
+  parser.add_argument("--verify-ssl", action="store_true", help="Verify the server certificate")
+  args = parser.parse_args(argv)
+  download_families(args.families, args.output_dir, base_url=args.base_url, max_concurrent=args.max_concurrent,
+                    min_interval=args.min_interval, page_size=args.page_size, verify_ssl=args.verify_ssl, retries=args.retries)
 
-output_list()
\ No newline at end of file
+if __name__ == "__main__":
+  main()
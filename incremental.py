@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+from util import folder_path, dataset_hash, sample_fasta, iter_fasta, COPY_BUFFER
+
+# batch sizes (new sequences) added to the base alignment by default
+ADD_SIZES = [100, 1000, 10000, 50000]
+
+# incremental aligner -> aligner re-aligning everything from scratch
+ADD_PAIRS = {
+    "famsa-add": "famsa",
+    "mafft-add": "mafft-parttree",
+    "mafft-addfragments": "mafft-parttree",
+}
+
+
+def batch_label(base_size, batch_size):
+    return f"{base_size}+{batch_size}"
+
+
+def prepare_incremental(source, base_size, batch_sizes=None, seed=0, threads=1):
+    """
+        Base alignment and batches of new sequences for the incremental benchmark.
+
+        base_size sequences and a pool of max(batch_sizes) others are drawn from source without
+        overlap; every batch is the start of the pool, so larger batches contain the smaller ones.
+        The base is aligned once with FAMSA (not measured), and for every batch the base and the
+        batch are also written together, as the input of the full re-alignment. Files go to
+        incremental-extHomFam-v2/ and are rebuilt when the spec (source hash, sizes, seed) changes.
+
+        output: dict with base (unaligned), base_alignment, and batches: dict label -> dict with
+                batch_size, batch (new sequences) and full (base + batch)
+    """
+    batch_sizes = sorted(ADD_SIZES if batch_sizes is None else batch_sizes)
+    output_dir = f"{folder_path}/incremental-extHomFam-v2"
+    os.makedirs(output_dir, exist_ok=True)
+    base = f"{output_dir}/base-{base_size}.fasta"
+    pool = f"{output_dir}/pool-{base_size}.fasta"
+    prepared = {
+        "base": base,
+        "base_alignment": f"{output_dir}/base-{base_size}.aln.fasta",
+        "batches": {batch_label(base_size, k): {"batch_size": k,
+                                                 "batch": f"{output_dir}/batch-{base_size}+{k}.fasta",
+                                                 "full": f"{output_dir}/full-{base_size}+{k}.fasta"}
+                    for k in batch_sizes},
+    }
+    spec = {"source": os.path.basename(source), "source_sha256": dataset_hash(source), "seed": seed,
+            "base_size": base_size, "batch_sizes": batch_sizes}
+    spec_file = f"{output_dir}/incremental-{base_size}.json"
+    files = [base, prepared["base_alignment"]] + [path for batch in prepared["batches"].values() for path in (batch["batch"], batch["full"])]
+    if all(os.path.exists(path) for path in files) and os.path.exists(spec_file):
+        with open(spec_file) as f:
+            if json.load(f) == spec:
+                return prepared
+
+    sample_fasta(source, [(base, base_size), (pool, max(batch_sizes))], seed=seed)
+    pool_records = [b">%s\n%s\n" % record for record in iter_fasta(pool, full_name=True)]
+    for batch in prepared["batches"].values():
+        records = b"".join(pool_records[:batch["batch_size"]])
+        with open(batch["batch"], "wb") as f:
+            f.write(records)
+        with open(batch["full"], "wb") as out, open(base, "rb") as f:
+            shutil.copyfileobj(f, out, COPY_BUFFER)
+            out.write(records)
+    os.unlink(pool)
+
+    print(f"Aligning the base of {base_size} sequences with FAMSA")
+    subprocess.run(["famsa", "-t", str(threads), base, prepared["base_alignment"]], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    with open(spec_file, "w") as f:
+        json.dump(spec, f, indent=2)
+    return prepared
+
+
+def _crossover(batch_sizes, add_times, full_times):
+    # first batch size where adding costs as much as re-aligning, interpolated in log batch size
+    ratio = np.log(np.asarray(add_times) / np.asarray(full_times))
+    above = np.flatnonzero(ratio >= 0)
+    if len(above) == 0:
+        return np.nan
+    i = above[0]
+    if i == 0:
+        return float(batch_sizes[0])
+    x0, x1 = np.log(batch_sizes[i - 1]), np.log(batch_sizes[i])
+    return float(np.exp(x0 + (x1 - x0) * -ratio[i - 1] / (ratio[i] - ratio[i - 1])))
+
+
+def incremental_report(df, batches, time_column="Time"):
+    """
+        Incremental addition against full re-alignment, per ADD_PAIRS pair and thread count.
+
+        input:
+            df: results dataframe from util.dict_to_dataframe
+            batches: dict dataset size label -> batch size (number of added sequences)
+
+        output: dataframe with the add and full times for every batch size, their ratio and
+                Crossover Batch, the batch size from which re-aligning from scratch is cheaper
+                (the smallest batch if it already is, NaN if adding is cheaper for every batch)
+    """
+    if "Dataset Size" not in df.columns:
+        return pd.DataFrame()
+    df = df[df["Dataset Size"].isin(list(batches))]
+    if "Status" in df.columns:
+        df = df[df["Status"] == "ok"]
+    times = df.set_index(["Aligner", "Dataset Size", "Threads"])[time_column]
+
+    rows = []
+    for add, full in ADD_PAIRS.items():
+        for threads in sorted(df.loc[df["Aligner"] == add, "Threads"].unique()):
+            measured = [(batches[size], times[(add, size, threads)], times[(full, size, threads)])
+                        for size in batches if (add, size, threads) in times.index and (full, size, threads) in times.index]
+            if not measured:
+                continue
+            measured.sort()
+            batch_sizes, add_times, full_times = zip(*measured)
+            crossover = _crossover(batch_sizes, add_times, full_times)
+            for k, add_time, full_time in measured:
+                rows.append({"Incremental": add, "Full": full, "Threads": threads, "Batch Size": k,
+                             f"Add {time_column}": add_time, f"Full {time_column}": full_time,
+                             "Add / Full": add_time / full_time, "Crossover Batch": crossover})
+    return pd.DataFrame(rows)
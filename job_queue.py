@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# seconds a claimed job stays leased without a heartbeat before it is handed to another worker
+LEASE = 120
+# claims of a job before it is given up as failed, e.g. when every worker running it dies
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    heartbeat REAL,
+    result TEXT,
+    error TEXT
+);
+"""
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def run_fingerprint(config, datasets):
+    """
+        Short digest of what a run's results depend on beyond the grid cell: the worker config
+        (run, trial, sink and validation options) and the datasets (from collect_metadata, with
+        their sha256)
+    """
+    payload = json.dumps({"config": config, "datasets": datasets}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class JobQueue:
+    """
+        Benchmark jobs in a SQLite database on storage shared by every worker.
+
+        A job is one aligner x dataset size x threads cell of a run (spec: the job dict of benchmark.py
+        without its function, plus the run fingerprint), and moves pending -> running -> done | failed. Claims run in an immediate
+        transaction, so two workers never get the same job. A running job whose worker has not sent a
+        heartbeat for lease seconds is put back to pending (its attempts are kept) and claimed again,
+        unless it was claimed max_attempts times already: then it is marked failed, so a job that kills
+        its worker does not take down every worker in turn.
+
+        The rollback journal is used rather than WAL, which needs shared memory that network
+        filesystems do not provide.
+    """
+    def __init__(self, path, lease=LEASE, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # autocommit mode, transactions are opened explicitly
+        self._db = sqlite3.connect(path, timeout=300, isolation_level=None, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    @staticmethod
+    def key(spec):
+        cell = f"{spec['aligner']}/{spec['dataset_size']}/{spec['threads']}"
+        return f"{spec['run']}/{cell}" if spec.get("run") else cell
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements()
+                self._db.execute("COMMIT")
+                return result
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def set_config(self, config):
+        """
+            Options every worker runs the jobs with (run and trial options, sink, validation, references)
+        """
+        self._transaction(lambda: self._db.executemany("INSERT OR REPLACE INTO config VALUES (?, ?)",
+                                                       [(key, json.dumps(value)) for key, value in config.items()]))
+
+    def config(self):
+        return {key: json.loads(value) for key, value in self._db.execute("SELECT key, value FROM config")}
+
+    def enqueue(self, specs, run=None):
+        """
+            Add jobs; jobs already in the queue (same run, aligner, dataset size and threads) are kept as
+            they are. With run (see run_fingerprint), the jobs of every other run are removed first, so a
+            reused queue never hands back results measured with other options or datasets.
+
+            output: number of jobs added
+        """
+        if run is not None:
+            specs = [dict(spec, run=run) for spec in specs]
+
+        def insert():
+            if run is not None:
+                self._db.execute("DELETE FROM jobs WHERE substr(key, 1, ?) != ?", (len(run) + 1, f"{run}/"))
+            before = self._db.total_changes
+            self._db.executemany("INSERT OR IGNORE INTO jobs (key, spec) VALUES (?, ?)",
+                                 [(self.key(spec), json.dumps(spec)) for spec in specs])
+            return self._db.total_changes - before
+        return self._transaction(insert)
+
+    def _requeue_stale(self, now):
+        self._db.execute("UPDATE jobs SET status = 'failed', error = ?, heartbeat = ? WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                         (f"worker lost {self.max_attempts} times", now, now - self.lease, self.max_attempts))
+        self._db.execute("UPDATE jobs SET status = 'pending', worker = NULL WHERE status = 'running' AND heartbeat < ?",
+                         (now - self.lease,))
+
+    def requeue_stale(self):
+        self._transaction(lambda: self._requeue_stale(time.time()))
+
+    def claim(self, worker):
+        """
+            Take the oldest pending job claimed fewer than max_attempts times, after re-queueing (or
+            failing) jobs of workers that stopped sending heartbeats.
+
+            output: (job_id, spec), or None when nothing is pending
+        """
+        def take():
+            now = time.time()
+            self._requeue_stale(now)
+            self._db.execute("UPDATE jobs SET status = 'failed', error = ? WHERE status = 'pending' AND attempts >= ?",
+                             (f"claimed {self.max_attempts} times without finishing", self.max_attempts))
+            found = self._db.execute("SELECT job_id, spec FROM jobs WHERE status = 'pending' ORDER BY job_id LIMIT 1").fetchone()
+            if found is None:
+                return None
+            self._db.execute("UPDATE jobs SET status = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE job_id = ?",
+                             (worker, now, found[0]))
+            return found[0], json.loads(found[1])
+        return self._transaction(take)
+
+    def heartbeat(self, job_id, worker):
+        """
+            output: False if the job is no longer leased to this worker
+        """
+        def beat():
+            return self._db.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                    (time.time(), job_id, worker)).rowcount == 1
+        return self._transaction(beat)
+
+    def complete(self, job_id, worker, result):
+        """
+            Store the result of a job; ignored (returns False) if the job was re-queued to another worker meanwhile
+        """
+        def done():
+            return self._db.execute("UPDATE jobs SET status = 'done', result = ?, heartbeat = ? WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                    (json.dumps(result, default=str), time.time(), job_id, worker)).rowcount == 1
+        return self._transaction(done)
+
+    def fail(self, job_id, worker, error):
+        def failed():
+            return self._db.execute("UPDATE jobs SET status = 'failed', error = ?, heartbeat = ? WHERE job_id = ? AND worker = ? AND status = 'running'",
+                                    (str(error), time.time(), job_id, worker)).rowcount == 1
+        return self._transaction(failed)
+
+    def retry_failed(self):
+        """
+            Put failed jobs back to pending with their attempts reset, output: number of jobs
+        """
+        return self._transaction(lambda: self._db.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL, error = NULL, attempts = 0 WHERE status = 'failed'").rowcount)
+
+    def counts(self):
+        """
+            output: dict status -> number of jobs
+        """
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update(dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")))
+        return counts
+
+    def jobs(self, status=None):
+        """
+            output: list of dicts with job_id, spec, status, worker, attempts, result and error
+        """
+        query = "SELECT job_id, spec, status, worker, attempts, result, error FROM jobs"
+        rows = self._db.execute(query + " WHERE status = ? ORDER BY job_id" if status else query + " ORDER BY job_id",
+                                (status,) if status else ())
+        return [{"job_id": job_id, "spec": json.loads(spec), "status": state, "worker": worker, "attempts": attempts,
+                 "result": json.loads(result) if result else None, "error": error}
+                for job_id, spec, state, worker, attempts, result, error in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class Heartbeat:
+    """
+        Background thread renewing the lease of a claimed job every lease / 3 seconds.
+
+            with Heartbeat(queue, job_id, worker):
+                ... run the job ...
+    """
+    def __init__(self, queue, job_id, worker):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.queue.lease / 3):
+            if not self.queue.heartbeat(self.job_id, self.worker):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        return False
@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+import time
+
+
+class Journal:
+    """
+        Append-only JSON-lines journal of benchmark results, written as each trial finishes.
+
+        Every line is flushed and fsynced, so a crash loses at most the trial that was running.
+        Records:
+            {"type": "trial", "aligner", "dataset_size", "threads", "trial", "row"}  one measured trial
+            {"type": "cell", "aligner", "dataset_size", "threads", "row"}           summary of a finished cell
+            {"type": "failed", "aligner", "dataset_size", "threads", "error"}       a cell that raised
+
+        With resume=True an existing journal is loaded and appended to; otherwise it is moved
+        aside to {path}.{timestamp} and a new one is started.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self.trials = {}
+        self.cells = {}
+        self.failed = {}
+
+        if os.path.exists(path):
+            if resume:
+                self._load()
+            else:
+                os.replace(path, f"{path}.{int(time.time())}")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a")
+
+    @staticmethod
+    def key(aligner, dataset_size, threads):
+        return (aligner, dataset_size, int(threads))
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn last line of a crashed run
+                    continue
+                key = self.key(record["aligner"], record["dataset_size"], record["threads"])
+                if record["type"] == "trial":
+                    self.trials.setdefault(key, {})[record["trial"]] = record["row"]
+                elif record["type"] == "cell":
+                    self.cells[key] = record["row"]
+                    self.failed.pop(key, None)
+                elif record["type"] == "failed":
+                    self.failed[key] = record["error"]
+
+    def _append(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def completed_trials(self, aligner, dataset_size, threads):
+        """
+            Rows of the trials already measured for a cell, in trial order
+        """
+        trials = self.trials.get(self.key(aligner, dataset_size, threads), {})
+        return [trials[trial] for trial in sorted(trials)]
+
+    def completed_cell(self, aligner, dataset_size, threads):
+        """
+            Summary row of a finished cell, or None
+        """
+        return self.cells.get(self.key(aligner, dataset_size, threads))
+
+    def record_trial(self, aligner, dataset_size, threads, trial, row):
+        self.trials.setdefault(self.key(aligner, dataset_size, threads), {})[trial] = row
+        self._append({"type": "trial", "aligner": aligner, "dataset_size": dataset_size, "threads": int(threads), "trial": trial, "row": row})
+
+    def record_cell(self, aligner, dataset_size, threads, row):
+        self.cells[self.key(aligner, dataset_size, threads)] = row
+        self.failed.pop(self.key(aligner, dataset_size, threads), None)
+        self._append({"type": "cell", "aligner": aligner, "dataset_size": dataset_size, "threads": int(threads), "row": row})
+
+    def record_failure(self, aligner, dataset_size, threads, error):
+        self.failed[self.key(aligner, dataset_size, threads)] = str(error)
+        self._append({"type": "failed", "aligner": aligner, "dataset_size": dataset_size, "threads": int(threads), "error": str(error)})
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,302 @@
+import os
+import resource
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+# Linux reports ru_maxrss (and /proc VmHWM) in kilobytes
+RSS_UNIT = 1024
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def rusage_to_dict(ru):
+    return {
+        "peak_rss_mb": ru.ru_maxrss / RSS_UNIT,
+        "user_time": ru.ru_utime,
+        "system_time": ru.ru_stime,
+        "minor_faults": ru.ru_minflt,
+        "major_faults": ru.ru_majflt,
+        "voluntary_switches": ru.ru_nvcsw,
+        "involuntary_switches": ru.ru_nivcsw,
+    }
+
+
+# seconds between SIGTERM and SIGKILL when a job hits its time limit
+KILL_GRACE = 10
+
+# exit signals that, under a memory limit, mean the aligner ran out of memory
+OOM_SIGNALS = (signal.SIGKILL, signal.SIGABRT, signal.SIGSEGV, signal.SIGBUS)
+
+
+class LimitExceeded(Exception):
+    """
+        An aligner was stopped by its time or memory limit.
+
+        status: "timeout" or "oom"
+        usage: resources measured up to the kill, as returned by run_measured
+    """
+    def __init__(self, status, usage, cmd, stderr=b""):
+        super().__init__(f"{status}: {cmd}")
+        self.status = status
+        self.usage = usage
+        self.cmd = cmd
+        self.stderr = stderr
+
+
+class MemoryCgroup:
+    """
+        Child cgroup (v2) with memory.max, created under a delegated parent cgroup.
+
+        The parent must be writable by this user with the memory controller enabled in its
+        cgroup.subtree_control; use None to fall back to RLIMIT_AS.
+    """
+    _count = 0
+
+    def __init__(self, parent, limit_mb):
+        MemoryCgroup._count += 1
+        self.path = os.path.join(parent, f"benchmark-{os.getpid()}-{MemoryCgroup._count}")
+        os.mkdir(self.path)
+        try:
+            with open(os.path.join(self.path, "memory.max"), "w") as f:
+                f.write(str(int(limit_mb * 1024 * 1024)))
+            if os.path.exists(os.path.join(self.path, "memory.swap.max")):
+                with open(os.path.join(self.path, "memory.swap.max"), "w") as f:
+                    f.write("0")
+        except OSError:
+            os.rmdir(self.path)
+            raise
+
+    @property
+    def procs(self):
+        # writing a pid here moves that process into the cgroup
+        return os.path.join(self.path, "cgroup.procs")
+
+    def oom_killed(self):
+        with open(os.path.join(self.path, "memory.events")) as f:
+            for line in f:
+                key, value = line.split()
+                if key == "oom_kill":
+                    return int(value) > 0
+        return False
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+
+def _kill_group(pgid, grace):
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            os.killpg(pgid, 0)
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _limit_wrapper(cmd, shell=False, affinity=None, memory_limit_mb=None, cgroup=None):
+    # Limits are applied by programs the child execs into before the aligner (taskset, then a
+    # /bin/sh that joins the cgroup or sets ulimit -v), rather than by Python code in a preexec_fn,
+    # which is unsafe in the forked child of a threaded process. The pid stays the same throughout,
+    # so wait4 and the sampler still see the aligner.
+    argv = ["/bin/sh", "-c", cmd] if shell else list(cmd)
+    steps = []
+    if cgroup is not None:
+        steps.append(f"echo $$ > {shlex.quote(cgroup.procs)}")
+    elif memory_limit_mb is not None:
+        steps.append(f"ulimit -v {int(memory_limit_mb * 1024)}")
+    if steps:
+        argv = ["/bin/sh", "-c", " && ".join(steps + ['exec "$@"']), "sh"] + argv
+    if affinity is not None:
+        argv = ["taskset", "-c", ",".join(str(cpu) for cpu in sorted(affinity))] + argv
+    return argv
+
+
+def run_measured(cmd, shell=False, sampler=None, affinity=None, timeout=None, memory_limit_mb=None, cgroup_parent=None):
+    """
+        Run an aligner as a child process and account for its resources with os.wait4.
+
+        The rusage returned by wait4 covers the child and every descendant it has waited for,
+        so a shell pipeline such as the MAFFT wrapper is accounted as a whole.
+
+        The child runs in its own process group. On timeout the whole group gets SIGTERM, then
+        SIGKILL after KILL_GRACE seconds. The memory limit is memory.max of a child cgroup when
+        cgroup_parent is given, otherwise RLIMIT_AS (virtual address space, a stricter proxy for RSS).
+        The CPU affinity and the limit are set by exec wrappers (taskset, /bin/sh) the child runs
+        through before the aligner, so nothing runs between fork and exec.
+
+        input:
+            cmd: argument list, or a command string when shell=True
+            shell: run the command through /bin/sh
+            sampler: optional sampler.ProcSampler, started on the child and stopped once it exits
+            affinity: optional CPU ids the child (and everything it spawns) is pinned to
+            timeout: optional wall-clock limit in seconds
+            memory_limit_mb: optional memory limit in MB
+            cgroup_parent: optional delegated cgroup v2 directory to enforce memory_limit_mb with
+
+        output: dict with wall time (minutes), peak RSS (MB), CPU times (s), page faults and context switches
+        raises: LimitExceeded if a limit stopped the child (with the partial usage),
+                subprocess.CalledProcessError if the child exits with a non-zero status
+    """
+    cgroup = None
+    if memory_limit_mb is not None and cgroup_parent is not None:
+        cgroup = MemoryCgroup(cgroup_parent, memory_limit_mb)
+
+    wrapped = affinity is not None or memory_limit_mb is not None
+    try:
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            start = time.perf_counter()
+            if wrapped:
+                proc = subprocess.Popen(_limit_wrapper(cmd, shell, affinity, memory_limit_mb, cgroup),
+                                        stdout=stdout, stderr=stderr, start_new_session=True)
+            else:
+                proc = subprocess.Popen(cmd, shell=shell, stdout=stdout, stderr=stderr, start_new_session=True)
+            timer = None
+            timed_out = threading.Event()
+            if timeout is not None:
+                def on_timeout():
+                    timed_out.set()
+                    _kill_group(proc.pid, KILL_GRACE)
+                timer = threading.Timer(timeout, on_timeout)
+                timer.daemon = True
+                timer.start()
+            if sampler is not None:
+                sampler.start(proc.pid)
+            try:
+                _, status, ru = os.wait4(proc.pid, 0)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                if sampler is not None:
+                    sampler.stop()
+            end = time.perf_counter()
+            # wait4 already reaped the child, let Popen know
+            proc.returncode = _exit_code(status)
+
+            # reap anything the aligner left behind in its group
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+            usage = rusage_to_dict(ru)
+            usage["time"] = (end - start) / 60
+
+            if proc.returncode != 0:
+                stdout.seek(0)
+                stderr.seek(0)
+                output, errors = stdout.read(), stderr.read()
+                if timed_out.is_set():
+                    raise LimitExceeded("timeout", usage, cmd, errors)
+                if cgroup is not None and cgroup.oom_killed():
+                    raise LimitExceeded("oom", usage, cmd, errors)
+                if cgroup is None and memory_limit_mb is not None and (
+                        -proc.returncode in OOM_SIGNALS or b"memory" in errors.lower() or b"bad_alloc" in errors):
+                    raise LimitExceeded("oom", usage, cmd, errors)
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output=output, stderr=errors)
+    finally:
+        if cgroup is not None:
+            cgroup.remove()
+
+    return usage
+
+
+def _read_status_kb(field, pid="self"):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return None
+
+
+def current_rss_mb():
+    """
+        Resident set size of this process right now
+    """
+    return _read_status_kb("VmRSS") / RSS_UNIT
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# VmHWM and RUSAGE_SELF are process-wide, so measured regions of concurrent jobs take turns
+_measure_lock = threading.Lock()
+
+
+class measure_self:
+    """
+        Context manager measuring the current process, for in-process aligners such as pyfamsa.
+
+        The peak RSS is the process high-water mark (VmHWM) reset on entry, so it includes the
+        interpreter and already loaded data but not allocations made before the measured region.
+        Falls back to the lifetime ru_maxrss when the high-water mark cannot be reset. start_rss_mb
+        is the RSS on entry, to tell what the region itself added.
+
+        Resetting the high-water mark affects the whole process, so regions run one at a time: a
+        region opened while another thread is inside one waits for it to end. Regions must not nest.
+
+            with measure_self() as usage:
+                ...
+            usage["peak_rss_mb"]
+
+        sampler: optional sampler.ProcSampler polling this process while the region runs
+    """
+    def __init__(self, sampler=None):
+        self.sampler = sampler
+
+    def __enter__(self):
+        _measure_lock.acquire()
+        try:
+            self.usage = {"start_rss_mb": current_rss_mb()}
+            self._reset = _reset_peak_rss()
+            self._before = resource.getrusage(resource.RUSAGE_SELF)
+            self._start = time.perf_counter()
+            if self.sampler is not None:
+                self.sampler.start(os.getpid())
+        except BaseException:
+            # __exit__ does not run when __enter__ raises
+            _measure_lock.release()
+            raise
+        return self.usage
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        try:
+            if self.sampler is not None:
+                self.sampler.stop()
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            if self._reset:
+                hwm = _read_status_kb("VmHWM") / RSS_UNIT
+        finally:
+            _measure_lock.release()
+        usage = rusage_to_dict(after)
+        before = rusage_to_dict(self._before)
+        for key in usage:
+            if key != "peak_rss_mb":
+                usage[key] -= before[key]
+
+        if self._reset:
+            usage["peak_rss_mb"] = hwm
+
+        usage["time"] = (end - self._start) / 60
+        self.usage.update(usage)
+        return False
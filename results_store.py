@@ -0,0 +1,270 @@
+import datetime
+import json
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import numpy as np
+import pandas as pd
+from analysis import permutation_test
+from util import dataset_hash, RESULT_COLUMNS
+
+# command printing the version of each aligner binary; famsa prints it in the banner of a bare call
+TOOL_VERSION_COMMANDS = {
+    "famsa": ["famsa"],
+    "kalign": ["kalign", "--version"],
+    "clustalo": ["clustalo", "--version"],
+    "mafft": ["mafft", "--version"],
+}
+
+# measurements compared between runs: key -> flag raised when it grows significantly
+REGRESSION_METRICS = {"time": "Slowdown", "peak_rss_mb": "Memory Growth"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    created TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cells (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    aligner TEXT NOT NULL,
+    dataset_size TEXT NOT NULL,
+    threads INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (run_id, aligner, dataset_size, threads)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    aligner TEXT NOT NULL,
+    dataset_size TEXT NOT NULL,
+    threads INTEGER NOT NULL,
+    trial INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (run_id, aligner, dataset_size, threads, trial)
+);
+CREATE TABLE IF NOT EXISTS baselines (
+    name TEXT PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id)
+);
+"""
+
+
+def _tool_version(cmd):
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    lines = [line.strip() for line in proc.stdout.decode("utf-8", "replace").splitlines() if line.strip()]
+    # prefer the line that names the version over a usage banner
+    for line in lines:
+        if "version" in line.lower() or "ver." in line.lower() or line[:1].isdigit() or line.lower().startswith("v"):
+            return line
+    return lines[0] if lines else None
+
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+
+def _memory_total_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _git_commit():
+    try:
+        proc = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return proc.stdout.decode().strip() or None
+
+
+def collect_metadata(datasets=None, options=None):
+    """
+        Environment of a benchmark run.
+
+        input:
+            datasets: dict dataset size -> fasta file, stored with the sha256 of its manifest
+            options: command-line options of the run
+
+        output: JSON-serializable dict
+    """
+    try:
+        import pyfamsa
+        pyfamsa_version = getattr(pyfamsa, "__version__", None)
+    except ImportError:
+        pyfamsa_version = None
+
+    tools = {tool: _tool_version(cmd) for tool, cmd in TOOL_VERSION_COMMANDS.items()}
+    tools["pyfamsa"] = pyfamsa_version
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "host": socket.gethostname(),
+        "cpu_model": _cpu_model(),
+        "cpu_count": os.cpu_count(),
+        "cpu_affinity": len(os.sched_getaffinity(0)),
+        "memory_total_mb": _memory_total_mb(),
+        "kernel": platform.release(),
+        "python": platform.python_version(),
+        "benchmark_commit": _git_commit(),
+        "tools": tools,
+        "datasets": {size: {"file": os.path.basename(path), "sha256": dataset_hash(path)}
+                     for size, path in (datasets or {}).items()},
+        "options": options or {},
+    }
+
+
+class ResultsStore:
+    """
+        SQLite store of benchmark runs: one row per run with its metadata, the summary row of every
+        cell and the raw rows of every trial (JSON, keyed as in util.RESULT_COLUMNS), and named
+        baselines pointing at runs.
+
+        Runs are referred to by id, by a baseline name, or as "latest" / "previous".
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def add_run(self, name, result_dict, trial_samples=(), metadata=None):
+        """
+            Store a run, as collected by benchmark.py (result_dict and trial_samples).
+
+            output: run id
+        """
+        metadata = metadata or {}
+        created = metadata.get("timestamp") or datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._db:
+            run_id = self._db.execute("INSERT INTO runs (name, created, metadata) VALUES (?, ?, ?)",
+                                      (name, created, json.dumps(metadata, default=str))).lastrowid
+            self._db.executemany("INSERT INTO cells VALUES (?, ?, ?, ?, ?)", [
+                (run_id, aligner, dataset_size, int(threads), json.dumps(row, default=str))
+                for aligner, cells in result_dict.items()
+                for (dataset_size, threads), row in cells.items()])
+            self._db.executemany("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?)", [
+                (run_id, aligner, dataset_size, int(row["threads"]), trial, json.dumps(row, default=str))
+                for aligner, dataset_size, trial, row in trial_samples])
+        return run_id
+
+    def set_baseline(self, name, run):
+        run_id = self.resolve(run)
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO baselines VALUES (?, ?)", (name, run_id))
+        return run_id
+
+    def resolve(self, run):
+        """
+            Run id of a run id, baseline name, "latest" or "previous"
+        """
+        if isinstance(run, int) or str(run).isdigit():
+            found = self._db.execute("SELECT run_id FROM runs WHERE run_id = ?", (int(run),)).fetchone()
+        elif run in ("latest", "previous"):
+            found = self._db.execute("SELECT run_id FROM runs ORDER BY run_id DESC LIMIT 1 OFFSET ?",
+                                     (0 if run == "latest" else 1,)).fetchone()
+        else:
+            found = self._db.execute("SELECT run_id FROM baselines WHERE name = ?", (run,)).fetchone()
+        if found is None:
+            raise KeyError(f"no run {run} in {self.path}")
+        return found[0]
+
+    def runs(self):
+        """
+            Stored runs, newest first, with their baseline names
+        """
+        rows = []
+        baselines = {}
+        for name, run_id in self._db.execute("SELECT name, run_id FROM baselines"):
+            baselines.setdefault(run_id, []).append(name)
+        for run_id, name, created, metadata in self._db.execute("SELECT * FROM runs ORDER BY run_id DESC"):
+            metadata = json.loads(metadata)
+            rows.append({"Run": run_id, "Name": name, "Created": created, "Host": metadata.get("host"),
+                         "FAMSA": metadata.get("tools", {}).get("famsa"),
+                         "Baselines": ",".join(baselines.get(run_id, []))})
+        return pd.DataFrame(rows)
+
+    def metadata(self, run):
+        (metadata,) = self._db.execute("SELECT metadata FROM runs WHERE run_id = ?", (self.resolve(run),)).fetchone()
+        return json.loads(metadata)
+
+    def cells(self, run):
+        """
+            output: dict (aligner, dataset_size, threads) -> summary row
+        """
+        query = "SELECT aligner, dataset_size, threads, row FROM cells WHERE run_id = ?"
+        return {(aligner, dataset_size, threads): json.loads(row)
+                for aligner, dataset_size, threads, row in self._db.execute(query, (self.resolve(run),))}
+
+    def trials(self, run):
+        """
+            output: dict (aligner, dataset_size, threads) -> raw trial rows in trial order
+        """
+        query = "SELECT aligner, dataset_size, threads, row FROM trials WHERE run_id = ? ORDER BY trial"
+        trials = {}
+        for aligner, dataset_size, threads, row in self._db.execute(query, (self.resolve(run),)):
+            trials.setdefault((aligner, dataset_size, threads), []).append(json.loads(row))
+        return trials
+
+    def close(self):
+        self._db.close()
+
+
+def compare_runs(store, baseline, candidate, alpha=0.05, min_change=0.05):
+    """
+        Flag cells (aligner x dataset size x threads) that got slower or use more memory.
+
+        A measurement regresses when its median grew by more than min_change (relative) and a
+        one-sided permutation test over the trials of both runs gives p <= alpha. Cells measured
+        only once on either side get no p-value and are never flagged; run with --repeats 3 or more.
+        DNF cells are compared as reported but a cell that was ok and is now DNF is always flagged.
+
+        output: dataframe with one row per cell present in both runs
+    """
+    baseline_cells, candidate_cells = store.cells(baseline), store.cells(candidate)
+    baseline_trials, candidate_trials = store.trials(baseline), store.trials(candidate)
+
+    rows = []
+    for key in sorted(set(baseline_cells) & set(candidate_cells)):
+        aligner, dataset_size, threads = key
+        row = {"Aligner": aligner, "Dataset Size": dataset_size, "Threads": threads}
+        before, after = baseline_cells[key], candidate_cells[key]
+        row["Baseline Status"] = before.get("status", "ok")
+        row["Status"] = after.get("status", "ok")
+        regression = row["Baseline Status"] == "ok" and row["Status"] != "ok"
+
+        for metric, flag in REGRESSION_METRICS.items():
+            column = RESULT_COLUMNS[metric]
+            old = [trial[metric] for trial in baseline_trials.get(key, []) if metric in trial] or [before.get(metric, np.nan)]
+            new = [trial[metric] for trial in candidate_trials.get(key, []) if metric in trial] or [after.get(metric, np.nan)]
+            old_median, new_median = float(np.median(old)), float(np.median(new))
+            change = new_median / old_median - 1 if old_median > 0 else np.nan
+            p_value = permutation_test(old, new)
+            row[f"Baseline {column}"] = old_median
+            row[column] = new_median
+            row[f"{column} Change"] = change
+            row[f"{column} p"] = p_value
+            row[flag] = bool(change > min_change and p_value <= alpha)
+            regression |= row[flag]
+
+        row["Regression"] = bool(regression)
+        rows.append(row)
+
+    return pd.DataFrame(rows)
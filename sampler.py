@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+import numpy as np
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+# Columns of every time series, in file order
+SAMPLE_COLUMNS = ["time", "rss_mb", "cpu_percent", "cpu_seconds", "threads", "processes", "read_bytes", "write_bytes"]
+
+
+def _children(pid):
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def process_tree(pid):
+    """
+        pid and all its live descendants, read from /proc/<pid>/task/<tid>/children
+    """
+    tree = []
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(_children(current))
+    return tree
+
+
+def read_process(pid):
+    """
+        Read one process' counters from /proc/<pid>/{stat,status,io}.
+
+        output: dict or None if the process is gone
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm may contain spaces, the remaining fields start after the last ")"
+            fields = f.read().rsplit(")", 1)[1].split()
+        rss_kb = 0
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                    break
+        io = {}
+        try:
+            with open(f"/proc/{pid}/io") as f:
+                for line in f:
+                    key, value = line.split(":")
+                    io[key] = int(value)
+        except OSError:
+            # io is not readable for processes of other users
+            pass
+    except (OSError, IndexError):
+        return None
+
+    return {
+        "cpu_ticks": int(fields[11]) + int(fields[12]),
+        "threads": int(fields[17]),
+        "rss_kb": rss_kb,
+        "read_bytes": io.get("read_bytes", 0),
+        "write_bytes": io.get("write_bytes", 0),
+    }
+
+
+class ProcSampler:
+    """
+        Background thread polling /proc for a process tree at a fixed interval.
+
+        Every tick records the summed RSS, CPU utilisation since the previous tick (100% = one core),
+        cumulative CPU seconds, thread and process count and the read/write bytes of the live tree.
+        Counters of descendants that already exited are no longer visible, so CPU% and I/O are
+        lower bounds for short-lived helper processes.
+
+            sampler = ProcSampler(interval=0.1)
+            sampler.start(pid)
+            ...
+            sampler.stop()
+            sampler.save("famsa_medium_8.npz")
+    """
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.samples = {column: [] for column in SAMPLE_COLUMNS}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, pid):
+        self.pid = pid
+        self._start = time.perf_counter()
+        self._last_ticks = None
+        self._last_time = self._start
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self._stop.wait(self.interval):
+                break
+
+    def sample(self):
+        now = time.perf_counter()
+        processes = [p for p in map(read_process, process_tree(self.pid)) if p is not None]
+        if not processes:
+            return
+
+        ticks = sum(p["cpu_ticks"] for p in processes)
+        if self._last_ticks is None or now <= self._last_time:
+            cpu_percent = 0.0
+        else:
+            cpu_percent = max(ticks - self._last_ticks, 0) / CLK_TCK / (now - self._last_time) * 100
+        self._last_ticks = ticks
+        self._last_time = now
+
+        self.samples["time"].append(now - self._start)
+        self.samples["rss_mb"].append(sum(p["rss_kb"] for p in processes) / 1024)
+        self.samples["cpu_percent"].append(cpu_percent)
+        self.samples["cpu_seconds"].append(ticks / CLK_TCK)
+        self.samples["threads"].append(sum(p["threads"] for p in processes))
+        self.samples["processes"].append(len(processes))
+        self.samples["read_bytes"].append(sum(p["read_bytes"] for p in processes))
+        self.samples["write_bytes"].append(sum(p["write_bytes"] for p in processes))
+
+    def to_arrays(self):
+        return {
+            "time": np.asarray(self.samples["time"], dtype=np.float64),
+            "rss_mb": np.asarray(self.samples["rss_mb"], dtype=np.float32),
+            "cpu_percent": np.asarray(self.samples["cpu_percent"], dtype=np.float32),
+            "cpu_seconds": np.asarray(self.samples["cpu_seconds"], dtype=np.float32),
+            "threads": np.asarray(self.samples["threads"], dtype=np.int32),
+            "processes": np.asarray(self.samples["processes"], dtype=np.int32),
+            "read_bytes": np.asarray(self.samples["read_bytes"], dtype=np.int64),
+            "write_bytes": np.asarray(self.samples["write_bytes"], dtype=np.int64),
+        }
+
+    def save(self, path):
+        """
+            Write the series as one compressed column per array (numpy .npz).
+            Load with numpy.load(path) or pandas.DataFrame(dict(numpy.load(path))).
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez_compressed(path, **self.to_arrays())
+        return path
+
+    def summary(self):
+        """
+            Per-run aggregates of the series, stored next to the rusage columns
+        """
+        if not self.samples["time"]:
+            return {}
+        return {
+            "mean_cpu_percent": float(np.mean(self.samples["cpu_percent"][1:] or [0.0])),
+            "max_threads": int(max(self.samples["threads"])),
+        }
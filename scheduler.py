@@ -0,0 +1,167 @@
+import os
+import threading
+import pandas as pd
+
+# headroom applied to the peak RSS of earlier runs when reserving memory
+MEMORY_SAFETY = 1.2
+
+
+def available_cores(count=None):
+    """
+        CPUs this process may run on, optionally only the first count of them
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if count is not None:
+        if count > len(cores):
+            raise ValueError(f"core budget of {count} exceeds the {len(cores)} available CPUs")
+        cores = cores[:count]
+    return cores
+
+
+def format_cores(cores):
+    """
+        Compact CPU list, e.g. [0, 1, 2, 3, 8] -> "0-3,8"
+    """
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(f"{lo}-{hi}" if lo != hi else f"{lo}" for lo, hi in ranges)
+
+
+def load_memory_estimates(csv_files):
+    """
+        Largest peak RSS (MB) per (aligner, dataset size) found in earlier MSA-results CSVs
+    """
+    estimates = {}
+    for csv_file in csv_files:
+        df = pd.read_csv(csv_file)
+        for (aligner, dataset_size), peak in df.groupby(["Aligner", "Dataset Size"])["Peak RSS (MB)"].max().items():
+            estimates[(aligner, dataset_size)] = max(peak, estimates.get((aligner, dataset_size), 0))
+    return estimates
+
+
+class CoreScheduler:
+    """
+        Run benchmark jobs concurrently on disjoint CPU sets within a core and memory budget.
+
+        Every job gets as many cores as it has threads (capped at the budget), and its aligner is
+        pinned to them by execing through taskset (resources.run_measured). Jobs are started in
+        order as soon as their cores and estimated memory are free; later jobs may overtake a job
+        that does not fit yet.
+        The memory estimate of a job is MEMORY_SAFETY x the largest peak RSS seen for its
+        (aligner, dataset size), from memory_estimates or from jobs completed in this run. Jobs
+        without an estimate, and exclusive jobs (in-process aligners), only start on an idle host.
+
+        Every job dict needs:
+            aligner, dataset_size, threads: identify the job and its core demand
+            exclusive: run alone (optional)
+        run_job(job, affinity) runs it and returns the stored result row, which is annotated with
+        cores (CPU list), co_tenants (number of other jobs overlapping it) and co_tenant_jobs.
+    """
+    def __init__(self, cores, memory_budget_mb=None, memory_estimates=None):
+        self.cores = sorted(cores)
+        self.memory_budget_mb = memory_budget_mb
+        self.memory_estimates = dict(memory_estimates or {})
+        self._condition = threading.Condition()
+
+    def _memory_needed(self, job):
+        if self.memory_budget_mb is None:
+            return 0
+        peak = self.memory_estimates.get((job["aligner"], job["dataset_size"]))
+        if peak is None:
+            return None
+        return peak * MEMORY_SAFETY
+
+    def _allocate(self, count):
+        count = min(count, len(self.cores))
+        free = [core for core in self.cores if core in self._free]
+        if len(free) < count:
+            return None
+        # prefer a contiguous block of CPU ids
+        for i in range(len(free) - count + 1):
+            if free[i + count - 1] - free[i] == count - 1:
+                return free[i:i + count]
+        return free[:count]
+
+    def _fits(self, job):
+        if job.get("exclusive") and self._running:
+            return None
+        memory = self._memory_needed(job)
+        if memory is None:
+            if self._running:
+                return None
+            # unknown footprint: hold the whole memory budget
+            memory = self.memory_budget_mb
+        if self.memory_budget_mb is not None and self._running and self._reserved_mb + memory > self.memory_budget_mb:
+            return None
+        cores = self._allocate(len(self.cores) if job.get("exclusive") else int(job["threads"]))
+        if cores is None:
+            return None
+        return cores, memory
+
+    def run(self, jobs, run_job, on_done=None):
+        """
+            Run every job, blocking until all finished. Exceptions of a job are re-raised after
+            the jobs already running have completed.
+        """
+        self._free = set(self.cores)
+        self._reserved_mb = 0
+        self._running = {}
+        self._co_tenants = {}
+        pending = list(jobs)
+        errors = []
+        threads = []
+
+        def worker(job_id, job, cores, memory):
+            try:
+                row = run_job(job, cores)
+                with self._condition:
+                    if row is not None:
+                        row["cores"] = format_cores(cores)
+                        row["co_tenants"] = len(self._co_tenants[job_id])
+                        row["co_tenant_jobs"] = ";".join(sorted(self._co_tenants[job_id]))
+                        if "peak_rss_mb" in row:
+                            key = (job["aligner"], job["dataset_size"])
+                            self.memory_estimates[key] = max(row["peak_rss_mb"], self.memory_estimates.get(key, 0))
+                if on_done is not None:
+                    on_done(job, row)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                with self._condition:
+                    self._free.update(cores)
+                    self._reserved_mb -= memory
+                    del self._running[job_id]
+                    self._condition.notify_all()
+
+        with self._condition:
+            while pending and not errors:
+                for position, job in enumerate(pending):
+                    allocation = self._fits(job)
+                    if allocation is not None:
+                        break
+                else:
+                    self._condition.wait()
+                    continue
+
+                pending.pop(position)
+                cores, memory = allocation
+                job_id = f"{job['aligner']}/{job['dataset_size']}/t{job['threads']}#{len(threads)}"
+                self._free.difference_update(cores)
+                self._reserved_mb += memory
+                self._co_tenants[job_id] = set(self._running)
+                for other in self._running:
+                    self._co_tenants[other].add(job_id)
+                self._running[job_id] = job
+
+                thread = threading.Thread(target=worker, args=(job_id, job, cores, memory), daemon=True)
+                threads.append(thread)
+                thread.start()
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
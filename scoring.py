@@ -0,0 +1,132 @@
+import glob
+import os
+import numpy as np
+from util import iter_fasta
+
+GAPS = np.frombuffer(b"-.", dtype=np.uint8)
+
+
+def alignment_matrix(rows):
+    """
+        Stack equally long aligned rows (bytes) into an N x L uint8 matrix, upper-cased
+    """
+    if not rows:
+        return np.zeros((0, 0), dtype=np.uint8)
+    width = len(rows[0])
+    if any(len(row) != width for row in rows):
+        raise ValueError("aligned rows differ in width")
+    return np.frombuffer(b"".join(rows).upper(), dtype=np.uint8).reshape(len(rows), width)
+
+
+def residue_columns(matrix):
+    """
+        Column index of every residue of an alignment matrix.
+
+        output: (row, residue, column) int64 arrays in row-major order, residue counting from 0 per row
+    """
+    residues = ~np.isin(matrix, GAPS)
+    row, column = np.nonzero(residues)
+    residue = np.cumsum(residues, axis=1)[row, column] - 1
+    return row, residue, column
+
+
+def load_references(reference_dir, pattern="*"):
+    """
+        Reference alignments, one family per file of reference_dir.
+
+        output: dict family -> (names, uint8 alignment matrix)
+    """
+    references = {}
+    for reference_file in sorted(glob.glob(os.path.join(reference_dir, pattern))):
+        if not os.path.isfile(reference_file):
+            continue
+        names, rows = [], []
+        for name, row in iter_fasta(reference_file):
+            names.append(name)
+            rows.append(row)
+        if len(names) >= 2:
+            family = os.path.basename(reference_file).split(".")[0]
+            references[family] = (names, alignment_matrix(rows))
+    return references
+
+
+def extract_rows(alignment_file, names):
+    """
+        Stream an alignment (plain or gzip) and keep only the rows of the given names
+    """
+    names = set(names)
+    return {name: row for name, row in iter_fasta(alignment_file) if name in names}
+
+
+def _pair_counts(ref_column, test_column):
+    """
+        Vectorized column-pair counting for one family.
+
+        output: (correct pairs, reference pairs, correct columns, reference columns)
+    """
+    if len(ref_column) == 0:
+        return 0, 0, 0, 0
+    # residues sharing a reference column and a test column are correctly aligned pairs
+    key = ref_column * (int(test_column.max()) + 1) + test_column
+    unique_keys, counts = np.unique(key, return_counts=True)
+    correct_pairs = int(np.sum(counts * (counts - 1) // 2))
+
+    ref_counts = np.bincount(ref_column)
+    reference_pairs = int(np.sum(ref_counts * (ref_counts - 1) // 2))
+
+    # a reference column (with at least two residues) is correct when it maps to one test column
+    split = np.bincount(unique_keys // (int(test_column.max()) + 1), minlength=len(ref_counts))
+    scored = ref_counts >= 2
+    return correct_pairs, reference_pairs, int(np.sum(scored & (split == 1))), int(np.sum(scored))
+
+
+def score_alignment(alignment_file, references):
+    """
+        Sum-of-pairs and total-column scores of a test alignment against reference alignments.
+
+        Only the reference sequences are extracted from the test alignment, streaming, so the cost
+        does not grow with the size of the test alignment beyond one pass over it. Reference
+        sequences missing from the test (e.g. not sampled into a synthetic tier) are skipped, as
+        are families with fewer than two of them and sequences whose residues differ in number.
+
+        output: dict with
+            sp_score: correctly aligned reference residue pairs / reference residue pairs, over all families
+            tc_score: correctly aligned reference columns / reference columns, over all families
+            ref_sequences: reference sequences scored
+            ref_families: reference families scored
+    """
+    wanted = [name for names, _ in references.values() for name in names]
+    test_rows = extract_rows(alignment_file, wanted)
+
+    totals = np.zeros(4, dtype=np.int64)
+    sequences = families = 0
+    for family, (names, ref_matrix) in references.items():
+        keep = [i for i, name in enumerate(names) if name in test_rows]
+        if len(keep) < 2:
+            continue
+        ref_matrix = ref_matrix[keep]
+        test_matrix = alignment_matrix([test_rows[names[i]] for i in keep])
+
+        ref_row, ref_residue, ref_column = residue_columns(ref_matrix)
+        test_row, test_residue, test_column = residue_columns(test_matrix)
+
+        ref_lengths = np.bincount(ref_row, minlength=len(keep))
+        test_lengths = np.bincount(test_row, minlength=len(keep))
+        valid = ref_lengths == test_lengths
+        if valid.sum() < 2:
+            continue
+
+        # both are in row-major residue order, so valid rows line up residue by residue
+        ref_valid = valid[ref_row]
+        test_valid = valid[test_row]
+        totals += _pair_counts(ref_column[ref_valid], test_column[test_valid])
+        sequences += int(valid.sum())
+        families += 1
+
+    correct_pairs, reference_pairs, correct_columns, reference_columns = totals
+    return {
+        "sp_score": float(correct_pairs / reference_pairs) if reference_pairs else np.nan,
+        "tc_score": float(correct_columns / reference_columns) if reference_columns else np.nan,
+        "ref_sequences": sequences,
+        "ref_families": families,
+    }
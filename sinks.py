@@ -0,0 +1,187 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+SINK_MODES = ("disk", "tmpfs", "discard")
+
+# RAM-backed directory used by the tmpfs sink
+TMPFS_DIR = "/dev/shm"
+
+# bytes read per call by the discard drain
+DRAIN_BUFFER = 1 << 20
+
+# seconds between polls of the size of a file output
+POLL_INTERVAL = 0.01
+
+
+class _Drain(threading.Thread):
+    """
+        Read a pipe to its end, keeping only the byte count, a digest and the time of the first and last byte
+    """
+    def __init__(self, fd):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.digest = hashlib.blake2b(digest_size=16)
+
+    def run(self):
+        with os.fdopen(self.fd, "rb", buffering=0) as f:
+            while True:
+                chunk = f.read(DRAIN_BUFFER)
+                if not chunk:
+                    break
+                self.last = time.perf_counter()
+                if self.first is None:
+                    self.first = self.last
+                self.bytes += len(chunk)
+                self.digest.update(chunk)
+
+
+class _FileWatcher(threading.Thread):
+    """
+        Poll the size of an output file to find when its first byte was written
+    """
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.first = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while self.first is None and not self._stopped.wait(POLL_INTERVAL):
+            try:
+                if os.stat(self.path).st_size > 0:
+                    self.first = time.time()
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class OutputSink:
+    """
+        Where the aligners write their alignments, to separate compute cost from output cost.
+
+            disk: the file the benchmark asked for, on whatever storage it is on
+            tmpfs: a file of the same name in a RAM-backed directory (tmpfs_dir), so no storage latency
+            discard: a FIFO drained by a thread that only counts and hashes the bytes; nothing is kept,
+                     so the output cannot be validated or scored
+
+        Every run wrapped by wrap() records output_sink, write_bytes (size of the alignment) and
+        write_time (seconds from the first output byte to the last, i.e. the output phase of the
+        aligner; kept as measured for pyfamsa). The disk sink also records sync_time, the time to
+        fsync the output after the aligner exited, which the page cache hides from Time.
+    """
+    def __init__(self, mode="disk", tmpfs_dir=TMPFS_DIR):
+        if mode not in SINK_MODES:
+            raise ValueError(f"unknown output sink {mode}, expected one of {', '.join(SINK_MODES)}")
+        self.mode = mode
+        self.directory = None
+        if mode == "tmpfs":
+            self.directory = tempfile.mkdtemp(prefix="benchmark-", dir=tmpfs_dir)
+        elif mode == "discard":
+            self.directory = tempfile.mkdtemp(prefix="benchmark-fifo-")
+
+    @property
+    def keeps_output(self):
+        return self.mode != "discard"
+
+    def output_path(self, output_file):
+        """
+            File an aligner asked to write output_file should write instead
+        """
+        if self.mode == "disk":
+            return output_file
+        return os.path.join(self.directory, os.path.basename(output_file))
+
+    @contextlib.contextmanager
+    def target(self, output_file):
+        """
+            Prepare the output of one run.
+
+                with sink.target(output_file) as (path, stats):
+                    ... run the aligner writing to path ...
+                stats["write_bytes"], stats["write_time"]
+        """
+        path = self.output_path(output_file)
+        stats = {"output_sink": self.mode}
+        if self.mode == "discard":
+            if os.path.exists(path):
+                os.unlink(path)
+            os.mkfifo(path)
+            # our own write end keeps the drain from seeing EOF before the aligner opens the FIFO,
+            # and lets it finish when the aligner never does
+            read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(path, os.O_WRONLY)
+            os.set_blocking(read_fd, True)
+            drain = _Drain(read_fd)
+            drain.start()
+            try:
+                yield path, stats
+            finally:
+                os.close(write_fd)
+                drain.join()
+                os.unlink(path)
+            stats["write_bytes"] = drain.bytes
+            stats["write_time"] = drain.last - drain.first if drain.first is not None else 0.0
+            stats["output_digest"] = drain.digest.hexdigest()
+            return
+
+        # a previous trial's output would already have a size, making the launch look like the first write
+        if os.path.exists(path):
+            os.unlink(path)
+        watcher = _FileWatcher(path)
+        watcher.start()
+        try:
+            yield path, stats
+        finally:
+            watcher.stop()
+        if not os.path.exists(path):
+            return
+        stat = os.stat(path)
+        stats["write_bytes"] = stat.st_size
+        stats["write_time"] = max(stat.st_mtime_ns / 1e9 - watcher.first, 0.0) if watcher.first is not None else 0.0
+        if self.mode == "disk":
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+            stats["sync_time"] = time.perf_counter() - start
+
+    def wrap(self, aligner_fn):
+        """
+            aligner_fn with its output redirected to this sink and the sink statistics added to its row
+        """
+        def run(output_file, **kwargs):
+            with self.target(output_file) as (path, stats):
+                row = aligner_fn(output_file=path, **kwargs)
+            for key, value in stats.items():
+                # pyfamsa measures its own write phase
+                if key == "write_time" and key in row:
+                    continue
+                row[key] = value
+            return row
+        run.__name__ = getattr(aligner_fn, "__name__", "aligner")
+        return run
+
+    def release(self, output_file):
+        """
+            Delete the tmpfs copy of output_file once it has been checked, so RAM does not fill up
+            over the grid; disk outputs are the benchmark's own and stay
+        """
+        if self.mode != "tmpfs":
+            return
+        path = self.output_path(output_file)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,227 @@
+import contextlib
+import cProfile
+import functools
+import itertools
+import os
+import re
+import threading
+import time
+import pandas as pd
+from resources import current_rss_mb
+
+# span path -> totals over its calls
+_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+_order = itertools.count()
+_settings = {"enabled": True, "profile": frozenset(), "profile_dir": None}
+
+
+def configure(enabled=True, profile=(), profile_dir=None):
+    """
+        Turn spans on or off, and choose the span names captured with cProfile into
+        {profile_dir}/{span path}-{call}.prof (load with pstats or snakeviz)
+    """
+    _settings["enabled"] = enabled
+    _settings["profile"] = frozenset(profile)
+    _settings["profile_dir"] = profile_dir
+    if profile and profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def _new_totals():
+    return {"order": next(_order), "calls": 0, "wall": 0.0, "cpu": 0.0, "rss_delta": 0.0,
+            "max_rss_delta": float("-inf"), "bytes": 0, "profiles": []}
+
+
+class Span:
+    """
+        An open span; bytes can be added while it runs
+    """
+    def __init__(self, name, nbytes=0):
+        self.name = name
+        self.bytes = nbytes
+
+    def add_bytes(self, nbytes):
+        self.bytes += nbytes
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _start_profiler(name):
+    if name not in _settings["profile"] or _settings["profile_dir"] is None or getattr(_local, "profiling", False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active (one per process from Python 3.12 on)
+        return None
+    _local.profiling = True
+    return profiler
+
+
+@contextlib.contextmanager
+def span(name, nbytes=0):
+    """
+        Time a named region: wall time, CPU time of the process, RSS change and bytes processed.
+
+        Spans nest per thread; a span opened in a thread without open spans is top-level. Totals are
+        kept per path of nested names, see report().
+
+            with span("parse", os.path.getsize(filename)) as s:
+                ...
+                s.add_bytes(written)
+    """
+    record = Span(name, nbytes)
+    if not _settings["enabled"]:
+        yield record
+        return
+
+    stack = _stack()
+    path = tuple(open_span.name for open_span in stack) + (name,)
+    with _lock:
+        if path not in _totals:
+            _totals[path] = _new_totals()
+    stack.append(record)
+    profiler = _start_profiler(name)
+    rss = current_rss_mb()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        rss = current_rss_mb() - rss
+        if profiler is not None:
+            profiler.disable()
+            _local.profiling = False
+        stack.pop()
+        with _lock:
+            totals = _totals[path]
+            totals["calls"] += 1
+            totals["wall"] += wall
+            totals["cpu"] += cpu
+            totals["rss_delta"] += rss
+            totals["max_rss_delta"] = max(totals["max_rss_delta"], rss)
+            totals["bytes"] += record.bytes
+            if profiler is not None:
+                profile_file = os.path.join(_settings["profile_dir"], "{}-{}.prof".format(
+                    re.sub(r"[^\w.-]+", "_", ".".join(path)), totals["calls"]))
+                profiler.dump_stats(profile_file)
+                totals["profiles"].append(profile_file)
+
+
+def spanned(name=None):
+    """
+        Decorator running every call of a function in a span (named after the function by default)
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def run_collected(fn, *args, **kwargs):
+    """
+        Run fn in a worker process with its spans starting afresh (a forked worker inherits the
+        parent's totals and open spans), and hand them back to the parent for merge().
+
+            future = pool.submit(run_collected, fn, *args)
+            result, totals = future.result()
+            merge(totals)
+
+        output: (result of fn, span totals of the call)
+    """
+    reset()
+    _local.stack = []
+    result = fn(*args, **kwargs)
+    with _lock:
+        totals = {path: dict(values) for path, values in _totals.items() if values["calls"]}
+    return result, totals
+
+
+def merge(totals):
+    """
+        Add span totals collected in another process (run_collected) under the spans open in this
+        thread. Workers running side by side can add up to more wall time than the span they ran in.
+    """
+    prefix = tuple(open_span.name for open_span in _stack())
+    with _lock:
+        for path, values in sorted(totals.items(), key=lambda item: item[1]["order"]):
+            full_path = prefix + path
+            if full_path not in _totals:
+                _totals[full_path] = _new_totals()
+            merged = _totals[full_path]
+            for key in ("calls", "wall", "cpu", "rss_delta", "bytes"):
+                merged[key] += values[key]
+            merged["max_rss_delta"] = max(merged["max_rss_delta"], values["max_rss_delta"])
+            merged["profiles"] += values["profiles"]
+
+
+def add_bytes(nbytes):
+    """
+        Add bytes processed to the innermost open span of this thread, if any
+    """
+    stack = _stack()
+    if stack:
+        stack[-1].add_bytes(nbytes)
+
+
+def report():
+    """
+        Totals of every span path, depth first in the order spans were first opened.
+
+        output: dataframe with Span (indented name), Path, Calls, Wall (s), Self Wall (s) (minus the
+                nested spans), CPU (s), CPU / Wall, RSS Delta (MB) (summed over calls), Max RSS Delta (MB),
+                Bytes, MB/s and Profiles
+    """
+    with _lock:
+        totals = {path: dict(values) for path, values in _totals.items() if values["calls"]}
+
+    def sort_key(path):
+        return tuple(totals[path[:i]]["order"] if path[:i] in totals else -1 for i in range(1, len(path) + 1))
+
+    rows = []
+    for path in sorted(totals, key=sort_key):
+        values = totals[path]
+        children = sum(other["wall"] for child, other in totals.items() if len(child) == len(path) + 1 and child[:-1] == path)
+        rows.append({
+            "Span": "  " * (len(path) - 1) + path[-1],
+            "Path": "/".join(path),
+            "Calls": values["calls"],
+            "Wall (s)": values["wall"],
+            "Self Wall (s)": values["wall"] - children,
+            "CPU (s)": values["cpu"],
+            "CPU / Wall": values["cpu"] / values["wall"] if values["wall"] > 0 else float("nan"),
+            "RSS Delta (MB)": values["rss_delta"],
+            "Max RSS Delta (MB)": values["max_rss_delta"],
+            "Bytes": values["bytes"],
+            "MB/s": values["bytes"] / 2**20 / values["wall"] if values["bytes"] and values["wall"] > 0 else float("nan"),
+            "Profiles": " ".join(values["profiles"]),
+        })
+    return pd.DataFrame(rows)
+
+
+def format_report(df):
+    """
+        The report as an indented text tree
+    """
+    if not len(df):
+        return "No spans recorded"
+    columns = ["Span", "Calls", "Wall (s)", "Self Wall (s)", "CPU (s)", "RSS Delta (MB)", "MB/s"]
+    width = int(df["Span"].str.len().max())
+    return df[columns].to_string(index=False, formatters={"Span": lambda name: name.ljust(width)}, float_format="{:.2f}".format)
@@ -0,0 +1,143 @@
+import numpy as np
+from analysis import robust_summary
+from util import save_results
+from scoring import score_alignment
+from colstats import alignment_statistics
+from spans import span
+
+
+def run_trials(aligner_fn, result_dict, trial_samples=None, repeats=1, warmup=0, cv_threshold=0.05, max_repeats=None,
+               aligner=None, previous=None, on_trial=None, **kwargs):
+    """
+        Run one benchmark cell (aligner x dataset size x threads) repeatedly.
+
+        The aligner wrapper is called warmup times without recording, then repeats times. While the
+        coefficient of variation of the wall time stays above cv_threshold, extra trials are run up
+        to max_repeats. The summary row stored in result_dict holds the median of every numeric
+        measurement plus median/IQR/min/bootstrap CI/CV of the wall time; a cell that is still
+        above the threshold is flagged as unstable. A DNF trial (status "timeout" or "oom") ends
+        the cell and its status is kept in the summary.
+
+        input:
+            aligner_fn: one of the aligners.py wrappers
+            result_dict: results the summary row is saved to
+            trial_samples: optional list every raw sample is appended to, as (aligner, dataset_size, trial, row)
+            aligner: name the results are stored under, taken from the wrapper when None
+            previous: rows of trials already measured for this cell (e.g. from a resumed journal);
+                      only the missing trials are run
+            on_trial: optional callback on_trial(trial, row), called as soon as each trial finishes
+            kwargs: forwarded to aligner_fn (input_file, output_file, threads, dataset_size, run options),
+                    together with timeseries_tag ("warmup<i>" or "trial<i>") naming the run's time series
+
+        output: the summary row
+    """
+    max_repeats = max(max_repeats or 3 * repeats, repeats)
+    rows = list(previous or [])
+
+    def finished():
+        # a run stopped by its time or memory limit (DNF) is not repeated
+        if rows and rows[-1].get("status", "ok") != "ok":
+            return True
+        if len(rows) < repeats:
+            return False
+        cv = robust_summary([row["time"] for row in rows])["cv"]
+        return not cv > cv_threshold or len(rows) >= max_repeats
+
+    if not finished():
+        for i in range(warmup):
+            aligner_fn(result_dict={}, timeseries_tag=f"warmup{i}", **kwargs)
+
+        while not finished():
+            scratch = {}
+            row = aligner_fn(result_dict=scratch, timeseries_tag=f"trial{len(rows)}", **kwargs)
+            if aligner is None:
+                (aligner, _), = scratch.items()
+            if on_trial is not None:
+                on_trial(len(rows), row)
+            rows.append(row)
+
+    dataset_size = kwargs["dataset_size"]
+    threads = kwargs["threads"]
+
+    if trial_samples is not None:
+        for trial, row in enumerate(rows):
+            trial_samples.append((aligner, dataset_size, trial, row))
+
+    usage = {}
+    for key, value in rows[-1].items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            usage[key] = float(np.median([row[key] for row in rows]))
+        else:
+            usage[key] = value
+
+    stats = robust_summary([row["time"] for row in rows])
+    usage["time"] = stats["median"]
+    usage["time_iqr"] = stats["iqr"]
+    usage["time_min"] = stats["min"]
+    usage["time_ci_low"] = stats["ci_low"]
+    usage["time_ci_high"] = stats["ci_high"]
+    usage["time_cv"] = stats["cv"]
+    usage["trials"] = len(rows)
+    usage["unstable"] = bool(stats["cv"] > cv_threshold)
+
+    return save_results(result_dict, aligner, usage, dataset_size, threads)
+
+
+def run_cell(job, result_dict, sink=None, validator=None, references=None, column_stats=False, **options):
+    """
+        Run one job of the benchmark grid: its trials, then the checks of its last output. A tmpfs
+        output is deleted after the checks.
+
+        input:
+            job: dict with aligner, label, fn (aligners.py wrapper), input_file, output_file, threads, dataset_size,
+                 and optionally fn_options (extra arguments of fn) and expected_input (the sequences the
+                 output must hold, when they are not all in input_file)
+            sink: optional sinks.OutputSink the aligner writes to
+            validator: optional validate.AlignmentValidator
+            references: optional reference alignments from scoring.load_references
+            column_stats: add the column statistics of the output (colstats.alignment_statistics)
+            options: forwarded to run_trials (trial and run options, previous, on_trial, ...)
+
+        output: the summary row, with validation, SP/TC scores and column statistics when they were computed
+    """
+    aligner_fn = job["fn"] if sink is None else sink.wrap(job["fn"])
+    output_file = job["output_file"] if sink is None else sink.output_path(job["output_file"])
+    keeps_output = sink is None or sink.keeps_output
+    row = run_trials(aligner_fn,
+                     input_file=job["input_file"],
+                     output_file=job["output_file"],
+                     threads=job["threads"],
+                     dataset_size=job["dataset_size"],
+                     result_dict=result_dict,
+                     aligner=job["aligner"],
+                     **job.get("fn_options", {}),
+                     **options)
+
+    try:
+        _check_output(job, row, output_file, keeps_output, validator, references, column_stats)
+    finally:
+        if sink is not None:
+            sink.release(job["output_file"])
+    return row
+
+
+def _check_output(job, row, output_file, keeps_output, validator, references, column_stats):
+    if validator is not None and keeps_output and row.get("status", "ok") == "ok":
+        with span("validate"):
+            row.update(validator.validate(job.get("expected_input", job["input_file"]), output_file))
+        if not row["valid"]:
+            print(f"INVALID output of {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads): {row['validation']}")
+    if references is not None and keeps_output and row.get("status", "ok") == "ok" and row.get("valid", True):
+        try:
+            with span("score"):
+                row.update(score_alignment(output_file, references))
+        except (ValueError, EOFError, OSError) as e:
+            # an unreadable output loses its scores, not the rest of the run
+            row["score_error"] = str(e)
+            print(f"No scores of {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads): {e}")
+    if column_stats and keeps_output and row.get("status", "ok") == "ok" and row.get("valid", True):
+        try:
+            with span("column statistics"):
+                row.update(alignment_statistics(output_file))
+        except (ValueError, EOFError, OSError) as e:
+            print(f"No column statistics of {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads): {e}")
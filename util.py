@@ -1,121 +1,712 @@
+import array
 import glob
+import gzip
+import hashlib
+import io
+import json
+import mmap
 import os
 import random
+import shutil
+import string
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
+from spans import spanned, add_bytes, run_collected, merge as merge_spans
 
 folder_path = os.path.dirname(os.path.realpath(__file__))
 
+EXTHOMFAM_V2_TIERS = ["small", "medium", "large", "xlarge"]
+
+# bytes per chunk when hashing / copying without sendfile
+COPY_BUFFER = 1 << 20
+
+def _fasta_sources(input_dir):
+  # sorted so the concatenation does not depend on directory order
+  return sorted(f for f in glob.glob(f"{input_dir}/*") if os.path.isfile(f))
+
+def _source_entries(sources):
+  entries = []
+  for source in sources:
+    stat = os.stat(source)
+    entries.append({"path": os.path.abspath(source), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+  return entries
+
+def _copy_file(infile, outfile):
+  size = os.fstat(infile.fileno()).st_size
+  try:
+    offset = 0
+    while offset < size:
+      sent = os.sendfile(outfile.fileno(), infile.fileno(), offset, size - offset)
+      if sent == 0:
+        break
+      offset += sent
+  except (AttributeError, OSError):
+    infile.seek(0)
+    outfile.seek(0, os.SEEK_END)
+    shutil.copyfileobj(infile, outfile, COPY_BUFFER)
+  return size
+
+@spanned()
+def hash_fasta(filename):
+  """
+      Stream a fasta file once, with a bounded buffer.
+
+      output: (sha256 hex digest of the decompressed content, number of records)
+  """
+  digest = hashlib.sha256()
+  count = 0
+  previous = b"\n"
+  with open_fasta_read(filename) as f:
+    for chunk in iter(lambda: f.read(COPY_BUFFER), b""):
+      digest.update(chunk)
+      add_bytes(len(chunk))
+      count += chunk.count(b"\n>") + (previous == b"\n" and chunk[:1] == b">")
+      previous = chunk[-1:]
+  return digest.hexdigest(), count
+
+def manifest_path(output_file):
+  return f"{output_file}.manifest.json"
+
+def is_up_to_date(output_file, sources):
+  """
+      True if output_file was completely built from exactly these sources (same paths, sizes and mtimes)
+      and has not been modified since. Manifests without source offsets predate family labels and
+      are rebuilt.
+  """
+  if not os.path.exists(output_file) or not os.path.exists(manifest_path(output_file)):
+    return False
+  with open(manifest_path(output_file)) as f:
+    manifest = json.load(f)
+  stat = os.stat(output_file)
+  return ("source_offsets" in manifest
+          and manifest["sources"] == _source_entries(sources)
+          and manifest["size"] == stat.st_size
+          and manifest["mtime_ns"] == stat.st_mtime_ns)
+
+@spanned()
 def concat_fasta(input_file, output_file):
-  with open(output_file, 'w') as outfile:
-    for file in glob.glob(f"{input_file}/*"):
-      with open(file) as infile:
-        outfile.write(infile.read())
+  """
+      Concatenate every fasta file of the directory input_file into output_file.
+
+      The sources are copied in sorted order with os.sendfile into {output_file}.partial, which is renamed
+      over output_file only once complete, so a crash never leaves a half-written dataset behind. A
+      manifest ({output_file}.manifest.json) records the sources (path, size, mtime), the offset each
+      source starts at in the output, the sequence count and the sha256 of the result.
+
+      Compressed sources are decompressed on the fly, and output_file is compressed when its name ends
+      in .gz, .zst or .bgz; both stream through bounded buffers instead of sendfile.
+
+      output: the manifest
+  """
+  sources = _fasta_sources(input_file)
+  partial = f"{output_file}.partial"
+  compression = compression_from_name(output_file)
+  # uncompressed byte offset where each source starts, to tell the family of every record
+  source_offsets = []
+  position = 0
+  if compression is None and not any(fasta_compression(file) for file in sources):
+    with open(partial, 'wb') as outfile:
+      for file in sources:
+        source_offsets.append(position)
+        with open(file, 'rb') as infile:
+          size = _copy_file(infile, outfile)
+          position += size
+          # keep records of consecutive files apart
+          if size and os.pread(infile.fileno(), 1, size - 1) != b"\n":
+            outfile.write(b"\n")
+            outfile.flush()
+            position += 1
+      outfile.flush()
+      os.fsync(outfile.fileno())
+  else:
+    with open_fasta_write(partial, compression) as outfile:
+      last = b"\n"
+      for file in sources:
+        if last != b"\n":
+          outfile.write(b"\n")
+          position += 1
+        source_offsets.append(position)
+        with open_fasta_read(file) as infile:
+          for chunk in iter(lambda: infile.read(COPY_BUFFER), b""):
+            outfile.write(chunk)
+            position += len(chunk)
+            last = chunk[-1:]
+
+  add_bytes(position)
+  content_hash, count = hash_fasta(partial)
+  os.replace(partial, output_file)
+  stat = os.stat(output_file)
+  manifest = {
+    "sources": _source_entries(sources),
+    "source_offsets": source_offsets,
+    "sequences": count,
+    "sha256": content_hash,
+    "size": stat.st_size,
+    "mtime_ns": stat.st_mtime_ns,
+  }
+  with open(manifest_path(output_file), "w") as f:
+    json.dump(manifest, f, indent=2)
+  return manifest
+
+def current_manifest(output_file):
+  """
+      Manifest of a dataset if it still matches the file (size and mtime), otherwise the file is
+      hashed and gets a new manifest with its sequence count, sha256, size and mtime.
+
+      Datasets not built by concat_fasta (sampled, synthetic, stratified, incremental) are hashed
+      once this way, so later calls are cheap.
+  """
+  stat = os.stat(output_file)
+  if os.path.exists(manifest_path(output_file)):
+    with open(manifest_path(output_file)) as f:
+      manifest = json.load(f)
+    if manifest.get("size") == stat.st_size and manifest.get("mtime_ns") == stat.st_mtime_ns:
+      return manifest
+  content_hash, count = hash_fasta(output_file)
+  manifest = {"sequences": count, "sha256": content_hash, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+  try:
+    with open(manifest_path(output_file), "w") as f:
+      json.dump(manifest, f, indent=2)
+  except OSError:
+    # read-only dataset directory, hash again next time
+    pass
+  return manifest
+
+def remove_manifest(output_file):
+  # for files rewritten outside concat_fasta
+  if os.path.exists(manifest_path(output_file)):
+    os.unlink(manifest_path(output_file))
+
+def dataset_hash(output_file):
+  """
+      sha256 of a dataset (see current_manifest), None if the file does not exist
+  """
+  if not os.path.exists(output_file):
+    return None
+  return current_manifest(output_file)["sha256"]
+
+@spanned()
+def count_sequences(filename):
+  """
+      Number of records of a fasta file, from its manifest when it still matches the file
+  """
+  return current_manifest(filename)["sequences"]
+
+@spanned()
+def compress_fasta(filename, compression="gzip"):
+  """
+      Compressed copy of a fasta file next to it, rebuilt only when the original is newer.
+
+      output: path of the compressed copy
+  """
+  output_file = f"{filename}{COMPRESSION_EXTENSIONS[compression]}"
+  if os.path.exists(output_file) and os.stat(output_file).st_mtime_ns >= os.stat(filename).st_mtime_ns:
+    return output_file
+  partial = f"{output_file}.partial"
+  with open(filename, "rb") as infile, open_fasta_write(partial, compression) as outfile:
+    for chunk in iter(lambda: infile.read(COPY_BUFFER), b""):
+      outfile.write(chunk)
+      add_bytes(len(chunk))
+  os.replace(partial, output_file)
+  return output_file
+
+@spanned()
+def build_datasets(jobs, processes=None):
+  """
+      Rebuild the concatenated datasets whose sources changed, in parallel processes.
+
+      input:
+          jobs: dict output_file -> source directory
+          processes: worker processes (default: one per stale dataset)
+
+      output: list of rebuilt output files
+  """
+  stale = {}
+  for output_file, input_dir in jobs.items():
+    if not os.path.isdir(input_dir):
+      if not os.path.exists(output_file):
+        raise FileNotFoundError(f"{input_dir} not found; download extHomFam-v2 first (see README)")
+      # sources were removed after a previous build, keep what is there
+      continue
+    if not is_up_to_date(output_file, _fasta_sources(input_dir)):
+      stale[output_file] = input_dir
+
+  if not stale:
+    return []
 
-def prepare_extHomFam_v2(all=False):
-    check_list = ["extHomFam-v2-small.fasta", "extHomFam-v2-medium.fasta", "extHomFam-v2-large.fasta", "extHomFam-v2-xlarge.fasta"]
+  with ProcessPoolExecutor(max_workers=processes or len(stale)) as pool:
+    # the workers' spans (concat_fasta, hash_fasta, ...) come back with their results
+    futures = {pool.submit(run_collected, concat_fasta, input_dir, output_file): output_file for output_file, input_dir in stale.items()}
+    for future in as_completed(futures):
+      manifest, totals = future.result()
+      merge_spans(totals)
+      print(f"Built {futures[future]} ({manifest['sequences']} sequences)")
+  return list(stale)
+
+@spanned()
+def prepare_extHomFam_v2(all=False, compression=None, tiers=None):
     # https://zenodo.org/records/6524237
-    if all and all([os.path.exists(f"{folder_path}/{check_list[i]}") for i in range(4)]):
-        return {
-            "small": f"{folder_path}/extHomFam-v2-small.fasta",
-            "medium": f"{folder_path}/extHomFam-v2-medium.fasta",
-            "large": f"{folder_path}/extHomFam-v2-large.fasta",
-            "xlarge": f"{folder_path}/extHomFam-v2-xlarge.fasta"
-            }
-    elif os.path.exists(f"{folder_path}/{check_list[1]}"):
-        return {
-            "medium": f"{folder_path}/extHomFam-v2-medium.fasta"
-            }
+    # tiers picks the tiers to build (e.g. ["xlarge"]); otherwise every tier with all, else medium
+    if tiers is None:
+        tiers = EXTHOMFAM_V2_TIERS if all else ["medium"]
+    extension = COMPRESSION_EXTENSIONS[compression] if compression else ""
+    datasets = {tier: f"{folder_path}/extHomFam-v2-{tier}.fasta{extension}" for tier in tiers}
+    build_datasets({datasets[tier]: f"{folder_path}/extHomFam-v2/{tier}" for tier in tiers})
+    return datasets
+        
+
+# Synthetic tiers cut from extHomFam-v2 medium: name -> number of sequences
+SYNTHETIC_SIZES = {"xsmall": 50000, "small": 100000, "medium": 250000, "large": 500000}
+
+@spanned()
+def index_fasta(filename, rebuild=False):
+    """
+        .fai-style byte-offset index of a fasta file, built once and stored as {filename}.idx.npz
+
+        The index is rebuilt when the fasta file's size or mtime changes.
+
+        output: dict of numpy arrays
+            offsets: byte offset of each record's ">"
+            sizes: bytes of each record, header and line breaks included
+            lengths: residues of each record
+    """
+    if fasta_compression(filename):
+        raise ValueError(f"{filename} is compressed, byte offsets need an uncompressed file")
+    index_file = f"{filename}.idx.npz"
+    stat = os.stat(filename)
+    if not rebuild and os.path.exists(index_file):
+        with np.load(index_file) as index:
+            if int(index["source_size"]) == stat.st_size and int(index["source_mtime_ns"]) == stat.st_mtime_ns:
+                return {key: index[key] for key in ("offsets", "sizes", "lengths")}
+
+    add_bytes(stat.st_size)
+    offsets = array.array("q")
+    sizes = array.array("q")
+    lengths = array.array("q")
+    if stat.st_size > 0:
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            start = mm.find(b">")
+            while start != -1:
+                end = mm.find(b"\n>", start)
+                end = size if end == -1 else end + 1
+                header_end = mm.find(b"\n", start, end)
+                header_end = end if header_end == -1 else header_end
+                offsets.append(start)
+                sizes.append(end - start)
+                lengths.append(len(mm[header_end:end].translate(None, _WHITESPACE)))
+                start = end if end < size else -1
+
+    index = {
+        "offsets": np.frombuffer(offsets, dtype=np.int64),
+        "sizes": np.frombuffer(sizes, dtype=np.int64),
+        "lengths": np.frombuffer(lengths, dtype=np.int64),
+    }
+    np.savez(index_file, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns, **index)
+    return index
+
+def copy_records(filename, index, records, outfile):
+    """
+        Copy records (positions in the index) from filename to an open binary outfile by seeking,
+        so memory stays bounded by the largest record.
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        for i in records:
+            record = os.pread(fd, int(index["sizes"][i]), int(index["offsets"][i]))
+            outfile.write(record)
+            if not record.endswith(b"\n"):
+                outfile.write(b"\n")
+    finally:
+        os.close(fd)
+
+def _sample_fasta_streaming(filename, outputs, seed, compression):
+    """
+        sample_fasta for compressed sources: two streaming passes, records written in file order
+    """
+    total = sum(1 for _ in iter_fasta(filename))
+    order = np.random.default_rng(seed).permutation(total)
+    # output each record goes to, -1 for none
+    assignment = np.full(total, -1, dtype=np.int32)
+    written = []
+    position = 0
+    for output, (_, count) in enumerate(outputs):
+        records = order[position:position + count]
+        position += len(records)
+        assignment[records] = output
+        written.append(len(records))
+
+    handles = [open_fasta_write(output_file, compression) for output_file, _ in outputs]
+    try:
+        for i, (name, seq) in enumerate(iter_fasta(filename, full_name=True)):
+            if assignment[i] >= 0:
+                handles[assignment[i]].write(b">%s\n%s\n" % (name, seq))
+    finally:
+        for handle in handles:
+            handle.close()
+    return written
+
+@spanned()
+def sample_fasta(filename, outputs, seed=0, shuffle=True, compression=None):
+    """
+        Draw disjoint random subsets of a fasta file without loading it.
+
+        input:
+            filename: source fasta file, indexed with index_fasta
+            outputs: list of (output_file, number of sequences); subsets are consecutive slices of one
+                     seeded permutation, so they never share a record
+            seed: RNG seed
+            shuffle: keep the sampled order; if False records are written in file order (sequential reads)
+            compression: compress the outputs ("gzip", "zstd", "bgzf"), by default from their extension
 
+        A compressed source cannot be seeked into; it is streamed twice instead and the records are
+        written in file order.
+
+        output: list of the number of sequences written to each output
+    """
+    if fasta_compression(filename):
+        return _sample_fasta_streaming(filename, outputs, seed, compression)
+
+    index = index_fasta(filename)
+    order = np.random.default_rng(seed).permutation(len(index["offsets"]))
+
+    written = []
+    position = 0
+    for output_file, count in outputs:
+        records = order[position:position + count]
+        position += len(records)
+        if not shuffle:
+            records = np.sort(records)
+        remove_manifest(output_file)
+        with open_fasta_write(output_file, compression) as outfile:
+            copy_records(filename, index, records, outfile)
+        add_bytes(int(index["sizes"][records].sum()))
+        written.append(len(records))
+    return written
+
+@spanned()
+def create_synthetic_dataset(extHomFam_v2, sizes=None, seed=0, compression=None):
+  """
+      Cut disjoint random tiers out of extHomFam-v2 medium.
+
+      input:
+          extHomFam_v2: datasets returned by prepare_extHomFam_v2
+          sizes: dict tier name -> number of sequences, SYNTHETIC_SIZES by default
+          seed: RNG seed; the seed, sizes and source hash are stored in mini-extHomFam-v2.json and the
+                tiers are rebuilt when any of them changes
+          compression: write the tiers compressed ("gzip", "zstd" or "bgzf")
+
+      output: dict tier name -> fasta file
+  """
+  sizes = dict(SYNTHETIC_SIZES if sizes is None else sizes)
+  extension = COMPRESSION_EXTENSIONS[compression] if compression else ""
+  output = {tier: f"{folder_path}/mini-extHomFam-v2-{tier}.fasta{extension}" for tier in sizes}
+  spec_file = f"{folder_path}/mini-extHomFam-v2.json"
+  spec = {"source": os.path.basename(extHomFam_v2["medium"]), "source_sha256": dataset_hash(extHomFam_v2["medium"]), "seed": seed, "sizes": sizes, "compression": compression}
+
+  # check if all output files exist and were cut with the same spec
+  if all([os.path.exists(output[key]) for key in output.keys()]) and os.path.exists(spec_file):
+    with open(spec_file) as f:
+      if json.load(f) == spec:
+        return output
+
+  total = count_sequences(extHomFam_v2["medium"])
+  if sum(sizes.values()) > total:
+    print(f"WARNING: {sum(sizes.values())} sequences requested but {extHomFam_v2['medium']} has {total}, the last tiers will be smaller")
+
+  for tier, count in zip(sizes, sample_fasta(extHomFam_v2["medium"], [(output[tier], sizes[tier]) for tier in sizes], seed=seed, compression=compression)):
+    print(f"Created {tier.upper()} dataset with {count} sequences")
+
+  with open(spec_file, "w") as f:
+    json.dump(spec, f, indent=2)
+
+  return output
+
+# Stratified grids cut from one extHomFam-v2 tier, all with the same number of sequences
+STRATIFIED_FAMILY_COUNTS = [10, 100, 1000]
+STRATIFIED_ORDERS = ["shuffled", "ascending", "descending"]
+# length strata, as quantile ranges of the source's sequence lengths
+STRATIFIED_LENGTH_QUANTILES = {"q1": (0, 0.25), "q2": (0.25, 0.5), "q3": (0.5, 0.75), "q4": (0.75, 1)}
+
+@spanned()
+def record_strata(filename, rebuild=False):
+    """
+        Length and family of every record of a concatenated dataset, computed once and stored as
+        {filename}.strata.npz next to its index.
+
+        The family of a record is the source file it was concatenated from, found from the source
+        offsets of the manifest.
+
+        output: dict of numpy arrays
+            lengths: residues of each record (as in index_fasta)
+            families: family id of each record
+            family_names: name of each family id
+    """
+    strata_file = f"{filename}.strata.npz"
+    stat = os.stat(filename)
+    if not rebuild and os.path.exists(strata_file):
+        with np.load(strata_file) as strata:
+            if int(strata["source_size"]) == stat.st_size and int(strata["source_mtime_ns"]) == stat.st_mtime_ns:
+                return {key: strata[key] for key in ("lengths", "families", "family_names")}
+
+    if not os.path.exists(manifest_path(filename)):
+        raise ValueError(f"{filename} has no manifest, family labels need a dataset built by concat_fasta")
+    with open(manifest_path(filename)) as f:
+        manifest = json.load(f)
+    if "source_offsets" not in manifest:
+        raise ValueError(f"the manifest of {filename} has no source offsets, rebuild it with build_datasets")
+
+    index = index_fasta(filename)
+    starts = np.asarray(manifest["source_offsets"], dtype=np.int64)
+    strata = {
+        "lengths": index["lengths"],
+        "families": (np.searchsorted(starts, index["offsets"], side="right") - 1).astype(np.int32),
+        "family_names": np.array([os.path.basename(source["path"]).split(".")[0] for source in manifest["sources"]]),
+    }
+    np.savez(strata_file, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns, **strata)
+    return strata
+
+def _family_quotas(family_sizes, count):
+    # spread count as evenly as possible over families, moving what small families cannot take to the others
+    quotas = np.zeros(len(family_sizes), dtype=np.int64)
+    remaining = count
+    open_families = np.flatnonzero(family_sizes > 0)
+    while remaining > 0 and len(open_families):
+        share = np.full(len(open_families), remaining // len(open_families))
+        share[:remaining % len(open_families)] += 1
+        take = np.minimum(share, family_sizes[open_families] - quotas[open_families])
+        quotas[open_families] += take
+        remaining -= int(take.sum())
+        open_families = open_families[quotas[open_families] < family_sizes[open_families]]
+    return quotas
+
+def stratified_records(strata, count, seed=0, length_range=None, families=None, order="shuffled"):
+    """
+        Draw record ids from a record_strata index.
+
+        input:
+            count: number of records
+            length_range: (min, max) residues, max inclusive, to draw only from that length stratum
+            families: number of families to draw from; families are picked at random among those with
+                      at least two records and count is spread evenly over them
+            order: "shuffled", or "ascending" / "descending" by length
+
+        output: numpy array of record ids in output order
+    """
+    rng = np.random.default_rng(seed)
+    eligible = np.ones(len(strata["lengths"]), dtype=bool)
+    if length_range is not None:
+        eligible &= (strata["lengths"] >= length_range[0]) & (strata["lengths"] <= length_range[1])
+
+    if families is None:
+        candidates = np.flatnonzero(eligible)
+        records = rng.choice(candidates, size=min(count, len(candidates)), replace=False)
     else:
-        if all:
-            concat_fasta(f"{folder_path}/extHomFam-v2/small", f"{folder_path}/extHomFam-v2-small.fasta")
-            concat_fasta(f"{folder_path}/extHomFam-v2/medium", f"{folder_path}/extHomFam-v2-medium.fasta")
-            concat_fasta(f"{folder_path}/extHomFam-v2/large", f"{folder_path}/extHomFam-v2-large.fasta")
-            concat_fasta(f"{folder_path}/extHomFam-v2/xlarge", f"{folder_path}/extHomFam-v2-xlarge.fasta")
-
-            return {
-            "small": f"{folder_path}/extHomFam-v2-small.fasta",
-            "medium": f"{folder_path}/extHomFam-v2-medium.fasta",
-            "large": f"{folder_path}/extHomFam-v2-large.fasta",
-            "xlarge": f"{folder_path}/extHomFam-v2-xlarge.fasta"
-            }
+        family_sizes = np.bincount(strata["families"][eligible], minlength=len(strata["family_names"]))
+        chosen = rng.permutation(np.flatnonzero(family_sizes >= 2))[:families]
+        quotas = _family_quotas(family_sizes[chosen], count)
+        records = np.concatenate([rng.choice(np.flatnonzero(eligible & (strata["families"] == family)), size=quota, replace=False)
+                                  for family, quota in zip(chosen, quotas)] or [np.zeros(0, dtype=np.int64)])
 
-        else:
-            concat_fasta(f"{folder_path}/extHomFam-v2/medium", f"{folder_path}/extHomFam-v2-medium.fasta")
+    if order == "shuffled":
+        return rng.permutation(records)
+    records = records[np.argsort(strata["lengths"][records], kind="stable")]
+    return records[::-1] if order == "descending" else records
 
-            return {"medium": f"{folder_path}/extHomFam-v2-medium.fasta"}
-        
+@spanned()
+def create_stratified_datasets(source, count=50000, seed=0, family_counts=None, orders=None, length_quantiles=None):
+    """
+        Controlled grids of datasets with the same number of sequences, cut from one extHomFam-v2 tier:
+            length-<stratum>: records from one length quantile range (STRATIFIED_LENGTH_QUANTILES)
+            families-<k>: records spread evenly over k random families (STRATIFIED_FAMILY_COUNTS)
+            order-<order>: one random draw, shuffled or sorted by length (STRATIFIED_ORDERS)
 
-def create_synthetic_dataset(extHomFam_v2):
-  output = {
-    "xsmall": f"{folder_path}/mini-extHomFam-v2-xsmall.fasta",
-    "small": f"{folder_path}/mini-extHomFam-v2-small.fasta", 
-    "medium": f"{folder_path}/mini-extHomFam-v2-medium.fasta", 
-    "large": f"{folder_path}/mini-extHomFam-v2-large.fasta"}
+        Every dataset is written to stratified-extHomFam-v2/ with its sampling spec (source and its
+        sha256, seed, criteria, number of records written) in {dataset}.spec.json, and is rebuilt only
+        when the spec changes. Lengths and families come from record_strata, so drawing is a NumPy
+        selection and writing seeks straight to the chosen records.
 
-  # check if all output files exist
-  if all([os.path.exists(output[key]) for key in output.keys()]):
-    return output
-  else:
-    sequences = []
-    for name, seq in zip(*parse_fasta(extHomFam_v2["medium"], return_names=True, clean=None, full_name=False)):
-      sequences.append((name,seq))
-    random.shuffle(sequences)
-
-    base_size = 50000
-    mini_extHomFam_v2_xsmall = sequences[:base_size] # 50,000
-    mini_extHomFam_v2_small = sequences[base_size:base_size+100000] # 100,000
-    mini_extHomFam_v2_medium = sequences[base_size+100000:base_size+350000] # 250,000
-    mini_extHomFam_v2_large = sequences[base_size+350000:base_size+850000] # 500,000
-
-    with open(f"{folder_path}/mini-extHomFam-v2-xsmall.fasta", "w") as xsmall, open(f"{folder_path}/mini-extHomFam-v2-small.fasta", "w") as small, open(f"{folder_path}/mini-extHomFam-v2-medium.fasta", "w") as medium, open(f"{folder_path}/mini-extHomFam-v2-large.fasta", "w") as large:
-            print(f"Creating XSMALL dataset with {len(mini_extHomFam_v2_xsmall)} sequences")
-            for name, seq in mini_extHomFam_v2_xsmall:
-                    print(f">{name}\n{seq}", file=xsmall)
-            
-            print(f"Creating SMALL dataset with {len(mini_extHomFam_v2_small)} sequences")
-            for name, seq in mini_extHomFam_v2_small:
-                    print(f">{name}\n{seq}", file=small)
-
-            print(f"Creating MEDIUM dataset with {len(mini_extHomFam_v2_medium)} sequences")
-            for name, seq in mini_extHomFam_v2_medium:
-                    print(f">{name}\n{seq}", file=medium)
-            
-            print(f"Creating LARGE dataset with {len(mini_extHomFam_v2_large)} sequences")
-            for name, seq in mini_extHomFam_v2_large:
-                    print(f">{name}\n{seq}", file=large)
-    
+        output: dict dataset name -> fasta file
+    """
+    family_counts = STRATIFIED_FAMILY_COUNTS if family_counts is None else family_counts
+    orders = STRATIFIED_ORDERS if orders is None else orders
+    length_quantiles = STRATIFIED_LENGTH_QUANTILES if length_quantiles is None else length_quantiles
+
+    strata = record_strata(source)
+    lengths = strata["lengths"]
+    grid = {}
+    for name, (low, high) in length_quantiles.items():
+        length_range = [int(np.quantile(lengths, low)), int(np.quantile(lengths, high))]
+        grid[f"length-{name}"] = {"length_range": length_range, "quantiles": [low, high]}
+    for families in family_counts:
+        grid[f"families-{families}"] = {"families": int(families)}
+    for order in orders:
+        grid[f"order-{order}"] = {"order": order}
+
+    output_dir = f"{folder_path}/stratified-extHomFam-v2"
+    os.makedirs(output_dir, exist_ok=True)
+    source_hash = dataset_hash(source)
+    index = index_fasta(source)
+    output = {}
+    for name, criteria in grid.items():
+        output_file = f"{output_dir}/{name}-{count}.fasta"
+        spec = {"source": os.path.basename(source), "source_sha256": source_hash, "seed": seed, "count": count, **criteria}
+        spec_file = f"{output_file}.spec.json"
+        output[name] = output_file
+        if os.path.exists(output_file) and os.path.exists(spec_file):
+            with open(spec_file) as f:
+                if {key: value for key, value in json.load(f).items() if key != "written"} == spec:
+                    continue
+
+        records = stratified_records(strata, count, seed=seed, length_range=criteria.get("length_range"),
+                                     families=criteria.get("families"), order=criteria.get("order", "shuffled"))
+        partial = f"{output_file}.partial"
+        with open(partial, "wb") as outfile:
+            copy_records(source, index, records, outfile)
+        remove_manifest(output_file)
+        os.replace(partial, output_file)
+        if len(records) < count:
+            print(f"WARNING: {name} has only {len(records)} of the {count} sequences requested")
+        with open(spec_file, "w") as f:
+            json.dump({**spec, "written": len(records)}, f, indent=2)
+        print(f"Created stratified dataset {name} with {len(records)} sequences")
     return output
                 
-def save_results(result_dict, aligner, current, peak, diff, time, dataset_size, threads):
-    if aligner not in result_dict:
-        result_dict[aligner] = {}
-
-    result_dict[aligner][dataset_size] = {
-        "current": current,
-        "peak": peak,
-        "usage": diff,
-        "time": time,
-        "threads": threads
-    }
+# CSV column for each measurement, in output order. Optional measurements only appear when recorded.
+RESULT_COLUMNS = {
+    "status": "Status",
+    "peak_rss_mb": "Peak RSS (MB)",
+    "user_time": "User CPU (s)",
+    "system_time": "System CPU (s)",
+    "minor_faults": "Minor Faults",
+    "major_faults": "Major Faults",
+    "voluntary_switches": "Voluntary Switches",
+    "involuntary_switches": "Involuntary Switches",
+    "time": "Time",
+    "time_iqr": "Time IQR",
+    "time_min": "Time Min",
+    "time_ci_low": "Time CI Low",
+    "time_ci_high": "Time CI High",
+    "time_cv": "Time CV",
+    "trials": "Trials",
+    "unstable": "Unstable",
+    "threads": "Threads",
+    "parse_time": "Parse (s)",
+    "sequence_time": "Sequence Objects (s)",
+    "tree_time": "Guide Tree (s)",
+    "align_time": "Align (s)",
+    "write_time": "Write (s)",
+    "write_bytes": "Write Bytes",
+    "sync_time": "Sync (s)",
+    "output_sink": "Output Sink",
+    "output_digest": "Output Digest",
+    "dedup_time": "Dedup (s)",
+    "expand_time": "Expand (s)",
+    "dedup_rss_mb": "Dedup RSS (MB)",
+    "unique_sequences": "Unique Sequences",
+    "dedup_ratio": "Dedup Ratio",
+    "clusters": "Clusters",
+    "max_cluster_size": "Max Cluster Size",
+    "sketch_time": "Sketch (s)",
+    "cluster_align_time": "Cluster Align (s)",
+    "merge_time": "Merge (s)",
+    "valid": "Valid",
+    "validation": "Validation",
+    "sp_score": "SP Score",
+    "tc_score": "TC Score",
+    "score_error": "Score Error",
+    "ref_sequences": "Reference Sequences",
+    "ref_families": "Reference Families",
+    "aln_columns": "Columns",
+    "gap_fraction": "Gap Fraction",
+    "mean_entropy": "Mean Entropy (bits)",
+    "trimmed_columns": "Trimmed Columns",
+    "cores": "Cores",
+    "co_tenants": "Co-tenants",
+    "co_tenant_jobs": "Co-tenant Jobs",
+    "mean_cpu_percent": "Mean CPU (%)",
+    "max_threads": "Max Threads",
+    "timeseries": "Time Series",
+}
+
+def parse_thread_list(spec):
+    """
+        Parse a --threads value into a sorted list of unique thread counts.
 
-    return result_dict
+        input:
+            spec: comma separated integers and inclusive ranges "lo-hi" or "lo-hi:step",
+                  e.g. "8", "1,2,4,8,16,32,64,128", "1-8", "8-128:8"
+
+        output: list of ints
+    """
+    threads = set()
+    for part in str(spec).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            bounds, _, step = part.partition(":")
+            lo, hi = bounds.split("-", 1)
+            threads.update(range(int(lo), int(hi) + 1, int(step) if step else 1))
+        else:
+            threads.add(int(part))
+
+    if not threads or min(threads) < 1:
+        raise ValueError(f"invalid thread specification: {spec}")
+    return sorted(threads)
+
+def save_results(result_dict, aligner, usage, dataset_size, threads):
+    """
+        Store the resource usage of one aligner run.
+
+        input:
+            usage: dict returned by resources.run_measured / resources.measure_self
+                   (wall time in minutes, peak RSS in MB, CPU times in seconds, ...)
+
+        output: the stored row
+    """
+    row = dict(usage)
+    row["threads"] = int(threads)
+    # setdefault keeps concurrent jobs from replacing each other's aligner entry
+    result_dict.setdefault(aligner, {})[(dataset_size, int(threads))] = row
+
+    return row
 
 
 def dict_to_dataframe(result_dict):
     data = []
 
-    for aligner, dataset_sizes in result_dict.items():
-        for dataset_size, values in dataset_sizes.items():
-            row = [aligner, dataset_size] + list(values.values())
+    for aligner, cells in result_dict.items():
+        for (dataset_size, _), values in cells.items():
+            row = {'Aligner': aligner, 'Dataset Size': dataset_size}
+            for key, value in values.items():
+                row[RESULT_COLUMNS.get(key, key)] = value
             data.append(row)
     
-    columns = ['Aligner', 'Dataset Size', 'Current', 'Peak', 'Usage', 'Time', 'Threads']
+    columns = ['Aligner', 'Dataset Size'] + list(RESULT_COLUMNS.values())
     
-    df = pd.DataFrame(data, columns=columns)
+    df = pd.DataFrame(data)
+    df = df[[c for c in columns if c in df.columns] + [c for c in df.columns if c not in columns]]
     
     return df
     
+def samples_to_dataframe(trial_samples):
+    """
+        Raw per-trial measurements, as collected by trials.run_trials
+    """
+    data = []
+
+    for aligner, dataset_size, trial, values in trial_samples:
+        row = {'Aligner': aligner, 'Dataset Size': dataset_size, 'Trial': trial}
+        for key, value in values.items():
+            row[RESULT_COLUMNS.get(key, key)] = value
+        data.append(row)
+
+    return pd.DataFrame(data)
+
 def _open_if_is_name(filename_or_handle, mode="r"):
     """
         if a file handle is passed, return the file handle
@@ -136,6 +727,285 @@ def _open_if_is_name(filename_or_handle, mode="r"):
 
     return (out, input_type)
 
+# standard amino acids, used to resolve ambiguity codes when clean='unalign'
+ESM_ALLOWED_AMINO_ACIDS = "LAGVSERTIDPKQNFYMHWC"
+
+_WHITESPACE = b" \t\r\n\v\f"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# file extension of each supported compression; bgzf is gzip-compatible blocked gzip
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "bgzf": ".bgz"}
+
+# external tools that (de)compress in their own process, in order of preference
+DECOMPRESSORS = {"gzip": [["pigz", "-dc"], ["gzip", "-dc"]], "zstd": [["zstd", "-dcq"]]}
+COMPRESSORS = {"gzip": [["pigz", "-c"], ["gzip", "-c"]], "zstd": [["zstd", "-cq"]], "bgzf": [["bgzip", "-c"]]}
+
+def fasta_compression(filename):
+    """
+        Compression of a file from its magic bytes: "gzip" (also bgzf), "zstd" or None
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == GZIP_MAGIC:
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+def compression_from_name(filename):
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if str(filename).endswith(extension):
+            return compression
+    return None
+
+def _tool(candidates):
+    for command in candidates:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+def _python_decompressor(filename, compression):
+    if compression == "gzip":
+        return gzip.open(filename, "rb")
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"reading {filename} needs the zstd binary or the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+
+class DecompressedReader:
+    """
+        Binary, line-iterable stream of a compressed file, decompressed concurrently with the reader.
+
+        Decompression runs in a separate process (pigz/gzip/zstd) when one is on PATH, otherwise in a
+        thread feeding a pipe (zlib and zstandard release the GIL while decompressing).
+
+        close() raises EOFError when the whole stream was read but the decompressor failed (a
+        truncated or corrupt file), so a short read is never taken for the end of the data.
+    """
+    def __init__(self, filename, compression):
+        self._filename = filename
+        self._proc = None
+        self._thread = None
+        self._error = None
+        command = _tool(DECOMPRESSORS.get(compression, []))
+        if command is not None:
+            self._proc = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=COPY_BUFFER)
+            self._stream = self._proc.stdout
+        else:
+            source = _python_decompressor(filename, compression)
+            read_end, write_end = os.pipe()
+            self._stream = os.fdopen(read_end, "rb", buffering=COPY_BUFFER)
+            self._thread = threading.Thread(target=self._pump, args=(source, write_end), daemon=True)
+            self._thread.start()
+
+    def _pump(self, source, write_end):
+        try:
+            with source, os.fdopen(write_end, "wb") as sink:
+                shutil.copyfileobj(source, sink, COPY_BUFFER)
+        except BrokenPipeError:
+            # the reader stopped early
+            pass
+        except Exception as e:
+            # surfaced by close(); the pipe is closed, so the reader sees the data end here
+            self._error = e
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readline(self, size=-1):
+        return self._stream.readline(size)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self._stream.closed:
+            return
+        # nothing left to read means the decompressor reached its end, successfully or not
+        finished = self._stream.read(1) == b""
+        self._stream.close()
+        if self._proc is not None:
+            if not finished:
+                self._proc.kill()
+            self._proc.wait()
+            stderr = self._proc.stderr.read().decode("utf-8", "replace").strip()
+            self._proc.stderr.close()
+            if finished and self._proc.returncode != 0:
+                raise EOFError(f"{self._filename}: decompressor exited with status {self._proc.returncode}: {stderr}")
+        if self._thread is not None:
+            self._thread.join()
+            if self._error is not None:
+                raise EOFError(f"{self._filename}: {self._error}") from self._error
+
+class CompressedWriter:
+    """
+        Binary writer compressing to filename, in a separate process (pigz/gzip/zstd/bgzip) when one is
+        on PATH, otherwise with the gzip / zstandard modules.
+    """
+    def __init__(self, filename, compression):
+        self._proc = None
+        self._file = None
+        command = _tool(COMPRESSORS.get(compression, []))
+        if command is not None:
+            self._file = open(filename, "wb")
+            self._proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self._file, bufsize=COPY_BUFFER)
+            self._stream = self._proc.stdin
+        elif compression == "gzip":
+            self._stream = gzip.open(filename, "wb", compresslevel=6)
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError(f"writing {filename} needs the zstd binary or the zstandard package")
+            self._stream = zstandard.ZstdCompressor().stream_writer(open(filename, "wb"), closefd=True)
+        else:
+            raise ValueError(f"writing {compression} needs {COMPRESSORS[compression][0][0]} on PATH")
+
+    def write(self, data):
+        return self._stream.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._stream.close()
+        if self._proc is not None:
+            if self._proc.wait() != 0:
+                raise OSError(f"compressor exited with status {self._proc.returncode}")
+            self._file.close()
+
+def open_fasta_read(filename):
+    """
+        Binary handle of a fasta file, transparently decompressing gzip, bgzf and zstd
+    """
+    compression = fasta_compression(filename)
+    if compression is None:
+        return open(filename, "rb")
+    return DecompressedReader(filename, compression)
+
+def open_fasta_write(filename, compression=None):
+    """
+        Binary handle writing a fasta file, compressed according to compression or the file extension
+        (.gz, .zst, .bgz)
+    """
+    compression = compression or compression_from_name(filename)
+    if compression is None:
+        return open(filename, "wb", buffering=COPY_BUFFER)
+    return CompressedWriter(filename, compression)
+
+def _fasta_records_mmap(handle):
+    """
+        (header, body) byte slices of every record, located with bytes.find over a memory map
+    """
+    with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        start = mm.find(b">")
+        while start != -1:
+            end = mm.find(b"\n>", start)
+            if end == -1:
+                end = size
+            header_end = mm.find(b"\n", start, end)
+            if header_end == -1:
+                header_end = end
+            yield mm[start + 1:header_end], mm[header_end + 1:end]
+            start = end + 1 if end < size else -1
+
+def _fasta_records_lines(handle):
+    """
+        (header, body) of every record, read line by line from any binary or text handle
+    """
+    header = None
+    chunks = []
+    for line in handle:
+        if isinstance(line, str):
+            line = line.encode()
+        if line.startswith(b">"):
+            if header is not None:
+                yield header, b"".join(chunks)
+            header = line[1:]
+            chunks = []
+        elif header is not None:
+            chunks.append(line)
+    if header is not None:
+        yield header, b"".join(chunks)
+
+def _fasta_cleaner(clean):
+    if clean is None:
+        return lambda seq: seq
+    elif clean == 'delete':
+        # uses code from: https://github.com/facebookresearch/esm/blob/master/examples/contact_prediction.ipynb
+        deletekeys = string.ascii_lowercase.encode() + b".*"
+        return lambda seq: seq.translate(None, deletekeys)
+    elif clean == 'upper':
+        translation = bytes.maketrans(b".", b"-")
+        return lambda seq: seq.upper().translate(translation, b"*")
+    elif clean == 'unalign':
+        anyX = random.choice(ESM_ALLOWED_AMINO_ACIDS).encode()
+        anyB = random.choice("ND").encode()
+        anyZ = random.choice("EQ").encode()
+        translation = bytes.maketrans(b"XBZ", anyX + anyB + anyZ)
+        return lambda seq: seq.upper().translate(translation, b".*-")
+    else:
+        raise ValueError(f"unrecognized input for clean parameter: {clean}")
+
+def iter_fasta(filename, clean=None, full_name=False, use_mmap=True):
+    """
+        Lazily yield the records of a fasta file as bytes.
+
+        input:
+            filename: the name of a fasta file (plain, gzip, bgzf or zstd) or a filehandle to a fasta file.
+            clean: {None, 'upper', 'delete', 'unalign'}, as in parse_fasta
+            full_name: if True, then yield the entire header. By default only the part before the first "|" or "/" is yielded.
+            use_mmap: memory map regular files and split records with bytes.find instead of iterating lines
+
+        output: generator of (name, sequence) bytes tuples, sequence with all whitespace removed
+    """
+    cleaner = _fasta_cleaner(clean)
+    input_type = "handle"
+    input_handle = filename
+    if isinstance(filename, (str, os.PathLike)):
+        # famsa -gz writes gzip output, whatever the file is called
+        input_handle = open_fasta_read(filename)
+        input_type = "name"
+
+    try:
+        records = None
+        if use_mmap:
+            try:
+                if os.fstat(input_handle.fileno()).st_size > 0:
+                    records = _fasta_records_mmap(input_handle)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                # not backed by a regular file (pipe, in-memory or decompressed handle)
+                pass
+        if records is None:
+            records = _fasta_records_lines(input_handle)
+
+        for header, body in records:
+            header = header.strip()
+            if full_name:
+                name = header
+            else:
+                name = header.replace(b'|', b'/').split(b'/', 1)[0]
+            yield name, cleaner(body.translate(None, _WHITESPACE))
+    finally:
+        if input_type == "name":
+            input_handle.close()
+
+@spanned()
 def parse_fasta(filename, return_names=False, clean=None, full_name=False): 
     """
         adapted from: https://bitbucket.org/seanrjohnson/srj_chembiolib/src/master/parsers.py
@@ -148,77 +1018,20 @@ def parse_fasta(filename, return_names=False, clean=None, full_name=False):
                     if 'delete' then delete all lowercase "." and "*" characters. This is usually if the input is an a2m file and you don't want to preserve the original length.
                     if 'upper' then delete "*" characters, convert lowercase to upper case, and "." to "-"
                     if 'unalign' then convert to upper, delete ".", "*", "-"
-            full_name: if True, then returns the entire name. By default only the part before the first whitespace is returned.
+            full_name: if True, then returns the entire name. By default only the part before the first "|" or "/" is returned.
 
         output: sequences or (names, sequences)
+
+        Materializes every record as str; prefer iter_fasta for large files.
     """
-    
-    prev_len = 0
-    prev_name = None
-    prev_seq = ""
-    out_seqs = list()
     out_names = list()
-    (input_handle, input_type) = _open_if_is_name(filename)
-
-    for line in input_handle:
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        if line[0] == ">":
-            if full_name:
-                name = line[1:]
-            else:
-                line = line.replace('|', '/')
-                parts = line.split('/', 1)
-                name = parts[0][1:]
-            out_names.append(name)
-            if (prev_name is not None):
-                out_seqs.append(prev_seq)
-            prev_len = 0
-            prev_name = name
-            prev_seq = ""
-        else:
-            prev_len += len(line)
-            prev_seq += line
-    if (prev_name != None):
-        out_seqs.append(prev_seq)
-
-    if input_type == "name":
-        input_handle.close()
-    
-    if clean == 'delete':
-        # uses code from: https://github.com/facebookresearch/esm/blob/master/examples/contact_prediction.ipynb
-        deletekeys = dict.fromkeys(string.ascii_lowercase)
-        deletekeys["."] = None
-        deletekeys["*"] = None
-        translation = str.maketrans(deletekeys)
-        remove_insertions = lambda x: x.translate(translation)
-
-        for i in range(len(out_seqs)):
-            out_seqs[i] = remove_insertions(out_seqs[i])
-    
-    elif clean == 'upper':
-        deletekeys = {'*': None, ".": "-"}
-        translation = str.maketrans(deletekeys)
-        remove_insertions = lambda x: x.translate(translation)
-
-        for i in range(len(out_seqs)):
-            out_seqs[i] = remove_insertions(out_seqs[i].upper())
-    elif clean == 'unalign':
-        anyX = str(random.choice(ESM_ALLOWED_AMINO_ACIDS))
-        anyB = str(random.choice("ND"))
-        anyZ = str(random.choice("EQ"))
-        deletekeys = {'*': None, ".": None, "-": None, "X": anyX, "B": anyB, "Z": anyZ}
-        
-        translation = str.maketrans(deletekeys)
-        remove_insertions = lambda x: x.translate(translation)
-        
-        for i in range(len(out_seqs)):
-            out_seqs[i] = remove_insertions(out_seqs[i].upper())
-    elif clean is not None:
-        raise ValueError(f"unrecognized input for clean parameter: {clean}")
+    out_seqs = list()
+    for name, seq in iter_fasta(filename, clean=clean, full_name=full_name):
+        out_names.append(name.decode())
+        out_seqs.append(seq.decode())
+        add_bytes(len(name) + len(seq))
 
     if return_names:
         return out_names, out_seqs
     else:
-        return out_seqs
\ No newline at end of file
+        return out_seqs
@@ -0,0 +1,89 @@
+import hashlib
+from util import iter_fasta
+
+GAPS = b"-."
+
+# digests combine as a sum modulo 2**128, so record order does not matter
+DIGEST_MODULUS = 1 << 128
+
+
+def _record_name(name):
+    # some aligners cut names at the first whitespace
+    return name.split(None, 1)[0] if name.strip() else name
+
+
+def _digest(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=16).digest(), "little")
+
+
+def fasta_fingerprint(filename, aligned=False):
+    """
+        Order-independent fingerprint of a fasta file (plain or gzip), computed in one streaming pass.
+
+        input:
+            aligned: degap the rows and check they all have the same width
+
+        output: dict with
+            records: number of records
+            names: combined digest of the record names
+            content: combined digest of every (name, upper-cased ungapped sequence)
+            width: alignment width (aligned only, None if rows differ)
+    """
+    records = names = content = 0
+    width = None
+    ragged = False
+    for name, seq in iter_fasta(filename):
+        name = _record_name(name)
+        if aligned:
+            if width is None:
+                width = len(seq)
+            elif len(seq) != width:
+                ragged = True
+            seq = seq.translate(None, GAPS)
+        records += 1
+        names = (names + _digest(name)) % DIGEST_MODULUS
+        content = (content + _digest(name + b"\0" + seq.upper())) % DIGEST_MODULUS
+
+    return {"records": records, "names": names, "content": content, "width": None if ragged else width}
+
+
+class AlignmentValidator:
+    """
+        Check aligner outputs against their input without holding either in memory.
+
+        An output passes when every row has the same width, it has as many records as the input,
+        the record names are the same set, and every degapped row equals its input sequence
+        (compared through per-record hashes, case-insensitively). Input fingerprints are cached.
+    """
+    def __init__(self):
+        self._inputs = {}
+
+    def input_fingerprint(self, input_file):
+        if input_file not in self._inputs:
+            self._inputs[input_file] = fasta_fingerprint(input_file)
+        return self._inputs[input_file]
+
+    def validate(self, input_file, output_file):
+        """
+            output: dict with valid (bool) and validation (reason of the first failed check, "ok" otherwise)
+        """
+        expected = self.input_fingerprint(input_file)
+        try:
+            found = fasta_fingerprint(output_file, aligned=True)
+        except (OSError, EOFError) as e:
+            # missing output or truncated gzip stream
+            return {"valid": False, "validation": f"unreadable output: {e}"}
+
+        if found["records"] == 0:
+            reason = "empty output"
+        elif found["width"] is None:
+            reason = "rows differ in width"
+        elif found["records"] != expected["records"]:
+            reason = f"{found['records']} records, input has {expected['records']}"
+        elif found["names"] != expected["names"]:
+            reason = "record names differ from input"
+        elif found["content"] != expected["content"]:
+            reason = "degapped sequences differ from input"
+        else:
+            reason = "ok"
+        return {"valid": reason == "ok", "validation": reason}
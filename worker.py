@@ -0,0 +1,76 @@
+import argparse
+import contextlib
+import os
+import tempfile as tmp
+import time
+import traceback
+from aligners import ALIGNERS
+from dedup import deduplicated
+from divide import divided
+from job_queue import JobQueue, Heartbeat, LEASE, MAX_ATTEMPTS, worker_name
+from scoring import load_references
+from sinks import OutputSink
+from trials import run_cell
+from validate import AlignmentValidator
+
+# Define arguments
+parser = argparse.ArgumentParser(description='Run benchmark jobs from a queue filled by benchmark.py --queue')
+parser.add_argument('queue', type=str, help='SQLite job queue, on storage shared by all workers')
+parser.add_argument('--lease', type=float, default=LEASE, help='Seconds without a heartbeat after which a running job is handed to another worker')
+parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help='Claims of a job (workers lost while running it) before it is marked failed')
+parser.add_argument('--poll', type=float, default=10, help='Seconds between looks at the queue while other workers still run jobs')
+parser.add_argument('--max-jobs', type=int, default=None, help='Exit after this many jobs')
+parser.add_argument('--retry-failed', action='store_true', help='Put failed jobs back in the queue before starting')
+args = parser.parse_args()
+
+queue = JobQueue(args.queue, lease=args.lease, max_attempts=args.max_attempts)
+if args.retry_failed:
+        print(f"Re-queued {queue.retry_failed()} failed jobs")
+config = queue.config()
+worker = worker_name()
+
+sink = OutputSink(config["output_sink"], config["tmpfs_dir"])
+validator = AlignmentValidator() if config["validate"] else None
+references = load_references(config["references"], config["reference_pattern"]) if config["references"] else None
+
+output_dir = contextlib.nullcontext(config["output_dir"]) if config["output_dir"] else tmp.TemporaryDirectory()
+with output_dir as save_path:
+        os.makedirs(save_path, exist_ok=True)
+        finished = 0
+        while args.max_jobs is None or finished < args.max_jobs:
+                claimed = queue.claim(worker)
+                if claimed is None:
+                        # jobs still running elsewhere come back if their worker dies
+                        if not queue.counts()["running"]:
+                                break
+                        time.sleep(args.poll)
+                        continue
+
+                job_id, spec = claimed
+                fn = ALIGNERS[spec.get("base_aligner", spec["aligner"])]
+                if spec.get("divide"):
+                        fn = divided(fn)
+                if spec.get("dedup"):
+                        fn = deduplicated(fn)
+                job = dict(spec, fn=fn, output_file=os.path.join(save_path, spec["output_file"]))
+                print(f"{worker}: {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads)")
+                samples = []
+                with Heartbeat(queue, job_id, worker) as heartbeat:
+                        try:
+                                row = run_cell(job, {}, sink=sink, validator=validator, references=references, column_stats=config.get("column_stats", False),
+                                        trial_samples=samples, **config["trial_options"], **config["run_options"])
+                        except Exception as e:
+                                # any error fails only this job, the worker moves on to the next one
+                                queue.fail(job_id, worker, f"{type(e).__name__}: {e}")
+                                print(f"FAILED {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads): {e}")
+                                traceback.print_exc()
+                                finished += 1
+                                continue
+
+                if heartbeat.lost or not queue.complete(job_id, worker, {"row": row, "trials": [[trial, trial_row] for _, _, trial, trial_row in samples], "worker": worker}):
+                        print(f"Lost the lease of {job['label']} on {job['dataset_size'].upper()} ({job['threads']} threads), another worker runs it")
+                finished += 1
+
+sink.close()
+queue.close()
+print(f"{worker}: finished {finished} jobs")